@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import sys
+from pathlib import Path
+from typing import NoReturn, Optional
+from json import dump
+from datetime import datetime
+from argparse import ArgumentParser, Namespace
+
+prj_path = Path(__file__).resolve().parents[1]
+sys.path.append(str(prj_path))
+
+from src.tools import die
+from src.Wireshark.common import BACKENDS, PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS
+from src.Wireshark.Tshark.Store import Stats_Store
+from src.Wireshark.Tshark.functions import PCAP_FILE_SUFFIXES
+
+CONF_DIR = prj_path / 'data/config'
+CONF_DIR.mkdir(parents=True, exist_ok=True)
+
+CACHE_DIR = prj_path / 'data/cache'
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+
+Arg_help = Namespace(
+    captures=('Packet capture files or directories of them to add to the store.'
+              ' Captures which are already collected are not dissected again.'),
+    database='Path to the store database (default: data/cache/capture_stats.sqlite3).',
+    protos='Comma separated protocols of the statistics (default: every supported one).',
+    display_filter='Display filter the statistics are collected with (tshark backend only).',
+    backend=("`tshark` runs tshark, `python` reads the captures in-process"
+             " (ethernet, ip, ipv6, tcp, udp and sctp statistics only),"
+             " `auto` (default) uses tshark if it is installed"),
+    checksum='Only the capture of a sha256 (may be repeated).',
+    since='Only captures starting at or after a time (unix timestamp or ISO 8601).',
+    until='Only captures starting before a time (unix timestamp or ISO 8601).',
+    header='Only reports with a header, e.g. `TCP Conversations` (may be repeated).',
+    top='Only the first N entries of every report.',
+    key='Comma separated fields to sort the entries by, largest first (default: total_bytes or bytes).',
+    bucket='Returns a json list of conversations, frames and bytes per time bucket of SECONDS.',
+    format='Output format of the merged reports (default: table).',
+    list_captures='Returns a json list of captures in the store.',
+    prune='Forget captures whose files do not exist anymore.',
+    indent='Set indentation value for resulting json.'
+)
+
+
+def parse_arguments() -> Namespace:
+    parser = ArgumentParser(description='Keep the endpoint and conversation statistics of packet captures'
+                                        ' and merge them across captures.')
+    parser.add_argument('captures', type=str, nargs='*', help=Arg_help.captures)
+    parser.add_argument('-d', '--database', type=str, default=str(CACHE_DIR / 'capture_stats.sqlite3'), help=Arg_help.database)
+    parser.add_argument('-P', '--protos', type=str, help=Arg_help.protos)
+    parser.add_argument('-f', '--display-filter', type=str, help=Arg_help.display_filter)
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='auto', help=Arg_help.backend)
+    parser.add_argument('-c', '--checksum', type=str, action='append', help=Arg_help.checksum)
+    parser.add_argument('-s', '--since', type=str, help=Arg_help.since)
+    parser.add_argument('-u', '--until', type=str, help=Arg_help.until)
+    parser.add_argument('-H', '--header', type=str, action='append', help=Arg_help.header)
+    parser.add_argument('-t', '--top', type=int, metavar='N', help=Arg_help.top)
+    parser.add_argument('-k', '--key', type=str, help=Arg_help.key)
+    parser.add_argument('-B', '--bucket', type=float, metavar='SECONDS', help=Arg_help.bucket)
+    parser.add_argument('-o', '--format', choices=('table', 'csv', 'json', 'ndjson'), default='table', help=Arg_help.format)
+    parser.add_argument('-l', '--list-captures', action='store_true', help=Arg_help.list_captures)
+    parser.add_argument('-p', '--prune', action='store_true', help=Arg_help.prune)
+    parser.add_argument('-i', '--indent', type=int, help=Arg_help.indent)
+    return parser.parse_args()
+
+
+def expand_capture_paths(paths: list[str]) -> list[Path]:
+    capture_paths = []
+    for path in map(Path, paths):
+        if not path.exists():
+            die(1, f"Error: The file {path} does not exist.")
+        if path.is_dir():
+            capture_paths.extend(sorted(
+                p for p in path.iterdir()
+                if p.is_file() and p.suffix.lower() in PCAP_FILE_SUFFIXES))
+        else:
+            capture_paths.append(path)
+    return capture_paths
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        die(2, f"Error: {value} is neither a unix timestamp nor an ISO 8601 time.")
+
+
+def write_reports(reports: list, args: Namespace) -> None:
+    for report in reports:
+        if args.header and report.header not in args.header:
+            continue
+        if (args.top is not None or args.key) and report.entries:
+            fields = report.entry_fields
+            key = args.key.split(',') if args.key else \
+                ['total_bytes' if 'total_bytes' in fields else 'bytes']
+            if args.top is not None:
+                report.entries[:] = report.top_entries(args.top, key)
+            else:
+                report.sort_entries(key, reverse=True)
+        if   args.format == 'table':  report.write_pretty_table(sys.stdout); print()
+        elif args.format == 'csv':    report.write_csv(sys.stdout)
+        elif args.format == 'ndjson': report.write_ndjson(sys.stdout)
+        else: report.write_json(sys.stdout, args.indent); print()
+
+
+def main() -> NoReturn:
+    args = parse_arguments()
+
+    capture_paths = expand_capture_paths(args.captures)
+    proto = args.protos or PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS
+    since, until = parse_time(args.since), parse_time(args.until)
+
+    with Stats_Store(args.database) as store:
+        if args.prune:
+            print(f"Forgot {store.remove_missing_captures()} missing captures.", file=sys.stderr)
+        if capture_paths:
+            try:
+                collected, skipped = store.add_captures(
+                    capture_paths, proto, args.display_filter, args.backend)
+            except ValueError as e:
+                die(2, f"Error: {e}")
+            print(f"Collected {len(collected)} captures, skipped {len(skipped)} already collected.",
+                  file=sys.stderr)
+
+        try:
+            if args.list_captures:
+                result = store.captures()
+            elif args.bucket is not None:
+                result = [row for row in store.conversation_buckets(
+                              args.bucket, proto, args.display_filter,
+                              args.checksum, since, until)
+                          if not args.header or row['header'] in args.header]
+            else:
+                write_reports(store.merged_reports(
+                    proto, args.display_filter, args.checksum, since, until), args)
+                die(0)
+        except ValueError as e:
+            die(2, f"Error: {e}")
+
+    try:
+        dump(
+            result,
+            fp=sys.stdout,
+            ensure_ascii=False,
+            indent=args.indent
+        )
+    except Exception as e:
+        die(3, e)
+
+    die(0)
+
+
+if __name__ == '__main__':
+    main()
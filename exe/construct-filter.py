@@ -15,17 +15,23 @@ from argparse import ArgumentParser, Namespace
 from pathlib import Path
 
 from src.tools import die
-from src.net_tools import (
-    construct_capture_filter, construct_display_filter,
-    construct_filters
-)
+from src.net_tools import construct_capture_filter, construct_filters
+from src.bpf_tools import compile_filter
+from src.filter_cache import Filter_Cache
 
 
 ArgHelp = Namespace(
     csv='path to csv file',
     exclude='construct filter to exclude packets from capture',
     capture='construct capture filter for tcpdump, tshark, or wireshark',
-    display='construct display filter for tshark or wireshark'
+    display='construct display filter for tshark or wireshark',
+    optimize=('combine endpoints with the same protocol and ports,'
+              ' collapse their addresses into networks and ports into ranges'),
+    bpf_report=('compile the capture filter, plain and optimized, into BPF'
+                ' and report its size and worst-case path length'
+                ' (uses libpcap if available)'),
+    no_cache=(f"do not use the cache of parsed csv files and filters"
+              f" in {CACHE_DIR / 'filters'}")
 )
 
 
@@ -38,6 +44,12 @@ def parse_arguments() -> Namespace:
                         action='store_true', help=ArgHelp.capture)
     parser.add_argument('-d', '--display',
                         action='store_true', help=ArgHelp.display)
+    parser.add_argument('-O', '--optimize',
+                        action='store_true', help=ArgHelp.optimize)
+    parser.add_argument('-B', '--bpf-report',
+                        action='store_true', help=ArgHelp.bpf_report)
+    parser.add_argument('-n', '--no-cache',
+                        action='store_true', help=ArgHelp.no_cache)
     return parser.parse_args()
 
 
@@ -52,31 +64,53 @@ def process_csv_path(csv_path_str: str) -> str:
     return csv_content
 
 
+def print_bpf_report(csv_content: str, goal: str) -> None:
+    rows = [('filter', 'characters', 'instructions', 'worst-case path', 'backend')]
+    for name, optimize in (('plain', False), ('optimized', True)):
+        expression = construct_capture_filter(
+            csv_content, goal=goal, optimize=optimize)
+        try:
+            program = compile_filter(expression)
+        except ValueError as e:
+            die(2, f"Could not compile the {name} filter: {e}")
+        rows.append((name, len(expression), program.instruction_count,
+                     program.worst_case_path, program.backend))
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
 def process_args(args: Namespace):
     #TODO: implement stdin processing
-    csv_paths = []
-    if ',' in args.csv:
-        for csv_path in [p.strip() for p in args.csv.split(',')]:
-            csv_content = process_csv_path(csv_path)
-            csv_paths.append(csv_content.strip())
-        csv_content = '\n'.join(p for p in csv_paths if p != '').strip()
-    else:
-        csv_path = args.csv
-        csv_content = process_csv_path(csv_path)
+    csv_contents = [
+        process_csv_path(p.strip()).strip() for p in args.csv.split(',')]
+    csv_contents = [c for c in csv_contents if c != '']
+    csv_content = '\n'.join(csv_contents)
 
     if args.exclude:
         goal = 'exclude'
     else:
         goal = 'include'
 
-    if args.capture and not args.display:
-        print(construct_capture_filter(csv_content, goal=goal))
-    elif not args.capture and args.display:
-        print(construct_display_filter(csv_content, goal=goal))
+    if args.bpf_report:
+        print_bpf_report(csv_content, goal)
+        return
+
+    capture = args.capture or not args.display
+    display = args.display or not args.capture
+    if args.no_cache:
+        filters = construct_filters(
+            csv_content, capture=capture, display=display,
+            goal=goal, optimize=args.optimize)
     else:
-        filters = construct_filters(csv_content, goal=goal)
+        filters = Filter_Cache(CACHE_DIR / 'filters').filters(
+            csv_contents, capture=capture, display=display,
+            goal=goal, optimize=args.optimize)
+    if capture and display:
         for filter in filters:
             print(filter)
+    else:
+        print(filters)
 
 
 def main():
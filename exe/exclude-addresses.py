@@ -3,14 +3,18 @@
 import sys
 from pathlib import Path
 from argparse import ArgumentParser, Namespace
-from typing import NoReturn, Union
+from typing import Iterator, NoReturn, Optional, Union
 from ipaddress import IPv4Network, IPv6Network, ip_network
 
 prj_path = Path(__file__).resolve().parents[1]
 sys.path.append(str(prj_path))
 
 from src.tools import die
-from src.net_tools import exclude_addresses, is_string_a_valid_ip_network
+from src.net_tools import (
+    parse_ip_string, parse_ip_strings,
+    exclude_addresses, exclude_addresses_stream, exclude_addresses_batch,
+    approximate_networks
+)
 
 CONF_DIR = prj_path / 'data/config'
 CONF_DIR.mkdir(parents=True, exist_ok=True)
@@ -20,12 +24,24 @@ CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 
 ArgHelp = Namespace(
-    network="The network from which we exclude addresses",
+    network=("The network from which we exclude addresses. Several comma"
+             " separated networks are processed in one pass against the"
+             " same addresses"),
     addresses=("comma or whitespace separated addresses of hosts"
                " and/or networks to be excluded"),
     separator=("separator for the list of resulting networks."
                " Default is the new line"),
-    ignore="ignore non-valid input arguments (except the target network)"
+    ignore="ignore non-valid input arguments (except the target network)",
+    file=("file with addresses to be excluded, one or more per line"
+          " (`-` for stdin). Can be repeated. Results are written"
+          " to stdout as they are produced"),
+    sorted=("input files are sorted by address, so they are merged"
+            " on the fly with flat memory usage"),
+    max_prefixes=("maximum number of resulting networks. If exceeded,"
+                  " the closest networks are merged (addresses between"
+                  " them are over-included)"),
+    drop=("with --max-prefixes also allow leaving out small networks"
+          " (their addresses are under-included)")
 )
 
 def parse_arguments() -> Namespace:
@@ -34,23 +50,45 @@ def parse_arguments() -> Namespace:
     parser.add_argument('-a', '--addresses', type=str, help=ArgHelp.addresses)
     parser.add_argument('-s', '--separator', type=str, help=ArgHelp.separator)
     parser.add_argument('-i', '--ignore', action='store_true', help=ArgHelp.ignore)
+    parser.add_argument('-f', '--file', type=str, action='append', help=ArgHelp.file)
+    parser.add_argument('-S', '--sorted', action='store_true', help=ArgHelp.sorted)
+    parser.add_argument('-m', '--max-prefixes', type=int, help=ArgHelp.max_prefixes)
+    parser.add_argument('-D', '--drop', action='store_true', help=ArgHelp.drop)
     return parser.parse_args()
 
 
 def validate_args(
-        target_net: str, addrs_str: str
-) -> Union[tuple[Union[IPv4Network, IPv6Network], str], NoReturn]:
-    if not is_string_a_valid_ip_network(target_net):
-        die(1, f"{target_net} is not a valid ip network.")
-    elif not addrs_str:
+        target_nets_str: str, addrs_str: Optional[str],
+        addrs_required: bool = True
+) -> Union[tuple[list[Union[IPv4Network, IPv6Network]], str], NoReturn]:
+    target_nets = []
+    for target_net in (t.strip() for t in target_nets_str.split(',')):
+        kind, parsed = parse_ip_string(target_net)
+        if kind == 'invalid':
+            die(1, f"{target_net} is not a valid ip network.")
+        target_nets.append(ip_network(parsed))
+    if addrs_required and not addrs_str:
         die(2, f"Missing addresses argument. It must be a {ArgHelp.addresses}.")
-    target_net = ip_network(target_net)
-    addrs_str = str(addrs_str).strip()
+    addrs_str = str(addrs_str).strip() if addrs_str else ''
+
+    return target_nets, addrs_str
 
-    return target_net, addrs_str
 
+def check_address(
+        net_a: Union[IPv4Network, IPv6Network],
+        target_nets: list[Union[IPv4Network, IPv6Network]]
+) -> Optional[str]:
+    '''Return the kind of mistake in the address to be excluded, if any.'''
+    same_version_nets = [t for t in target_nets if t.version == net_a.version]
+    if not same_version_nets:
+        return 'misfitting address'
+    elif not any(net_a.subnet_of(t) for t in same_version_nets):
+        # Supernets of the target network are irrelevant as well.
+        return 'irrelevant address'
+    return None
 
-def process_args(target_net: Union[str, IPv4Network, IPv6Network],
+
+def process_args(target_nets: list[Union[IPv4Network, IPv6Network]],
           addrs_str: str) -> Union[tuple[set, set, set, set], NoReturn]:
 
     addr_objs = set()
@@ -59,17 +97,14 @@ def process_args(target_net: Union[str, IPv4Network, IPv6Network],
     mis_addrs = set()
     irr_addrs = set()
 
-    if is_string_a_valid_ip_network(addrs_str):
-        net_a = ip_network(addrs_str)
-        if not isinstance(net_a, type(target_net)):
+    kind, parsed = parse_ip_string(addrs_str)
+    if kind != 'invalid':
+        net_a = ip_network(parsed)
+        mistake = check_address(net_a, target_nets)
+        if mistake == 'misfitting address':
             mis_addrs.add(net_a)
-        elif not net_a.subnet_of(target_net):
-            # Mistake maybe (?).
-            #TODO: add comments to clarify
-            if net_a.supernet_of(target_net):
-                irr_addrs.add(net_a)
-            else:
-                irr_addrs.add(net_a)
+        elif mistake == 'irrelevant address':
+            irr_addrs.add(net_a)
         else: addr_objs.add(net_a)
     else:
         # split the string of addresses to be excluded into a set of strings to avoid duplication
@@ -81,14 +116,15 @@ def process_args(target_net: Union[str, IPv4Network, IPv6Network],
                 die(2, f"{addrs_str} is not a valid ip network.")
             addrs = set(
                 a.strip() for a in addrs_str.split() if a.strip() != '')
-        for a in addrs:
-            if not is_string_a_valid_ip_network(a, strict=False):
+        for a, (kind, parsed) in zip(addrs, parse_ip_strings(addrs)):
+            if kind == 'invalid':
                 inv_addrs.add(a); continue
             else:
-                net_a = ip_network(a)
-            if not isinstance(net_a, type(target_net)):
+                net_a = ip_network(parsed)
+            mistake = check_address(net_a, target_nets)
+            if mistake == 'misfitting address':
                 mis_addrs.add(net_a)
-            elif not net_a.subnet_of(target_net):
+            elif mistake == 'irrelevant address':
                 irr_addrs.add(a)
             else:
                 addr_objs.add(net_a)
@@ -113,17 +149,109 @@ def print_result_and_exit(result_nets, separator) -> NoReturn:
     die(0, separator.join((str(n) for n in result_nets)).strip())
 
 
+def read_addresses_from_files(
+        target_nets: list[Union[IPv4Network, IPv6Network]],
+        paths: list[str], ignore: bool = False
+) -> Union[Iterator[Union[IPv4Network, IPv6Network]], NoReturn]:
+    '''Lazily yield networks to be excluded from files or stdin.
+
+    Lines may hold comma or whitespace separated addresses,
+    everything after `#` is a comment.'''
+    for path in paths:
+        if path == '-':
+            file = sys.stdin
+        elif not Path(path).is_file():
+            die(1, f"File {path} does not exist or is not a file.")
+        else:
+            file = open(path, 'r', encoding='utf-8')
+        with file:
+            for line_number, line in enumerate(file, start=1):
+                for a in line.split('#', 1)[0].replace(',', ' ').split():
+                    kind, parsed = parse_ip_string(a)
+                    if kind == 'invalid':
+                        error = 'invalid address'
+                    else:
+                        net_a = ip_network(parsed)
+                        error = check_address(net_a, target_nets)
+                        if error is None:
+                            yield net_a; continue
+                    if not ignore:
+                        die(2, f"{error}: {a} ({path}:{line_number})")
+
+
+def approximate_result(result_nets, max_prefixes: int, allow_drop: bool) -> list:
+    if max_prefixes < 1:
+        die(2, "Maximum number of prefixes must be a positive number.")
+    approximation = approximate_networks(result_nets, max_prefixes, allow_drop)
+    print(f"over-included addresses: {approximation.over_included},"
+          f" under-included addresses: {approximation.under_included}",
+          file=sys.stderr)
+    return approximation.networks
+
+
+def print_batch_result_and_exit(
+        target_nets, results, separator,
+        max_prefixes: Optional[int] = None, allow_drop: bool = False
+) -> NoReturn:
+    blocks = []
+    for target_net in target_nets:
+        result_nets = results[target_net] or [target_net]
+        if max_prefixes is not None:
+            result_nets = approximate_result(result_nets, max_prefixes, allow_drop)
+        blocks.append(f"# {target_net}\n"
+                      + separator.join(str(n) for n in result_nets).strip())
+    die(0, '\n\n'.join(blocks))
+
+
+def stream_result_and_exit(result_nets, separator) -> NoReturn:
+    first = True
+    try:
+        for net in result_nets:
+            if not first: sys.stdout.write(separator)
+            sys.stdout.write(str(net)); first = False
+    except ValueError as e:
+        die(2, f"\n{e}" if not first else str(e))
+    if not first: sys.stdout.write('\n')
+    die(0)
+
+
 def main() -> NoReturn:
     args = parse_arguments()
     if not args.separator: separator = "\n"
     else:  separator = str(args.separator)
-    target_net, addrs_str = validate_args(args.network, args.addresses)
-    addr_objs, inv_addrs, mis_addrs, irr_addrs = process_args(target_net, addrs_str)
+    if args.file:
+        if args.addresses:
+            die(2, "Use either addresses argument or files, not both.")
+        target_nets, _ = validate_args(args.network, None, addrs_required=False)
+        addr_objs = read_addresses_from_files(target_nets, args.file, args.ignore)
+        if len(target_nets) > 1:
+            print_batch_result_and_exit(
+                target_nets, exclude_addresses_batch(target_nets, addr_objs),
+                separator, args.max_prefixes, args.drop)
+        result_nets = exclude_addresses_stream(
+            target_nets[0], addr_objs, presorted=args.sorted)
+        if args.max_prefixes is not None:
+            try:
+                result_nets = approximate_result(
+                    result_nets, args.max_prefixes, args.drop)
+            except ValueError as e:
+                die(2, str(e))
+        stream_result_and_exit(result_nets, separator)
+    target_nets, addrs_str = validate_args(args.network, args.addresses)
+    addr_objs, inv_addrs, mis_addrs, irr_addrs = process_args(target_nets, addrs_str)
     if not args.ignore and (inv_addrs or mis_addrs or irr_addrs):
         print_errors_and_exit(inv_addrs, mis_addrs, irr_addrs)
+    elif len(target_nets) > 1:
+        print_batch_result_and_exit(
+            target_nets, exclude_addresses_batch(target_nets, addr_objs),
+            separator, args.max_prefixes, args.drop)
     else:
+        target_net = target_nets[0]
         result_nets = sorted(list(exclude_addresses(target_net, (a for a in addr_objs))))
         if len(result_nets) == 0: die(0, target_net)
+        if args.max_prefixes is not None:
+            result_nets = approximate_result(
+                result_nets, args.max_prefixes, args.drop)
         print_result_and_exit(result_nets, separator)
 
 
@@ -4,17 +4,18 @@
 import sys
 import json
 from pathlib import Path
-from typing import Union
-from ipaddress import (
-    IPv4Network, IPv6Network,
-    ip_address, ip_network,
-    collapse_addresses
-)
+from typing import Iterable, Iterator, Union
+from ipaddress import IPv4Network, IPv6Network
 from argparse import ArgumentParser, Namespace
 
 prj_path = Path(__file__).resolve().parents[1]
 sys.path.append(str(prj_path))
 
+from src.net_tools import Prefix_Set
+from src.sni_tools import (
+    SECTIONS, SERVER_NAME_TO_ADDRESSES,
+    Domain_Trie, Substring_Automaton, address_key, read_sections
+)
 
 CONF_DIR = prj_path / 'data/config'
 CONF_DIR.mkdir(parents=True, exist_ok=True)
@@ -27,7 +28,10 @@ ArgHelp = Namespace(
     services="comma-separated list of domain names or their parts",
     data="data from which addresses are extracted",
     separator=("separator for the list of resulting networks."
-               " Default is the new line")
+               " Default is the new line"),
+    match=("`substring` (default) matches server names containing a service"
+           " name, `suffix` the service names and their subdomains"
+           " (`*.example.com` for subdomains only)")
 )
 
 
@@ -37,68 +41,71 @@ def parse_arguments() -> Namespace:
     parser.add_argument('-d', '--data',      type=str, help=ArgHelp.data)
     parser.add_argument('-s', '--separator', type=str, help=ArgHelp.separator,
                         default='\n')
+    parser.add_argument('-m', '--match',     type=str, help=ArgHelp.match,
+                        choices=('substring', 'suffix'), default='substring')
     return parser.parse_args()
 
 
+def iterate_sni_sections(
+        data: Union[str, Path, dict]
+) -> Iterator[tuple[str, Iterable[tuple[str, list[str]]]]]:
+    '''Sections of SNI data given as a json file (streamed), a json string
+    or an already loaded dictionary.'''
+    if isinstance(data, Path) or (isinstance(data, str) and not data.lstrip().startswith('{')):
+        yield from read_sections(data)
+        return
+    if isinstance(data, str):
+        data = json.loads(data)
+    if not isinstance(data, dict):
+        raise ValueError("data must be a path, a json string or a dictionary.")
+    for section, entries in data.items():
+        if section in SECTIONS:
+            yield section, entries.items()
+
+
 def get_service_addresses_list(
         service_names: Union[str, list, set, tuple],
-        data: Union[str, Path, dict, list]
+        data: Union[str, Path, dict],
+        match: str = 'substring'
 ) -> list[Union[IPv4Network,IPv6Network]]:
-
-    if isinstance(data, (str, Path)):
-        if Path(data).exists() and Path(data).is_file:
-            try:
-                with open(data, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                if isinstance(data, dict):
-                    if 'server_name_to_addresses' in data.keys():
-                        data = data['server_name_to_addresses'].items()
-                #TODO: implement else-case
-            except Exception as e: raise e
-        elif isinstance(data, str):
-            try:
-                data = json.loads(data)
-                if isinstance(data, dict):
-                    if 'server_name_to_addresses' in data.keys():
-                        data = data['server_name_to_addresses'].items()
-                    #TODO: implement else-case
-                #TODO: implement else-case
-            except Exception as e: raise e
-    elif isinstance(data, dict):
-        if 'server_name_to_addresses' in data.keys():
-            data = data['server_name_to_addresses'].items()
+    '''Networks of the addresses of server names containing any of
+    `service_names` (`match='substring'`) or being any of them or their
+    subdomains (`match='suffix'`). The names are matched by one automaton
+    in a single pass over the data, collecting the addresses as ranges.'''
 
     if isinstance(service_names, str):
-        if ',' not in service_names:
-            data = {
-                sni: addr for sni, addr in data
-                if service_names.lower() in sni.lower()
-            }
-        else:
-            service_names = set(
-                n.strip() for n in service_names.strip().split(',')
-                if n.strip() != '')
-            return get_service_addresses_list(service_names, data)
-    elif isinstance(service_names, (list, set, tuple)):
-        if all(isinstance(n, str) for n in service_names):
-            data = {
-                sni: addr for sni, addr in data
-                if any(name.strip().lower() in sni.lower()
-                       for name in service_names)
-            }
-        else:
-            raise ValueError(
-                "All elements of service_name iterable must be strings.")
-    else:
+        service_names = service_names.split(',')
+    elif not isinstance(service_names, (list, set, tuple)):
         raise ValueError("service_name must be a string or a list of strings.")
+    if not all(isinstance(n, str) for n in service_names):
+        raise ValueError(
+            "All elements of service_name iterable must be strings.")
+    service_names = set(n.strip().lower() for n in service_names if n.strip() != '')
+
+    if match == 'substring':
+        matcher = Substring_Automaton(service_names)
+    elif match == 'suffix':
+        matcher = Domain_Trie(service_names)
+    else:
+        raise ValueError(f"Unknown match mode: {match}.")
+
+    ranges = {4: [], 6: []}
+    # Both sections hold the same pairs, so the first one is enough.
+    for section, entries in iterate_sni_sections(data):
+        if section == SERVER_NAME_TO_ADDRESSES:
+            for server_name, addresses in entries:
+                if server_name in matcher:
+                    for address in addresses:
+                        version, value = address_key(address)
+                        ranges[version].append((value, value))
+        else:
+            for address, server_names in entries:
+                if any(server_name in matcher for server_name in server_names):
+                    version, value = address_key(address)
+                    ranges[version].append((value, value))
+        break
 
-    service_addresses = []
-    for sni_addr in data.values():
-        service_addresses.extend(sni_addr)
-    service_addresses = list(
-        collapse_addresses(ip_address(addr) for addr in service_addresses))
-
-    return service_addresses
+    return Prefix_Set.from_ranges(ranges[4], ranges[6]).collapse()
 
 
 def print_result(result, separator):
@@ -110,7 +117,7 @@ def main():
     args = parse_arguments()
     print_result(
         get_service_addresses_list(
-            service_names=args.services, data=args.data
+            service_names=args.services, data=args.data, match=args.match
         ),
         args.separator
     )
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 from pathlib import Path
 from typing import NoReturn
@@ -11,6 +12,7 @@ sys.path.append(str(prj_path))
 
 from src.tools import die
 from src.Wireshark.Tshark.functions import get_sni_dict
+from src.Wireshark.common import BACKENDS
 
 CONF_DIR = prj_path / 'data/config'
 CONF_DIR.mkdir(parents=True, exist_ok=True)
@@ -24,17 +26,25 @@ Arg_help = Namespace(
     indent='Set indentation value for resulting json.',
     ntoa='Returns a json of server names and their addresses.',
     aton='Returns a json of addresses and their server names.',
-    stdout='Print the resulting json to stdout.'
+    stdout='Print the resulting json to stdout.',
+    backend=('`tshark` runs tshark, `python` extracts server names from'
+             ' TLS and QUIC ClientHello messages in-process (no filter'
+             ' expressions), `auto` (default) uses tshark if it is installed.'),
+    jobs=('Number of parallel processes (default: one per CPU core when'
+          ' given without a value). The python backend splits captures into'
+          ' chunks, tshark runs one process per file.')
 )
 
 
 def parse_arguments() -> Namespace:
     parser = ArgumentParser(description='Process a pcap or pcapng file and save SNIs as a JSON file.')
-    parser.add_argument('pcap', type=str, help='Path to the pcap or pcapng file.')
+    parser.add_argument('pcap', type=str, help='Path to the pcap or pcapng file, or a directory of them.')
     parser.add_argument('-f', '--filter', type=str, help=Arg_help.filter)
     parser.add_argument('-i', '--indent', type=int, help=Arg_help.indent)
     parser.add_argument('-N', '--ntoa', action='store_true', help=Arg_help.ntoa)
     parser.add_argument('-A', '--aton', action='store_true', help=Arg_help.aton)
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='auto', help=Arg_help.backend)
+    parser.add_argument('-j', '--jobs', type=int, nargs='?', const=0, help=Arg_help.jobs)
     return parser.parse_args()
 
 
@@ -43,13 +53,20 @@ def main() -> NoReturn:
 
     if not Path(args.pcap).exists():
         die(1, f"Error: The file {args.pcap} does not exist.")
+    if args.jobs is not None and args.jobs < 0:
+        die(2, "Error: The number of jobs must be positive.")
 
-    sni_dict = get_sni_dict(
-        args.pcap,
-        filter=args.filter,
-        get_server_name_to_addresses=args.ntoa,
-        get_address_to_server_names=args.aton,
-    )
+    try:
+        sni_dict = get_sni_dict(
+            args.pcap,
+            filter=args.filter,
+            get_server_name_to_addresses=args.ntoa,
+            get_address_to_server_names=args.aton,
+            backend=args.backend,
+            workers=None if args.jobs is None else (args.jobs or os.cpu_count())
+        )
+    except ValueError as e:
+        die(2, f"Error: {e}")
 
     try:
         dump(
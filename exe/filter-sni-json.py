@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
+import re
 import sys
 from pathlib import Path
+from typing import NoReturn, Optional
 from argparse import ArgumentParser, Namespace
-from json import dumps
+from ipaddress import ip_network
 
 prj_path = Path(__file__).resolve().parents[1]
 sys.path.append(str(prj_path))
 
+from src.tools import die
+from src.net_tools import Prefix_Set
+from src.sni_tools import Domain_Trie, filter_file
+
 CONF_DIR = prj_path / 'data/config'
 CONF_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -17,12 +23,32 @@ CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 ArgHelp = Namespace(
     file='path to json file containing domain names and addresses dicts',
-    addresses='filter expression for host and/or network addresses',
-    domains='filter expression for domain names',
+    addresses=('comma or space separated host and/or network addresses,'
+               ' `@path` reads them from a file (one per line, `#` comments)'),
+    domains=('comma or space separated domain names: `example.com` matches it'
+             ' and its subdomains, `*.example.com` only subdomains, a `*` label'
+             ' elsewhere any one label; `@path` reads them from a file'),
     indent='set json indentation'
 )
 
 
+def parse_patterns(expression: Optional[str]) -> Optional[list[str]]:
+    if expression is None:
+        return None
+    patterns = []
+    for item in re.split(r'[,\s]+', expression):
+        if item.startswith('@'):
+            try:
+                with open(item[1:], encoding='utf-8') as file:
+                    for line in file:
+                        patterns.extend(re.split(r'[,\s]+', line.split('#', 1)[0]))
+            except OSError as e:
+                die(1, f"Error: {e}")
+        else:
+            patterns.append(item)
+    return [pattern for pattern in patterns if pattern]
+
+
 def parse_arguments() -> Namespace:
     parser = ArgumentParser()
     parser.add_argument('file', help=ArgHelp.file)
@@ -33,9 +59,28 @@ def parse_arguments() -> Namespace:
     return parser.parse_args()
 
 
-def main() -> None:
+def main() -> NoReturn:
     args = parse_arguments()
-    print(dumps(args.__dict__))
+
+    if not Path(args.file).exists():
+        die(1, f"Error: The file {args.file} does not exist.")
+
+    addresses, domains = parse_patterns(args.addresses), parse_patterns(args.domains)
+    try:
+        address_set = None if addresses is None else Prefix_Set(
+            ip_network(address, strict=False) for address in addresses)
+        domain_trie = None if domains is None else Domain_Trie(domains)
+    except ValueError as e:
+        die(2, f"Error: {e}")
+
+    try:
+        filter_file(args.file, sys.stdout, address_set, domain_trie, args.indent)
+    except ValueError as e:
+        die(2, f"Error: {e}")
+    except Exception as e:
+        die(3, e)
+
+    die(0)
 
 
 if __name__ == '__main__':
@@ -11,12 +11,11 @@ from dataclasses import dataclass, field, asdict
 from ipaddress import (
     IPv4Address, IPv4Interface, IPv4Network,
     IPv6Address, IPv6Interface, IPv6Network,
-    ip_address, ip_interface, ip_network,
-    collapse_addresses
+    ip_address, ip_interface, ip_network
 )
 
 from src.tools import die, obj_to_stringified_dict
-from src.net_tools import IPv4_Internet, IPv6_Internet, is_string_a_valid_ip_address, is_string_a_valid_ip_network
+from src.net_tools import IPv4_Internet, IPv6_Internet, Prefix_Set, is_string_a_valid_ip_address, is_string_a_valid_ip_network
 
 #TODO: for this (and other constants for paths to binary executables)
 # implement an algorithm to find a realpath to binary to make this project portable
@@ -198,7 +197,7 @@ class VPN(VPN_Processor):
 
         if   not self.routes and self.proxify:     self.routes = [IPv4_Internet]
         elif not self.routes and not self.proxify: self.routes = [self.virtual_network]
-        elif self.routes: self.routes = list(collapse_addresses(self.routes + [self.virtual_network]))
+        elif self.routes: self.routes = Prefix_Set(self.routes + [self.virtual_network]).collapse()
 
         for route in self.routes:
             if route not in (IPv4_Internet, IPv6_Internet) \
@@ -8,6 +8,8 @@ prj_path = Path(__file__).resolve().parents[1]
 sys.path.append(str(prj_path))
 
 from src.tools import die
+from src.Wireshark.common import BACKENDS
+from src.Wireshark.Tshark.Cache import Statistics_Cache
 
 
 CONF_DIR = prj_path / 'data/config'
@@ -22,7 +24,14 @@ ArgHelp = Namespace(
     test="test to run (conversion, gathering)",
     json="return stats as json (default)",
     csv="return stats as csv",
-    table="return stats as a pretty table"
+    table="return stats as a pretty table",
+    backend=("`tshark` runs tshark, `python` reads the capture in-process"
+             " (ethernet, ip, ipv6, tcp, udp and sctp statistics only),"
+             " `auto` (default) uses tshark if it is installed"),
+    no_cache=(f"do not use the cache of statistics in {CACHE_DIR / 'statistics'},"
+              " which are reused until the capture changes"),
+    verify=("check the sha256 of the capture on every cache hit,"
+            " not only when its modification time changed")
     # filter = "filter expression for packet capture file processing (wireshark `display` syntax)"
 )
 
@@ -38,6 +47,12 @@ def parse_arguments() -> Namespace:
                         action='store_true', help=ArgHelp.table)
     parser.add_argument('-t', '--test',
                         type=str, help=ArgHelp.test)
+    parser.add_argument('-b', '--backend', choices=BACKENDS,
+                        default='auto', help=ArgHelp.backend)
+    parser.add_argument('-n', '--no-cache',
+                        action='store_true', help=ArgHelp.no_cache)
+    parser.add_argument('-V', '--verify',
+                        action='store_true', help=ArgHelp.verify)
     #TODO: implement corresponding selectors:
     # parser.add_argument('-f', '--filter', type=str, help=ArgHelp.filter)
     return parser.parse_args()
@@ -74,7 +89,9 @@ def main():
     args = parse_arguments()
     pcap = Path(args.pcap)
     if pcap.exists() and pcap.is_file():
-        result = gather_all_pcap_data_as_json(pcap)
+        cache = None if args.no_cache else \
+            Statistics_Cache(CACHE_DIR / 'statistics', verify=args.verify)
+        result = gather_all_pcap_data_as_json(pcap, backend=args.backend, cache=cache)
         die(0, result)
     elif not pcap.exists():
         die(1, f"File {pcap} does not exist")
@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import tempfile
 from pathlib import Path
+from typing import NoReturn
 from argparse import ArgumentParser, Namespace
-from json import dumps
 
 
 prj_path = Path(__file__).resolve().parents[1]
 sys.path.append(str(prj_path))
 
+from src.tools import die
+from src.sni_tools import ADDRESS_TO_SERVER_NAMES, SERVER_NAME_TO_ADDRESSES, merge_files
+
 CONF_DIR = prj_path / 'data/config'
 CONF_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -16,19 +21,66 @@ CACHE_DIR = prj_path / 'data/cache'
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def parse_arguments() -> Namespace:
-    parser = ArgumentParser()
-    parser.add_argument('jsons',
-                        type=str, help='paths to json files to be merged')
-    parser.add_argument('-o', '--outfile',
-                        type=str, help='a path to new merged json file')
+Arg_help = Namespace(
+    jsons='Paths to json files (or directories of them) made by extract-sni-from-pcap.py.',
+    outfile='A path to new merged json file (default: stdout).',
+    ntoa='Merge only server names and their addresses.',
+    aton='Merge only addresses and their server names.',
+    indent='Set indentation value for resulting json.'
+)
+
 
+def parse_arguments() -> Namespace:
+    parser = ArgumentParser(description='Merge SNI json files keeping memory use bounded.')
+    parser.add_argument('jsons', type=str, nargs='+', help=Arg_help.jsons)
+    parser.add_argument('-o', '--outfile', type=str, help=Arg_help.outfile)
+    parser.add_argument('-N', '--ntoa', action='store_true', help=Arg_help.ntoa)
+    parser.add_argument('-A', '--aton', action='store_true', help=Arg_help.aton)
+    parser.add_argument('-i', '--indent', type=int, help=Arg_help.indent)
     return parser.parse_args()
 
 
-def main() -> None:
+def expand_json_paths(paths: list[str]) -> list[Path]:
+    json_paths = []
+    for path in map(Path, paths):
+        if not path.exists():
+            die(1, f"Error: The file {path} does not exist.")
+        if path.is_dir():
+            json_paths.extend(sorted(path.glob('*.json')))
+        else:
+            json_paths.append(path)
+    return json_paths
+
+
+def main() -> NoReturn:
     args = parse_arguments()
-    print(dumps(args.__dict__, indent=4))
+
+    json_paths = expand_json_paths(args.jsons)
+    sections = [section for section, requested in (
+        (ADDRESS_TO_SERVER_NAMES, args.aton), (SERVER_NAME_TO_ADDRESSES, args.ntoa)
+    ) if requested or not (args.aton or args.ntoa)]
+
+    try:
+        if args.outfile is None:
+            merge_files(json_paths, sys.stdout, sections, args.indent)
+        else:
+            # The output file may be one of the inputs.
+            outfile = Path(args.outfile)
+            with tempfile.NamedTemporaryFile(
+                    'w', encoding='utf-8', dir=outfile.parent or '.',
+                    prefix=f".{outfile.name}.", delete=False) as file:
+                try:
+                    merge_files(json_paths, file, sections, args.indent)
+                except BaseException:
+                    os.remove(file.name)
+                    raise
+            os.replace(file.name, outfile)
+    except ValueError as e:
+        die(2, f"Error: {e}")
+    except Exception as e:
+        die(3, e)
+
+    die(0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from pathlib import Path
+from typing import NoReturn
+from json import dump
+from argparse import ArgumentParser, Namespace
+
+prj_path = Path(__file__).resolve().parents[1]
+sys.path.append(str(prj_path))
+
+from src.tools import die
+from src.Wireshark.Pcap.Index import Sni_Index
+from src.Wireshark.Tshark.functions import PCAP_FILE_SUFFIXES
+
+CONF_DIR = prj_path / 'data/config'
+CONF_DIR.mkdir(parents=True, exist_ok=True)
+
+CACHE_DIR = prj_path / 'data/cache'
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+
+Arg_help = Namespace(
+    captures=('Packet capture files or directories of them to add to the index.'
+              ' Captures which are already indexed are skipped.'),
+    database='Path to the index database (default: data/cache/sni_index.sqlite3).',
+    jobs='Number of parallel processes (default: one per CPU core when given without a value).',
+    ntoa='Returns a json of server names and their addresses.',
+    aton='Returns a json of addresses and their server names.',
+    server_name='Only server names matching a glob pattern, e.g. `*.example.com`.',
+    address='Only addresses of an address or a network.',
+    records='Returns a json list of server name and address pairs with the time they were first and last seen.',
+    list_captures='Returns a json list of indexed captures.',
+    prune='Forget captures whose files do not exist anymore.',
+    indent='Set indentation value for resulting json.'
+)
+
+
+def parse_arguments() -> Namespace:
+    parser = ArgumentParser(description='Keep a persistent index of server names seen in packet captures and query it.')
+    parser.add_argument('captures', type=str, nargs='*', help=Arg_help.captures)
+    parser.add_argument('-d', '--database', type=str, default=str(CACHE_DIR / 'sni_index.sqlite3'), help=Arg_help.database)
+    parser.add_argument('-j', '--jobs', type=int, nargs='?', const=0, help=Arg_help.jobs)
+    parser.add_argument('-N', '--ntoa', action='store_true', help=Arg_help.ntoa)
+    parser.add_argument('-A', '--aton', action='store_true', help=Arg_help.aton)
+    parser.add_argument('-s', '--server-name', type=str, help=Arg_help.server_name)
+    parser.add_argument('-a', '--address', type=str, help=Arg_help.address)
+    parser.add_argument('-r', '--records', action='store_true', help=Arg_help.records)
+    parser.add_argument('-l', '--list-captures', action='store_true', help=Arg_help.list_captures)
+    parser.add_argument('-p', '--prune', action='store_true', help=Arg_help.prune)
+    parser.add_argument('-i', '--indent', type=int, help=Arg_help.indent)
+    return parser.parse_args()
+
+
+def expand_capture_paths(paths: list[str]) -> list[Path]:
+    capture_paths = []
+    for path in map(Path, paths):
+        if not path.exists():
+            die(1, f"Error: The file {path} does not exist.")
+        if path.is_dir():
+            capture_paths.extend(sorted(
+                p for p in path.iterdir()
+                if p.is_file() and p.suffix.lower() in PCAP_FILE_SUFFIXES))
+        else:
+            capture_paths.append(path)
+    return capture_paths
+
+
+def main() -> NoReturn:
+    args = parse_arguments()
+
+    if args.jobs is not None and args.jobs < 0:
+        die(2, "Error: The number of jobs must be positive.")
+    capture_paths = expand_capture_paths(args.captures)
+
+    with Sni_Index(args.database) as index:
+        if args.prune:
+            print(f"Forgot {index.remove_missing_captures()} missing captures.", file=sys.stderr)
+        if capture_paths:
+            try:
+                indexed, skipped = index.add_captures(
+                    capture_paths,
+                    workers=None if args.jobs is None else (args.jobs or os.cpu_count()))
+            except ValueError as e:
+                die(2, f"Error: {e}")
+            print(f"Indexed {len(indexed)} captures, skipped {len(skipped)} already indexed.",
+                  file=sys.stderr)
+            if not (args.ntoa or args.aton or args.records or args.list_captures
+                    or args.server_name or args.address):
+                die(0)
+
+        try:
+            if args.list_captures:
+                result = index.captures()
+            elif args.records:
+                result = index.records(args.server_name, args.address)
+            else:
+                result = index.get_sni_dict(
+                    get_server_name_to_addresses=args.ntoa,
+                    get_address_to_server_names=args.aton,
+                    server_name=args.server_name,
+                    address=args.address)
+        except ValueError as e:
+            die(2, f"Error: {e}")
+
+    try:
+        dump(
+            result,
+            fp=sys.stdout,
+            ensure_ascii=False,
+            indent=args.indent
+        )
+    except Exception as e:
+        die(3, e)
+
+    die(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,7 @@ import subprocess
 from argparse import ArgumentParser, Namespace
 from typing import NoReturn, Optional
 
-from src.net_tools import construct_capture_filter_for_endpoint
+from src.filter_cache import Filter_Cache
 from src.Wireshark.common import TSHARK_BINARY
 
 endpoints_list_path = prj_path / CONF_DIR / 'default_endpoints_filter.en0.csv'
@@ -52,17 +52,13 @@ def spawn_tshark(
 def construct_capture_filter(
         endpoints_list_path: Path = endpoints_list_path
 ) -> str:
-    if endpoints_list_path.exists():
-        endpoints_list = []
-        with open(endpoints_list_path, 'r') as file:
-            for line in file.read().strip().splitlines():
-                endpoints_list.append(line.split(','))
-    endpoint_expressions = []
-    #TODO: reduce resulting filter expression by combining same values of endpoints
-    # goto `construct_capture_filter_for_endpoint` definition
-    for enpoint_args in endpoints_list:
-        endpoint_expressions.append(construct_capture_filter_for_endpoint(*enpoint_args))
-    return ' and '.join(e for e in endpoint_expressions)
+    # Endpoints sharing protocol and ports are combined, see `construct_optimized_filters`.
+    # The result is cached by csv content, see `Filter_Cache`.
+    with open(endpoints_list_path, 'r', encoding='utf-8') as file:
+        csv_content = file.read()
+    return Filter_Cache(CACHE_DIR / 'filters').filters(
+        [csv_content], capture=True, display=False,
+        goal='exclude', optimize=True)
 
 def main() -> NoReturn:
     args = parse_arguments()
@@ -20,7 +20,7 @@ SUPPORTED_FAMILIES = ('inet', 'inet6', 'unix', 'vsock')
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[2]))
-from tools import cast_value, die, obj_to_stringified_dict
+from tools import die, obj_to_stringified_dict, row_converter
 
 class TCP_Connection: ...
 class UDP_Connection: ...
@@ -53,11 +53,7 @@ class Inet_Connection_Processor:
         # remove already processed items from initial list
         for _ in range(pop_count): cl.pop(0)
         cv.extend(cl); del cl
-        for i, (type, value) in enumerate(zip(
-                init_class.__annotations__.values(), cv
-        )):
-            cv[i] = cast_value(value, type)
-        return init_class(*cv)
+        return init_class(*_convert_connection_values(cv))
 
     @property
     def lsock(self) -> str: return f"{str(self.laddr)}:{str(self.lport)}"
@@ -100,6 +96,8 @@ class Base_Connection(Inet_Connection_Processor):
 class TCP_Connection(Base_Connection): __annotations__ = Base_Connection.__annotations__
 class UDP_Connection(Base_Connection): __annotations__ = Base_Connection.__annotations__
 
+_convert_connection_values = row_converter(Base_Connection.__annotations__.values())
+
 @dataclass
 class Netstat_Inet_Report:
     timestamp: float
@@ -1,11 +1,32 @@
 import csv
 import json
 import subprocess
+from pathlib import Path
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Any, Dict
 
 from ..common import CAPINFOS_BINARY
+from ..Pcap.Classes import Pcap_Reader, Capture_Metadata
+
+# Backends of `Pcapinfo.from_pcap_file`: `capinfos` runs the binary above,
+# `python` reads record headers in-process (pcap and pcapng only),
+# `auto` reads in-process and runs capinfos for other formats.
+CAPINFOS_BACKENDS = ('auto', 'capinfos', 'python')
+
+# Names capinfos reports for what `Pcap_Reader.metadata` reads.
+_FILE_TYPE_NAMES = {
+    ('pcap', False): 'Wireshark/tcpdump/... - pcap',
+    ('pcap', True): 'Wireshark/tcpdump/... - nanosecond pcap',
+    ('pcapng', False): 'Wireshark/... - pcapng',
+    ('pcapng', True): 'Wireshark/... - pcapng',
+}
+_ENCAPSULATION_NAMES = {
+    0: 'NULL/Loopback', 1: 'Ethernet', 101: 'Raw IP', 105: 'IEEE 802.11 Wireless LAN',
+    108: 'OpenBSD loopback', 113: 'Linux cooked-mode capture v1',
+    127: 'IEEE 802.11 plus radiotap radio header', 228: 'Raw IPv4', 229: 'Raw IPv6',
+    276: 'Linux cooked-mode capture v2'
+}
 
 class _Capinfos_field_types:
     int_keys = {'Number of packets', 'File size (bytes)', 'Data size (bytes)'}
@@ -85,11 +106,61 @@ class Pcapinfo:
     capture_comment: str = None
 
     @classmethod
-    def from_pcap_file(cls, pcap_file_path):
+    def from_pcap_file(cls, pcap_file_path, backend: str = 'auto', checksums: bool = True):
+        '''See `CAPINFOS_BACKENDS`, `checksums` are computed in-process only
+        if asked for (capinfos always computes them).'''
+        if backend not in CAPINFOS_BACKENDS:
+            raise ValueError(f"Backend must be one of: {', '.join(CAPINFOS_BACKENDS)}")
+        if backend != 'capinfos':
+            try:
+                with Pcap_Reader(pcap_file_path) as reader:
+                    metadata = reader.metadata(('sha256', 'sha1') if checksums else ())
+                return cls.from_capture_metadata(pcap_file_path, metadata)
+            except ValueError:
+                if backend == 'python':
+                    raise
         capinfos_csv = Capinfos_processor.get_all_capinfos(pcap_file_path)
         pcap_stats = Capinfos_processor.parse_capinfos_csv_to_dict(capinfos_csv).values()
         return cls(*pcap_stats)
 
+    @classmethod
+    def from_capture_metadata(cls, pcap_file_path, metadata: Capture_Metadata):
+        '''Values capinfos would report, derived from `Pcap_Reader.metadata`.'''
+        packets, data_size = metadata.packets, metadata.data_size
+        duration = metadata.end - metadata.start if metadata.start is not None else 0.0
+        if len(metadata.linktypes) == 1:
+            linktype, = metadata.linktypes
+            encapsulation = _ENCAPSULATION_NAMES.get(linktype, f"Unknown ({linktype})")
+        else:
+            encapsulation = 'Per packet' if metadata.linktypes else 'Unknown'
+        truncated = metadata.truncated or (None, None)
+        return cls(
+            file_name=str(pcap_file_path),
+            file_type=_FILE_TYPE_NAMES[metadata.format, metadata.nanoseconds],
+            file_encapsulation=encapsulation,
+            file_time_precision='nanoseconds (9)' if metadata.nanoseconds else 'microseconds (6)',
+            packet_size_limit=None if metadata.snaplen is None else str(metadata.snaplen),
+            packet_size_limit_min__inferred=None if truncated[0] is None else str(truncated[0]),
+            packet_size_limit_max__inferred=None if truncated[1] is None else str(truncated[1]),
+            number_of_packets=packets,
+            file_size__in_bytes=Path(pcap_file_path).stat().st_size,
+            data_size__in_bytes=data_size,
+            capture_duration__in_seconds=duration,
+            start_time=None if metadata.start is None else datetime.fromtimestamp(metadata.start),
+            end_time=None if metadata.end is None else datetime.fromtimestamp(metadata.end),
+            data_byte_rate__in_bytes_per_sec=data_size / duration if duration else None,
+            data_bit_rate__in_bits_per_sec=data_size * 8 / duration if duration else None,
+            average_packet_size__in_bytes=data_size / packets if packets else None,
+            average_packet_rate__in_packets_per_sec=packets / duration if duration else None,
+            sha256=metadata.checksums.get('sha256'),
+            sha1=metadata.checksums.get('sha1'),
+            strict_time_order=str(metadata.ordered),
+            capture_hardware=metadata.section.get('hardware'),
+            capture_opersys=metadata.section.get('os'),
+            capture_application=metadata.section.get('application'),
+            capture_comment=metadata.section.get('comment')
+        )
+
     @classmethod
     def from_csv(cls, csv_obj):
         data = Capinfos_processor.parse_capinfos_csv_to_dict(csv_obj).values()
@@ -1,20 +1,41 @@
 import subprocess
+import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
-from typing import Any, Dict, List, Set, Tuple, Optional, Union
+from typing import Any, Dict, Iterator, List, Set, Tuple, Optional, Union
 from datetime import datetime
-from ipaddress import ip_address
 
-from .common import TSHARK_BINARY, PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS
-from .Tshark.Classes import Endpoint_Report, Conversation_Report
+from .common import TSHARK_BINARY, PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS, resolve_backend
+from .Pcap import functions as pcap_functions
+from .Pcap.Tls import extract_server_names, extract_server_names_parallel
+from .Tshark.Classes import Report_Processor, Endpoint_Report, Conversation_Report
+from .Tshark.Columns import Report_Columns, iterate_report_columns
 from ..tools import get_file_size
 from src.tools import die
+from src.net_tools import Prefix_Set
+from src.sni_tools import address_key, server_name_key
+
+# Server names of connections to these are not collected.
+PRIVATE_NETWORKS = Prefix_Set(
+    ['127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16'])
 
 
 class Tshark:
 
     @staticmethod
-    def get_timestamp_of_first_frame_in_pcap_file(pcap_file_path) -> datetime:
+    def get_timestamp_of_first_frame_in_pcap_file(
+            pcap_file_path, backend: str = 'auto') -> datetime:
+
+        # Reading one record header in-process is much cheaper than running
+        # tshark, which is left for formats the reader does not know.
+        if resolve_backend(backend) == 'python':
+            return pcap_functions.get_timestamp_of_first_frame(pcap_file_path)
+        if backend == 'auto':
+            try:
+                return pcap_functions.get_timestamp_of_first_frame(pcap_file_path)
+            except ValueError:
+                pass
 
         command = [
             TSHARK_BINARY, "-n", "-r", pcap_file_path, "-c", "1",
@@ -28,29 +49,19 @@ class Tshark:
         return timestamp
 
     @staticmethod
-    def return_pcap_dict(pcap_file_path) -> Dict[str, Any]:
+    def return_pcap_dict(pcap_file_path, backend: str = 'auto') -> Dict[str, Any]:
         pcap_dict = {
             'path': pcap_file_path,
             'size': get_file_size(pcap_file_path),
-            'timestamp': Tshark.get_timestamp_of_first_frame_in_pcap_file(pcap_file_path),
+            'timestamp': Tshark.get_timestamp_of_first_frame_in_pcap_file(
+                pcap_file_path, backend),
         }
         return pcap_dict
 
     @staticmethod
-    def get_ipaddr_tls_server_name_pairs(
-            pcap_file_path_str,
-            filter: Optional[str] = None,
-            get_address_to_server_names: bool = False,
-            get_server_name_to_addresses: bool = False
-    ):
-    # ) -> dict[str, Union[dict[str, list[str]], Any]]:
-
-        # If none of these options are set--get both dictionaries.
-        if get_address_to_server_names is False and \
-           get_server_name_to_addresses is False:
-            get_address_to_server_names = True
-            get_server_name_to_addresses = True
-
+    def _tshark_server_name_pairs(
+            pcap_file_path_str, filter: Optional[str] = None
+    ) -> Set[Tuple[str, str]]:
         server_name_field = 'tls.handshake.extensions_server_name'
         private_addresses = 'not ip.dst in {127.0.0.0/8, 10.0.0.0/8, 172.16.0.0/12, 192.168.0.0/16}'
 
@@ -60,7 +71,7 @@ class Tshark:
             display_filter = f"{private_addresses} and {server_name_field} and {filter}"
 
         command = [
-            TSHARK_BINARY, "-n", "-r", pcap_file_path_str,
+            TSHARK_BINARY, "-n", "-r", str(pcap_file_path_str),
             "-Y", display_filter,
             "-T", "fields", "-E", "separator=,",
             "-e", "ip.dst", "-e", server_name_field
@@ -77,11 +88,63 @@ class Tshark:
         except Exception as e:
             raise e
 
-        pairs = set(
+        return set(
             p for p in [tuple(p.split(',')) for p in pairs
                         if len(p.split(',')) == 2]
         )
 
+    @staticmethod
+    def get_ipaddr_tls_server_name_pairs(
+            pcap_file_path_str,
+            filter: Optional[str] = None,
+            get_address_to_server_names: bool = False,
+            get_server_name_to_addresses: bool = False,
+            backend: str = 'auto',
+            workers: Optional[int] = None
+    ):
+    # ) -> dict[str, Union[dict[str, list[str]], Any]]:
+        '''`pcap_file_path_str` may be a list of captures (e.g. ring buffer
+        files). With `workers` they are processed in parallel: the python
+        backend splits them into chunks, the tshark one runs a process per file.'''
+
+        # If none of these options are set--get both dictionaries.
+        if get_address_to_server_names is False and \
+           get_server_name_to_addresses is False:
+            get_address_to_server_names = True
+            get_server_name_to_addresses = True
+
+        if isinstance(pcap_file_path_str, (list, tuple)):
+            pcap_file_paths = list(pcap_file_path_str)
+        else:
+            pcap_file_paths = [pcap_file_path_str]
+
+        if resolve_backend(backend) == 'python':
+            if filter is not None:
+                raise ValueError("Display filters are supported only by the tshark backend.")
+            if workers is None and len(pcap_file_paths) == 1:
+                server_names = extract_server_names(pcap_file_paths[0])
+            else:
+                server_names = extract_server_names_parallel(pcap_file_paths, workers)
+            pairs = set(
+                (str(address), server_name) for address, server_name
+                in server_names if address not in PRIVATE_NETWORKS)
+        else:
+            with ThreadPoolExecutor(workers or 1) as executor:
+                pairs = set().union(*executor.map(
+                    lambda path: Tshark._tshark_server_name_pairs(path, filter),
+                    pcap_file_paths))
+
+        return Tshark.server_name_dicts(
+            pairs, get_address_to_server_names, get_server_name_to_addresses)
+
+    @staticmethod
+    def server_name_dicts(
+            pairs,
+            get_address_to_server_names: bool = True,
+            get_server_name_to_addresses: bool = True
+    ) -> Dict[str, Dict[str, List[str]]]:
+        '''Sorted `address_to_server_names` and/or `server_name_to_addresses`
+        dictionaries of `(address, server name)` string pairs.'''
         if get_address_to_server_names:
             address_to_server_names = defaultdict(list)
         if get_server_name_to_addresses:
@@ -95,24 +158,22 @@ class Tshark:
 
         if get_address_to_server_names:
             for address in address_to_server_names:
-                address_to_server_names[address].sort(
-                    key=lambda k: k[0].split('.')[::-1])
+                address_to_server_names[address].sort(key=server_name_key)
 
             sorted_address_to_server_names = dict(
                 sorted(
                     address_to_server_names.items(),
-                    key=lambda item: ip_address(item[0])
+                    key=lambda item: address_key(item[0])
                 ))
 
         if get_server_name_to_addresses:
             for server_name in server_name_to_addresses:
-                server_name_to_addresses[server_name].sort(
-                    key=lambda ip: ip_address(ip))
+                server_name_to_addresses[server_name].sort(key=address_key)
 
             sorted_server_name_to_addresses = dict(
                 sorted(
                     server_name_to_addresses.items(),
-                    key=lambda k: k[0].split('.')[::-1]
+                    key=lambda item: server_name_key(item[0])
             ))
 
         if get_address_to_server_names and get_server_name_to_addresses:
@@ -130,12 +191,12 @@ class Tshark:
             }
 
     @staticmethod
-    def get_endpoints_statistics_strings(
+    def get_endpoints_statistics_command(
             pcap_file_path,
             proto: Union[str, List[str], Set[str], Tuple[str]]
             = PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
             display_filter: Optional[str] = None
-    ) -> Optional[List[str]]:
+    ) -> str:
 
         def _parse_proto_arg(proto):
 
@@ -181,11 +242,48 @@ class Tshark:
         conversations_expression = create_expression("conv",
                                                      protos, display_filter)
 
-        command = (
+        return (
             f"{TSHARK_BINARY} -n -r {pcap_file_path} -q"
             f" {endpoints_expression}"
             f" {conversations_expression}"
         )
+
+    @staticmethod
+    def iterate_statistics_reports(
+            pcap_file_path,
+            proto: Union[str, List[str], Set[str], Tuple[str]]
+            = PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
+            display_filter: Optional[str] = None,
+            columnar: bool = False
+    ) -> Iterator[Union[Endpoint_Report, Conversation_Report, Report_Columns]]:
+        '''Run all the taps in one tshark process and parse its output
+        while it is read, yielding the reports which have entries
+        (as `Report_Columns` with `columnar`).'''
+        parse = iterate_report_columns if columnar else Report_Processor.iterate_reports
+        command = Tshark.get_endpoints_statistics_command(
+            pcap_file_path, proto, display_filter)
+        # stderr goes to a file, so a chatty tshark can not block on it
+        # while its stdout is being read.
+        with tempfile.TemporaryFile('w+') as stderr, subprocess.Popen(
+                command, shell=True, text=True,
+                stdout=subprocess.PIPE, stderr=stderr) as process:
+            for report in parse(process.stdout):
+                if (len(report) if columnar else len(report.entries)) > 0:
+                    yield report
+            if process.wait() != 0:
+                stderr.seek(0)
+                print(stderr.read())
+
+    @staticmethod
+    def get_endpoints_statistics_strings(
+            pcap_file_path,
+            proto: Union[str, List[str], Set[str], Tuple[str]]
+            = PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
+            display_filter: Optional[str] = None
+    ) -> Optional[List[str]]:
+
+        command = Tshark.get_endpoints_statistics_command(
+            pcap_file_path, proto, display_filter)
         dump_stats = subprocess.run(command, shell=True, text=True, capture_output=True)
 
         if dump_stats.returncode != 0:
@@ -200,16 +298,9 @@ class Tshark:
     @staticmethod
     def parse_conversations_reports(conversation_reports) -> list:
         parsed_reports = []
-        report_classes = [
-            (Conversation_Report, 'conversations', 'address_A'),
-            (Endpoint_Report, 'endpoints', 'address')
-        ]
         for report in conversation_reports:
-            # for ReportClass, entry_key, sort_key in report_classes:
-            for ReportClass, _, _ in report_classes:
-                parsed_report = ReportClass.parse_report_page(report)
-                if parsed_report and len(parsed_report.entries) > 0:
-                    #TODO: fix sorting for IPv4 and IPv6 addresses
-                    # getattr(parsed_report, entry_key).sort(key=lambda r: getattr(r, sort_key))
+            # Pages are dispatched to their classes by the header line.
+            for parsed_report in Report_Processor.iterate_reports(report.splitlines()):
+                if len(parsed_report.entries) > 0:
                     parsed_reports.append(parsed_report)
         return parsed_reports
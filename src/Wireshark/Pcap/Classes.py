@@ -0,0 +1,511 @@
+import mmap
+import struct
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Literal, NamedTuple, Optional, Union
+
+# Link-layer header types, see https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPES_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_SCTP = 132
+# IPv6 extension headers which are skipped to get to the transport header.
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_OBSOLETE_PACKET = 0x00000002
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_PACKET_BLOCKS = (PCAPNG_ENHANCED_PACKET, PCAPNG_OBSOLETE_PACKET, PCAPNG_SIMPLE_PACKET)
+# Section header block options
+PCAPNG_SECTION_OPTIONS = {1: 'comment', 2: 'hardware', 3: 'os', 4: 'application'}
+
+# Checksums of `Pcap_Reader.metadata` are updated every this many bytes.
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+class Frame(NamedTuple):
+    '''A captured record. `data` is a view into the mapped file,
+    valid only while the reader is open; copy it with `bytes()` to keep it.'''
+    timestamp: Optional[float]
+    linktype: int
+    data: memoryview
+    length: int
+
+
+class Packet(NamedTuple):
+    '''Decoded headers of a frame. Addresses are packed bytes,
+    `ports` and `protocol` are `None` when not available
+    (e.g. non-first IP fragments), `sequence` is set for TCP only.'''
+    timestamp: Optional[float]
+    length: int
+    src_mac: Optional[bytes]
+    dst_mac: Optional[bytes]
+    version: int
+    src: bytes
+    dst: bytes
+    protocol: Optional[int]
+    sport: Optional[int]
+    dport: Optional[int]
+    payload: memoryview
+    sequence: Optional[int] = None
+
+
+class Capture_Metadata(NamedTuple):
+    '''Summary of a capture from its file and record headers. Timestamps
+    are the earliest and the latest ones, `ordered` tells if they never
+    decrease. `truncated` is the range of captured lengths of records
+    shorter than the packets, `section` has the options of the (first)
+    pcapng section header: `hardware`, `os`, `application`, `comment`.'''
+    format: str
+    nanoseconds: bool
+    linktypes: tuple[int, ...]
+    snaplen: Optional[int]
+    packets: int
+    data_size: int
+    start: Optional[float]
+    end: Optional[float]
+    ordered: bool
+    truncated: Optional[tuple[int, int]]
+    section: Dict[str, str]
+    checksums: Dict[str, str]
+
+
+class Pcap_Reader:
+    '''Streaming reader of pcap and pcapng files.
+
+    The file is memory-mapped and records are yielded as views into it,
+    so nothing is copied until headers are decoded:
+
+        with Pcap_Reader(path) as reader:
+            for packet in reader.packets():
+                ...
+    '''
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped.
+            self._file.close()
+            raise ValueError(f"File {self.path} is empty")
+        self._view = memoryview(self._mmap)
+        if len(self._view) < 4:
+            self.close()
+            raise ValueError(f"File {self.path} is not a packet capture file")
+        magic = self._view[:4].tobytes()
+        if int.from_bytes(magic, 'little') == PCAPNG_SECTION_HEADER:
+            self.format = 'pcapng'
+        elif PCAP_MAGIC_MICROSECONDS in (int.from_bytes(magic, 'little'),
+                                         int.from_bytes(magic, 'big')) \
+          or PCAP_MAGIC_NANOSECONDS in (int.from_bytes(magic, 'little'),
+                                        int.from_bytes(magic, 'big')):
+            self.format = 'pcap'
+        else:
+            self.close()
+            raise ValueError(f"File {self.path} is not a packet capture file")
+
+    def __enter__(self) -> 'Pcap_Reader':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._file.closed: return
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Frames kept by the caller still reference the mapping,
+            # it is unmapped once they are garbage collected.
+            pass
+        self._file.close()
+
+    def __iter__(self) -> Iterator[Frame]:
+        return self.frames()
+
+    def frames(self, from_chunk: Optional['Chunk'] = None) -> Iterator[Frame]:
+        '''Frames from the start of the file, or of a chunk (see `chunks`),
+        up to the end of the file.'''
+        if self.format == 'pcap':
+            return self._pcap_frames(from_chunk.start if from_chunk else 24)
+        if from_chunk:
+            byte_order, interfaces = from_chunk.context
+            return self._pcapng_frames(from_chunk.start, byte_order, list(interfaces))
+        return self._pcapng_frames()
+
+    def packets(self) -> Iterator[Packet]:
+        '''Frames with decoded headers; frames other than IPv4 and IPv6
+        (ARP, unsupported link types, truncated headers) are skipped.'''
+        for frame in self.frames():
+            packet = decode_frame(frame)
+            if packet is not None:
+                yield packet
+
+    def chunks(self, size: int) -> list['Chunk']:
+        '''Split the file into chunks of about `size` bytes at record
+        boundaries. Only record headers are read to find them.'''
+        chunks = []
+        if self.format == 'pcap':
+            byte_order, _, _ = self._pcap_header()
+            record_header = struct.Struct(byte_order + 'IIII')
+            view, offset, end = self._view, 24, len(self._view)
+            start, frames = offset, 0
+            while offset + 16 <= end:
+                if offset - start >= size:
+                    chunks.append(Chunk(start, frames, None))
+                    start, frames = offset, 0
+                offset += 16 + record_header.unpack_from(view, offset)[2]
+                frames += 1
+            chunks.append(Chunk(start, frames, None))
+            return chunks
+        start, frames, context = 0, 0, ('<', ())
+        for offset, block_type, _, byte_order, interfaces in self._pcapng_blocks():
+            if block_type not in PCAPNG_PACKET_BLOCKS:
+                continue
+            if offset - start >= size and frames:
+                chunks.append(Chunk(start, frames, context))
+                start, frames = offset, 0
+                context = (byte_order, tuple(interfaces))
+            frames += 1
+        chunks.append(Chunk(start, frames, context))
+        return chunks
+
+    def metadata(self, checksums: Iterable[str] = ()) -> Capture_Metadata:
+        '''Summary of the capture read from record headers only, no frame
+        is decoded. `checksums` are names of `hashlib` algorithms (e.g.
+        `sha256`) computed in the same pass over the file.'''
+        digests = {name: hashlib.new(name) for name in checksums}
+        view, hashed = self._view, 0
+        sections, interfaces = [], []
+        packets = data_size = 0
+        start = end = previous = None
+        ordered, truncated = True, None
+        for offset, timestamp, captured, length in self._record_headers(sections, interfaces):
+            packets += 1
+            data_size += length
+            if timestamp is not None:
+                if start is None or timestamp < start: start = timestamp
+                if end is None or timestamp > end: end = timestamp
+                if previous is not None and timestamp < previous: ordered = False
+                previous = timestamp
+            if captured < length:
+                truncated = (captured, captured) if truncated is None else \
+                    (min(truncated[0], captured), max(truncated[1], captured))
+            if digests and offset - hashed >= CHECKSUM_BLOCK_SIZE:
+                for digest in digests.values(): digest.update(view[hashed:offset])
+                hashed = offset
+        for digest in digests.values(): digest.update(view[hashed:])
+        if self.format == 'pcap':
+            byte_order, resolution, linktype = self._pcap_header()
+            nanoseconds, linktypes = resolution < 1e-6, (linktype,)
+            snaplen, = struct.unpack_from(byte_order + 'I', view, 16)
+        else:
+            nanoseconds = any(resolution < 1e-6 for _, resolution, _, _ in interfaces)
+            linktypes = tuple(dict.fromkeys(linktype for linktype, _, _, _ in interfaces))
+            snaplen = max((snaplen for _, _, _, snaplen in interfaces), default=0)
+        return Capture_Metadata(
+            self.format, nanoseconds, linktypes, snaplen or None, packets, data_size,
+            start, end, ordered, truncated, sections[0] if sections else {},
+            {name: digest.hexdigest() for name, digest in digests.items()})
+
+    def _record_headers(
+            self, sections: list, interfaces: list
+    ) -> Iterator[tuple[int, Optional[float], int, int]]:
+        '''`(end offset, timestamp, captured length, length)` of records.
+        Options of pcapng section headers and interfaces of all the sections
+        are appended to `sections` and `interfaces`.'''
+        view, end = self._view, len(self._view)
+        if self.format == 'pcap':
+            byte_order, resolution, _ = self._pcap_header()
+            record_header = struct.Struct(byte_order + 'IIII')
+            offset = 24
+            while offset + 16 <= end:
+                seconds, fraction, captured, length = record_header.unpack_from(view, offset)
+                offset += 16 + captured
+                if offset > end:
+                    break  # truncated last record
+                yield offset, seconds + fraction * resolution, captured, length
+            return
+        section_interfaces = None
+        for offset, block_type, block_length, byte_order, section_interfaces_ in \
+                self._pcapng_blocks():
+            if section_interfaces_ is not section_interfaces:
+                # a new section
+                section_interfaces = section_interfaces_
+                options = {}
+                for code, value in _pcapng_options(
+                        view, offset + 24, offset + block_length - 4, byte_order):
+                    name = PCAPNG_SECTION_OPTIONS.get(code)
+                    if name and name not in options:
+                        options[name] = value.decode('utf-8', 'replace')
+                sections.append(options)
+            body = offset + 8
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                interfaces.append(section_interfaces[-1])
+            elif block_type in (PCAPNG_ENHANCED_PACKET, PCAPNG_OBSOLETE_PACKET):
+                if block_type == PCAPNG_ENHANCED_PACKET:
+                    interface, high, low, captured, length = struct.unpack_from(
+                        byte_order + 'IIIII', view, body)
+                else:
+                    interface, _, high, low, captured, length = struct.unpack_from(
+                        byte_order + 'HHIIII', view, body)
+                if interface < len(section_interfaces):
+                    _, resolution, ts_offset, _ = section_interfaces[interface]
+                    yield (offset + block_length, ((high << 32) | low) * resolution + ts_offset,
+                           captured, length)
+            elif block_type == PCAPNG_SIMPLE_PACKET and section_interfaces:
+                _, _, _, snaplen = section_interfaces[0]
+                length, = struct.unpack_from(byte_order + 'I', view, body)
+                yield offset + block_length, None, min(length, snaplen or length), length
+
+    def _pcap_header(self) -> tuple[str, float, int]:
+        view = self._view
+        if len(view) < 24:
+            raise ValueError(f"File {self.path} has a truncated pcap header")
+        for byte_order in ('<', '>'):
+            magic, = struct.unpack_from(byte_order + 'I', view, 0)
+            if magic in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+                break
+        resolution = 1e-9 if magic == PCAP_MAGIC_NANOSECONDS else 1e-6
+        network, = struct.unpack_from(byte_order + 'I', view, 20)
+        return byte_order, resolution, network & 0x0fffffff
+
+    def _pcap_frames(self, offset: int = 24) -> Iterator[Frame]:
+        view = self._view
+        byte_order, resolution, linktype = self._pcap_header()
+        record_header = struct.Struct(byte_order + 'IIII')
+        end = len(view)
+        while offset + 16 <= end:
+            seconds, fraction, captured, length = record_header.unpack_from(view, offset)
+            offset += 16
+            if offset + captured > end:
+                break  # truncated last record
+            yield Frame(seconds + fraction * resolution, linktype,
+                        view[offset:offset + captured], length)
+            offset += captured
+
+    def _pcapng_blocks(
+            self, offset: int = 0, byte_order: str = '<',
+            interfaces: Optional[list] = None
+    ) -> Iterator[tuple[int, int, int, str, list]]:
+        '''`(offset, type, length, byte order, interfaces)` of blocks.
+        Interfaces are `(linktype, timestamp resolution, timestamp offset,
+        snaplen)` of the current section.'''
+        view = self._view
+        end = len(view)
+        interfaces = [] if interfaces is None else interfaces
+        while offset + 12 <= end:
+            block_type, = struct.unpack_from(byte_order + 'I', view, offset)
+            if block_type == PCAPNG_SECTION_HEADER:
+                magic = view[offset + 8:offset + 12].tobytes()
+                byte_order = '<' if int.from_bytes(magic, 'little') == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            block_length, = struct.unpack_from(byte_order + 'I', view, offset + 4)
+            if block_length < 12 or offset + block_length > end:
+                break  # truncated or corrupted block
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                body = offset + 8
+                linktype, _, snaplen = struct.unpack_from(byte_order + 'HHI', view, body)
+                resolution, ts_offset = 1e-6, 0
+                for code, value in _pcapng_options(
+                        view, body + 8, offset + block_length - 4, byte_order):
+                    if code == 9 and value:     # if_tsresol
+                        exponent = value[0] & 0x7f
+                        resolution = 2.0 ** -exponent if value[0] & 0x80 else 10.0 ** -exponent
+                    elif code == 14 and len(value) == 8:  # if_tsoffset
+                        ts_offset, = struct.unpack(byte_order + 'q', value)
+                interfaces.append((linktype, resolution, ts_offset, snaplen))
+            yield offset, block_type, block_length, byte_order, interfaces
+            offset += block_length
+
+    def _pcapng_frames(
+            self, offset: int = 0, byte_order: str = '<',
+            interfaces: Optional[list] = None
+    ) -> Iterator[Frame]:
+        view = self._view
+        for offset, block_type, block_length, byte_order, interfaces in \
+                self._pcapng_blocks(offset, byte_order, interfaces):
+            body = offset + 8
+            if block_type in (PCAPNG_ENHANCED_PACKET, PCAPNG_OBSOLETE_PACKET):
+                if block_type == PCAPNG_ENHANCED_PACKET:
+                    interface, high, low, captured, length = struct.unpack_from(
+                        byte_order + 'IIIII', view, body)
+                else:
+                    interface, _, high, low, captured, length = struct.unpack_from(
+                        byte_order + 'HHIIII', view, body)
+                if interface < len(interfaces):
+                    linktype, resolution, ts_offset, _ = interfaces[interface]
+                    data = body + 20
+                    captured = min(captured, offset + block_length - 4 - data)
+                    yield Frame(((high << 32) | low) * resolution + ts_offset,
+                                linktype, view[data:data + captured], length)
+            elif block_type == PCAPNG_SIMPLE_PACKET and interfaces:
+                linktype, _, _, snaplen = interfaces[0]
+                length, = struct.unpack_from(byte_order + 'I', view, body)
+                captured = min(length, snaplen or length, block_length - 16)
+                yield Frame(None, linktype, view[body + 4:body + 4 + captured], length)
+
+
+class Chunk(NamedTuple):
+    '''A part of a capture file to be processed separately: offset of
+    its first record, number of records and, for pcapng, the byte order
+    and interfaces of the section at that point.'''
+    start: int
+    frames: int
+    context: Optional[tuple[str, tuple]]
+
+
+def _pcapng_options(
+        view: memoryview, offset: int, end: int, byte_order: str
+) -> Iterator[tuple[int, bytes]]:
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(byte_order + 'HH', view, offset)
+        if code == 0: return  # opt_endofopt
+        yield code, view[offset + 4:offset + 4 + length].tobytes()
+        offset += 4 + (length + 3) // 4 * 4
+
+
+def decode_frame(frame: Frame) -> Optional[Packet]:
+    '''Decode link, network and transport headers of a frame.'''
+    data, linktype = frame.data, frame.linktype
+    src_mac = dst_mac = None
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14: return None
+        dst_mac, src_mac = data[0:6].tobytes(), data[6:12].tobytes()
+        ethertype = (data[12] << 8) | data[13]
+        offset = 14
+        while ethertype in ETHERTYPES_VLAN and len(data) >= offset + 4:
+            ethertype = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+        if ethertype == ETHERTYPE_IPV4:   version = 4
+        elif ethertype == ETHERTYPE_IPV6: version = 6
+        else: return None
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # 4 bytes of address family in host (NULL) or network (LOOP) order;
+        # values for IPv6 differ among BSDs, so look at the IP header instead.
+        offset = 4
+        if len(data) <= offset: return None
+        version = data[offset] >> 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        offset = 0
+        if not data: return None
+        version = data[0] >> 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16: return None
+        protocol_type = (data[14] << 8) | data[15]
+        offset = 16
+        if protocol_type == ETHERTYPE_IPV4:   version = 4
+        elif protocol_type == ETHERTYPE_IPV6: version = 6
+        else: return None
+    else:
+        return None
+
+    fragmented = False
+    # Link layer padding (e.g. of minimum size Ethernet frames) is not
+    # payload. Lengths of 0 are unknown: segmentation offload, jumbograms.
+    if version == 4:
+        if len(data) < offset + 20: return None
+        header_length = (data[offset] & 0x0f) * 4
+        if header_length < 20: return None
+        total_length = (data[offset + 2] << 8) | data[offset + 3]
+        if total_length:
+            data = data[:offset + max(total_length, header_length)]
+        protocol = data[offset + 9]
+        src, dst = data[offset + 12:offset + 16].tobytes(), data[offset + 16:offset + 20].tobytes()
+        fragmented = bool(((data[offset + 6] << 8) | data[offset + 7]) & 0x1fff)
+        offset += header_length
+    elif version == 6:
+        if len(data) < offset + 40: return None
+        payload_length = (data[offset + 4] << 8) | data[offset + 5]
+        if payload_length:
+            data = data[:offset + 40 + payload_length]
+        protocol = data[offset + 6]
+        src, dst = data[offset + 8:offset + 24].tobytes(), data[offset + 24:offset + 40].tobytes()
+        offset += 40
+        while protocol in IPV6_EXTENSION_HEADERS + (IPV6_FRAGMENT_HEADER,):
+            if len(data) < offset + 8: return None
+            if protocol == IPV6_FRAGMENT_HEADER:
+                fragmented = bool(((data[offset + 2] << 8) | data[offset + 3]) & 0xfff8)
+                protocol, offset = data[offset], offset + 8
+            else:
+                protocol, offset = data[offset], offset + (data[offset + 1] + 1) * 8
+    else:
+        return None
+
+    sport = dport = sequence = None
+    if not fragmented and protocol in (IPPROTO_TCP, IPPROTO_UDP, IPPROTO_SCTP) \
+       and len(data) >= offset + 4:
+        sport = (data[offset] << 8) | data[offset + 1]
+        dport = (data[offset + 2] << 8) | data[offset + 3]
+        if protocol == IPPROTO_TCP and len(data) >= offset + 13:
+            sequence = int.from_bytes(data[offset + 4:offset + 8], 'big')
+            offset += (data[offset + 12] >> 4) * 4
+        elif protocol == IPPROTO_UDP:
+            offset += 8
+        else:
+            offset += 12
+    return Packet(frame.timestamp, frame.length, src_mac, dst_mac, version,
+                  src, dst, protocol, sport, dport, data[offset:], sequence)
+
+
+class Pcap_Writer:
+    '''Minimal writer of pcap and pcapng files, e.g. to generate test captures.'''
+
+    def __init__(self, path: Union[str, Path], linktype: int = LINKTYPE_ETHERNET,
+                 snaplen: int = 262144, format: Literal['pcap', 'pcapng'] = 'pcap') -> None:
+        self.format = format
+        self._file = open(path, 'wb')
+        if format == 'pcap':
+            self._file.write(struct.pack('<IHHiIII', PCAP_MAGIC_MICROSECONDS,
+                                         2, 4, 0, 0, snaplen, linktype))
+        else:
+            self._write_block(PCAPNG_SECTION_HEADER, struct.pack(
+                '<IHHq', PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))
+            self._write_block(PCAPNG_INTERFACE_DESCRIPTION, struct.pack(
+                '<HHI', linktype, 0, snaplen))
+
+    def __enter__(self) -> 'Pcap_Writer':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _write_block(self, block_type: int, body: bytes) -> None:
+        body += bytes(-len(body) % 4)
+        length = struct.pack('<I', len(body) + 12)
+        self._file.write(struct.pack('<I', block_type) + length + body + length)
+
+    def write(self, data: bytes, timestamp: float, length: Optional[int] = None) -> None:
+        length = len(data) if length is None else length
+        microseconds = round(timestamp * 1e6)
+        if self.format == 'pcap':
+            self._file.write(struct.pack('<IIII', *divmod(microseconds, 1000000),
+                                         len(data), length))
+            self._file.write(data)
+        else:
+            self._write_block(PCAPNG_ENHANCED_PACKET, struct.pack(
+                '<IIIII', 0, microseconds >> 32, microseconds & 0xffffffff,
+                len(data), length) + data)
+
+    def close(self) -> None:
+        self._file.close()
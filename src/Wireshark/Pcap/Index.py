@@ -0,0 +1,192 @@
+'''Persistent SQLite index of TLS server names seen in packet captures.
+
+Every capture is indexed once: files are recognized by path, size and
+modification time first, and by the sha256 of their content if those
+changed (e.g. a capture was moved). For every capture the index keeps
+the server name and address pairs with the time they were first and
+last seen, so queries do not touch the captures again.
+'''
+
+import os
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+from ipaddress import ip_network
+
+from .Tls import extract_server_names_seen
+from ..Main import Tshark, PRIVATE_NETWORKS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    checksum TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS captures_by_path ON captures (path, size, mtime);
+CREATE TABLE IF NOT EXISTS server_names (
+    capture_id INTEGER NOT NULL REFERENCES captures (id) ON DELETE CASCADE,
+    server_name TEXT NOT NULL,
+    address TEXT NOT NULL,
+    -- packed address, so networks are ranges of one version
+    version INTEGER NOT NULL,
+    packed BLOB NOT NULL,
+    first_seen REAL,
+    last_seen REAL,
+    PRIMARY KEY (server_name, packed, capture_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS server_names_by_address
+    ON server_names (version, packed, server_name);
+'''
+
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def file_checksum(path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while block := file.read(CHECKSUM_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Sni_Index:
+
+    def __init__(self, database_path: Union[str, Path]) -> None:
+        self.database_path = Path(database_path)
+        self.database_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.database_path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> 'Sni_Index':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _is_known(self, path: Path, stat: os.stat_result) -> bool:
+        return self.connection.execute(
+            'SELECT 1 FROM captures WHERE path = ? AND size = ? AND mtime = ?',
+            (str(path), stat.st_size, stat.st_mtime)).fetchone() is not None
+
+    def add_captures(
+            self, pcap_file_paths: Iterable[Union[str, Path]],
+            workers: Optional[int] = None
+    ) -> tuple[List[Path], List[Path]]:
+        '''Index captures which are not indexed yet,
+        return the lists of indexed and skipped ones.'''
+        new, skipped, checksums = [], [], {}
+        for path in (Path(p).resolve() for p in pcap_file_paths):
+            stat = path.stat()
+            if self._is_known(path, stat):
+                skipped.append(path); continue
+            checksum = file_checksum(path)
+            with self.connection:
+                # The path was rewritten with other content, forget the old one.
+                self.connection.execute(
+                    'DELETE FROM captures WHERE path = ? AND checksum != ?', (str(path), checksum))
+            if checksum in checksums.values():
+                skipped.append(path); continue
+            known = self.connection.execute(
+                'SELECT path FROM captures WHERE checksum = ?', (checksum,)).fetchone()
+            if known:
+                # The same capture moved or touched, not just copied.
+                if known[0] == str(path) or not Path(known[0]).exists():
+                    with self.connection:
+                        self.connection.execute(
+                            'UPDATE captures SET path = ?, size = ?, mtime = ? WHERE checksum = ?',
+                            (str(path), stat.st_size, stat.st_mtime, checksum))
+                skipped.append(path); continue
+            checksums[path] = checksum
+            new.append((path, stat))
+        if not new:
+            return [], skipped
+
+        results = extract_server_names_seen([path for path, _ in new], workers)
+        with self.connection:
+            for path, stat in new:
+                capture_id = self.connection.execute(
+                    'INSERT INTO captures (checksum, path, size, mtime, indexed_at)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (checksums[path], str(path), stat.st_size, stat.st_mtime, time.time())
+                ).lastrowid
+                self.connection.executemany(
+                    'INSERT INTO server_names VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((capture_id, server_name, str(address), address.version,
+                      address.packed, first_seen, last_seen)
+                     for (address, server_name), (first_seen, last_seen)
+                     in results[path].items()
+                     if address not in PRIVATE_NETWORKS))
+        return [path for path, _ in new], skipped
+
+    def remove_missing_captures(self) -> int:
+        '''Forget captures whose files do not exist anymore.'''
+        missing = [(capture_id,) for capture_id, path in
+                   self.connection.execute('SELECT id, path FROM captures')
+                   if not Path(path).exists()]
+        with self.connection:
+            self.connection.executemany('DELETE FROM captures WHERE id = ?', missing)
+        return len(missing)
+
+    def _conditions(
+            self, server_name: Optional[str], address: Optional[str]
+    ) -> tuple[str, list]:
+        '''`server_name` may be a glob pattern (`*.example.com`),
+        `address` an address or a network.'''
+        conditions, parameters = [], []
+        if server_name is not None:
+            conditions.append('server_name GLOB ?'); parameters.append(server_name)
+        if address is not None:
+            network = ip_network(address, strict=False)
+            conditions.append('version = ? AND packed BETWEEN ? AND ?')
+            parameters.extend((network.version, network.network_address.packed,
+                               network.broadcast_address.packed))
+        return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', parameters
+
+    def records(
+            self, server_name: Optional[str] = None, address: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        '''Server name and address pairs with the first and last time they
+        were seen in any capture and the number of those captures.'''
+        where, parameters = self._conditions(server_name, address)
+        rows = self.connection.execute(
+            'SELECT server_name, address, MIN(first_seen), MAX(last_seen), COUNT(*)'
+            f' FROM server_names{where} GROUP BY server_name, version, packed'
+            ' ORDER BY server_name, version, packed', parameters)
+        return [{'server_name': name, 'address': address, 'first_seen': first,
+                 'last_seen': last, 'captures': count}
+                for name, address, first, last, count in rows]
+
+    def get_sni_dict(
+            self,
+            get_server_name_to_addresses: bool = False,
+            get_address_to_server_names: bool = False,
+            server_name: Optional[str] = None,
+            address: Optional[str] = None
+    ) -> Dict[str, Dict[str, List[str]]]:
+        '''Same dictionaries as `get_sni_dict` of the Tshark functions,
+        for all the indexed captures.'''
+        if not get_server_name_to_addresses and not get_address_to_server_names:
+            get_server_name_to_addresses = get_address_to_server_names = True
+        where, parameters = self._conditions(server_name, address)
+        pairs = self.connection.execute(
+            f'SELECT DISTINCT address, server_name FROM server_names{where}', parameters)
+        return Tshark.server_name_dicts(
+            pairs, get_address_to_server_names, get_server_name_to_addresses)
+
+    def captures(self) -> List[Dict[str, Any]]:
+        rows = self.connection.execute(
+            'SELECT path, checksum, size, indexed_at,'
+            ' (SELECT COUNT(*) FROM server_names WHERE capture_id = captures.id)'
+            ' FROM captures ORDER BY path')
+        return [{'path': path, 'checksum': checksum, 'size': size,
+                 'indexed_at': indexed_at, 'server_names': count}
+                for path, checksum, size, indexed_at, count in rows]
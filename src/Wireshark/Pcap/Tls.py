@@ -0,0 +1,382 @@
+'''Server names from TLS and QUIC ClientHello messages.
+
+Instead of dissecting every packet, frames are first searched for the
+byte patterns of a TLS handshake record or a QUIC long header, only
+matching ones are decoded, and of the ClientHello only the extensions
+are walked to the `server_name` one. ClientHello messages split over
+several TCP segments or QUIC Initial packets are reassembled.
+
+QUIC Initial packets are decrypted with keys derived from the
+connection id (RFC 9001), which requires the `cryptography` package;
+without it only TLS over TCP is processed.
+'''
+
+import os
+import re
+import hmac
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional, Union
+from ipaddress import IPv4Address, IPv6Address, ip_address
+
+from .Classes import Pcap_Reader, Packet, Chunk, decode_frame, IPPROTO_TCP, IPPROTO_UDP
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    QUIC_Provider = 'python'
+except ImportError:
+    QUIC_Provider = None
+
+TLS_HANDSHAKE_RECORD = 0x16
+HANDSHAKE_CLIENT_HELLO = 0x01
+EXTENSION_SERVER_NAME = 0x0000
+SERVER_NAME_HOST_NAME = 0x00
+# A ClientHello is well below this, anything longer is not worth buffering.
+MAX_CLIENT_HELLO_LENGTH = 1 << 16
+# Unfinished reassemblies older than this number of frames are dropped.
+REASSEMBLY_WINDOW = 10000
+# Smaller chunks are not worth sending to another process.
+MIN_CHUNK_SIZE = 8 * 1024 * 1024
+
+# version: (initial packet type, salt, label prefix)
+QUIC_VERSIONS = {
+    b'\x00\x00\x00\x01': (0, bytes.fromhex('38762cf7f55934b34d179ae6a4c80cadccbb7f0a'), b'quic'),
+    b'\x6b\x33\x43\xcf': (1, bytes.fromhex('0dede3def700a6db819381be6e269dcbf9bd2ed9'), b'quicv2'),
+}
+QUIC_FRAME_PADDING, QUIC_FRAME_PING, QUIC_FRAME_CRYPTO = 0x00, 0x01, 0x06
+QUIC_FRAMES_ACK = (0x02, 0x03)
+
+ADDRESS = Union[IPv4Address, IPv6Address]
+
+
+def parse_client_hello_server_name(message: bytes) -> Optional[str]:
+    '''`server_name` of a ClientHello handshake message, if present.'''
+    if len(message) < 4 or message[0] != HANDSHAKE_CLIENT_HELLO:
+        return None
+    end = min(len(message), 4 + int.from_bytes(message[1:4], 'big'))
+    offset = 4 + 2 + 32  # header, legacy_version, random
+    if offset >= end: return None
+    offset += 1 + message[offset]  # legacy_session_id
+    if offset + 2 > end: return None
+    offset += 2 + int.from_bytes(message[offset:offset + 2], 'big')  # cipher_suites
+    if offset >= end: return None
+    offset += 1 + message[offset]  # legacy_compression_methods
+    if offset + 2 > end: return None
+    extensions_end = min(end, offset + 2 + int.from_bytes(message[offset:offset + 2], 'big'))
+    offset += 2
+    while offset + 4 <= extensions_end:
+        extension_type = int.from_bytes(message[offset:offset + 2], 'big')
+        extension_end = min(extensions_end, offset + 4 + int.from_bytes(message[offset + 2:offset + 4], 'big'))
+        if extension_type == EXTENSION_SERVER_NAME:
+            position = offset + 4 + 2  # skip server_name_list length
+            while position + 3 <= extension_end:
+                name_type = message[position]
+                name_end = position + 3 + int.from_bytes(message[position + 1:position + 3], 'big')
+                if name_type == SERVER_NAME_HOST_NAME and name_end <= extension_end:
+                    return bytes(message[position + 3:name_end]).decode('utf-8', 'replace')
+                position = name_end
+            return None
+        offset = extension_end
+    return None
+
+
+def _handshake_message(data: bytes) -> Optional[bytes]:
+    '''The first handshake message carried by TLS records at the start
+    of `data`, `None` if more data is needed. Raise ValueError if `data`
+    is not a sequence of handshake records.'''
+    fragments = bytearray()
+    offset = 0
+    while True:
+        if len(fragments) >= 4 and len(fragments) >= 4 + int.from_bytes(fragments[1:4], 'big'):
+            return bytes(fragments)
+        if offset + 5 > len(data):
+            return None
+        if data[offset] != TLS_HANDSHAKE_RECORD or data[offset + 1] != 3:
+            raise ValueError("Not a TLS handshake record")
+        length = int.from_bytes(data[offset + 3:offset + 5], 'big')
+        fragments += data[offset + 5:offset + 5 + length]
+        offset += 5 + length
+
+
+def _is_client_hello_start(payload: bytes) -> bool:
+    return len(payload) >= 6 and payload[0] == TLS_HANDSHAKE_RECORD \
+       and payload[1] == 3 and payload[5] == HANDSHAKE_CLIENT_HELLO
+
+
+# QUIC
+
+def _hkdf_expand_label(secret: bytes, label: bytes, length: int) -> bytes:
+    label = b'tls13 ' + label
+    info = length.to_bytes(2, 'big') + bytes([len(label)]) + label + b'\x00'
+    # All the lengths used here fit into one SHA-256 block.
+    return hmac.new(secret, info + b'\x01', hashlib.sha256).digest()[:length]
+
+
+def quic_initial_keys(
+        destination_connection_id: bytes, version: bytes = b'\x00\x00\x00\x01'
+) -> tuple[bytes, bytes, bytes]:
+    '''Client Initial packet protection key, iv and header protection key.'''
+    _, salt, prefix = QUIC_VERSIONS[version]
+    initial_secret = hmac.new(salt, destination_connection_id, hashlib.sha256).digest()
+    client_secret = _hkdf_expand_label(initial_secret, b'client in', 32)
+    return (_hkdf_expand_label(client_secret, prefix + b' key', 16),
+            _hkdf_expand_label(client_secret, prefix + b' iv', 12),
+            _hkdf_expand_label(client_secret, prefix + b' hp', 16))
+
+
+def _varint(data: bytes, offset: int) -> tuple[int, int]:
+    length = 1 << (data[offset] >> 6)
+    if offset + length > len(data):
+        raise ValueError("Truncated variable-length integer")
+    value = int.from_bytes(data[offset:offset + length], 'big') & ((1 << (8 * length - 2)) - 1)
+    return value, offset + length
+
+
+def decrypt_quic_initial(datagram: bytes) -> Optional[tuple[bytes, bytes]]:
+    '''Destination connection id and decrypted payload of the client
+    Initial packet at the start of a UDP datagram.'''
+    if QUIC_Provider is None or len(datagram) < 7 or datagram[0] & 0xc0 != 0xc0:
+        return None
+    version = bytes(datagram[1:5])
+    if version not in QUIC_VERSIONS or (datagram[0] >> 4) & 0x03 != QUIC_VERSIONS[version][0]:
+        return None
+    try:
+        offset = 5
+        dcid = bytes(datagram[offset + 1:offset + 1 + datagram[offset]])
+        offset += 1 + datagram[offset]
+        offset += 1 + datagram[offset]  # source connection id
+        token_length, offset = _varint(datagram, offset)
+        length, offset = _varint(datagram, offset + token_length)
+    except (IndexError, ValueError):
+        return None
+    if offset + length > len(datagram) or length < 20:
+        return None
+    key, iv, hp = quic_initial_keys(dcid, version)
+    sample = bytes(datagram[offset + 4:offset + 20])
+    encryptor = Cipher(algorithms.AES(hp), modes.ECB()).encryptor()
+    mask = encryptor.update(sample) + encryptor.finalize()
+    first = datagram[0] ^ (mask[0] & 0x0f)
+    pn_length = (first & 0x03) + 1
+    packet_number = bytes(b ^ m for b, m in zip(datagram[offset:offset + pn_length], mask[1:]))
+    header = bytes([first]) + bytes(datagram[1:offset]) + packet_number
+    nonce = (int.from_bytes(iv, 'big') ^ int.from_bytes(packet_number, 'big')).to_bytes(12, 'big')
+    try:
+        payload = AESGCM(key).decrypt(
+            nonce, bytes(datagram[offset + pn_length:offset + length]), header)
+    except Exception:
+        # Not an Initial of the client (e.g. the server's one) or corrupted.
+        return None
+    return dcid, payload
+
+
+def quic_crypto_frames(payload: bytes) -> Iterator[tuple[int, bytes]]:
+    '''`(offset, data)` of CRYPTO frames in a decrypted Initial payload.'''
+    offset = 0
+    try:
+        while offset < len(payload):
+            frame_type = payload[offset]
+            offset += 1
+            if frame_type in (QUIC_FRAME_PADDING, QUIC_FRAME_PING):
+                continue
+            elif frame_type in QUIC_FRAMES_ACK:
+                _, offset = _varint(payload, offset)  # largest acknowledged
+                _, offset = _varint(payload, offset)  # delay
+                ranges, offset = _varint(payload, offset)
+                _, offset = _varint(payload, offset)  # first range
+                for _ in range(2 * ranges + (3 if frame_type == 0x03 else 0)):
+                    _, offset = _varint(payload, offset)
+            elif frame_type == QUIC_FRAME_CRYPTO:
+                crypto_offset, offset = _varint(payload, offset)
+                length, offset = _varint(payload, offset)
+                yield crypto_offset, payload[offset:offset + length]
+                offset += length
+            else:
+                return  # nothing else is allowed before the ClientHello is done
+    except (IndexError, ValueError):
+        return
+
+
+def _assemble_crypto_stream(fragments: dict[int, bytes]) -> bytes:
+    stream = bytearray()
+    for offset in sorted(fragments):
+        if offset > len(stream): break
+        stream += fragments[offset][len(stream) - offset:]
+    return bytes(stream)
+
+
+# Extraction
+
+def extract_server_names(
+        pcap_file_path: Union[str, Path], quic: bool = True,
+        chunk: Optional[Chunk] = None
+) -> Iterator[tuple[ADDRESS, str]]:
+    '''Yield `(server address, server name)` of every ClientHello.
+
+    With `chunk` only ClientHello messages starting in it are processed;
+    frames after it are read only to finish their reassembly.'''
+    for _, address, server_name in extract_server_name_records(pcap_file_path, quic, chunk):
+        yield address, server_name
+
+
+def extract_server_name_records(
+        pcap_file_path: Union[str, Path], quic: bool = True,
+        chunk: Optional[Chunk] = None
+) -> Iterator[tuple[Optional[float], ADDRESS, str]]:
+    '''`extract_server_names` with the timestamp of the frame
+    completing each ClientHello.'''
+    quic = quic and QUIC_Provider is not None
+    # Any frame with a ClientHello contains one of these.
+    markers = re.compile(b'|'.join(
+        re.escape(m) for m in (b'\x16\x03', *(QUIC_VERSIONS if quic else ()))))
+    # flow -> [buffered payload, next sequence number, frame number]
+    tcp_pending: dict[tuple, list] = {}
+    # flow and connection id -> [{offset: crypto data}, frame number]
+    quic_pending: dict[tuple, list] = {}
+    chunk_frames = chunk.frames if chunk else float('inf')
+
+    with Pcap_Reader(pcap_file_path) as reader:
+        for number, frame in enumerate(reader.frames(chunk)):
+            if number % REASSEMBLY_WINDOW == 0:
+                for pending in (tcp_pending, quic_pending):
+                    for key in [k for k, v in pending.items()
+                                if v[-1] < number - REASSEMBLY_WINDOW]:
+                        del pending[key]
+            in_chunk = number < chunk_frames
+            if not in_chunk and not tcp_pending and not quic_pending:
+                break
+            if not tcp_pending and not quic_pending \
+               and markers.search(frame.data) is None:
+                continue
+            packet = decode_frame(frame)
+            if packet is None or packet.sport is None:
+                continue
+            if packet.protocol == IPPROTO_TCP:
+                server_name = _process_tcp(packet, number, tcp_pending, in_chunk)
+            elif packet.protocol == IPPROTO_UDP and quic:
+                server_name = _process_quic(packet, number, quic_pending, in_chunk)
+            else:
+                continue
+            if server_name is not None:
+                yield packet.timestamp, ip_address(packet.dst), server_name
+
+
+SEEN = dict[tuple[ADDRESS, str], tuple[Optional[float], Optional[float]]]
+
+
+def _merge_seen(seen: SEEN, other: SEEN) -> None:
+    for pair, (first, last) in other.items():
+        if pair in seen:
+            known_first, known_last = seen[pair]
+            first = min((t for t in (first, known_first) if t is not None), default=None)
+            last = max((t for t in (last, known_last) if t is not None), default=None)
+        seen[pair] = (first, last)
+
+
+def _extract_chunk(task: tuple[Path, Chunk, bool]) -> tuple[Path, SEEN]:
+    path, chunk, quic = task
+    seen = {}
+    for timestamp, address, server_name in extract_server_name_records(path, quic, chunk):
+        _merge_seen(seen, {(address, server_name): (timestamp, timestamp)})
+    return path, seen
+
+
+def extract_server_names_seen(
+        pcap_file_paths: Iterable[Union[str, Path]], workers: Optional[int] = None,
+        quic: bool = True
+) -> dict[Path, SEEN]:
+    '''First and last time every `(server address, server name)` pair
+    was seen, per capture file. The captures are split into chunks
+    processed by a pool of `workers` processes.'''
+    workers = workers or os.cpu_count() or 1
+    paths = [Path(p) for p in pcap_file_paths]
+    total_size = sum(p.stat().st_size for p in paths)
+    # A few chunks per worker even out the differences in their contents.
+    chunk_size = max(MIN_CHUNK_SIZE, total_size // (workers * 4))
+    tasks = []
+    for path in paths:
+        with Pcap_Reader(path) as reader:
+            tasks.extend((path, chunk, quic) for chunk in reader.chunks(chunk_size))
+    results = {path: {} for path in paths}
+    if workers == 1 or len(tasks) == 1:
+        for path, seen in map(_extract_chunk, tasks):
+            _merge_seen(results[path], seen)
+    else:
+        with ProcessPoolExecutor(min(workers, len(tasks))) as executor:
+            for path, seen in executor.map(_extract_chunk, tasks):
+                _merge_seen(results[path], seen)
+    return results
+
+
+def extract_server_names_parallel(
+        pcap_file_paths: Iterable[Union[str, Path]], workers: Optional[int] = None,
+        quic: bool = True
+) -> list[tuple[ADDRESS, str]]:
+    '''Unique `(server address, server name)` pairs of all the captures,
+    see `extract_server_names_seen`. The result is sorted,
+    so it does not depend on the scheduling.'''
+    pairs = set()
+    for seen in extract_server_names_seen(pcap_file_paths, workers, quic).values():
+        pairs.update(seen)
+    return sorted(pairs, key=lambda p: (p[0].version, p[0], p[1]))
+
+
+def _process_tcp(
+        packet: Packet, number: int, pending: dict, new: bool = True
+) -> Optional[str]:
+    payload = packet.payload
+    # No sequence number: the TCP header is truncated (e.g. by the snaplen).
+    if not payload or packet.sequence is None:
+        return None
+    key = (packet.src, packet.dst, packet.sport, packet.dport)
+    state = pending.get(key)
+    if state is not None:
+        buffer, next_sequence, _ = state
+        if packet.sequence != next_sequence:
+            if (next_sequence - packet.sequence) & 0xffffffff >= 0x80000000:
+                del pending[key]  # a gap, give up on this flow
+            return None  # otherwise a retransmission
+        buffer += payload
+        state[1] = (next_sequence + len(payload)) & 0xffffffff
+        data = buffer
+    elif new and _is_client_hello_start(payload):
+        data = payload
+    else:
+        return None
+    try:
+        message = _handshake_message(data)
+    except ValueError:
+        pending.pop(key, None)
+        return None
+    if message is None:
+        if state is None:
+            pending[key] = [bytearray(payload),
+                            (packet.sequence + len(payload)) & 0xffffffff, number]
+        elif len(data) > MAX_CLIENT_HELLO_LENGTH:
+            del pending[key]
+        return None
+    pending.pop(key, None)
+    return parse_client_hello_server_name(message)
+
+
+def _process_quic(
+        packet: Packet, number: int, pending: dict, new: bool = True
+) -> Optional[str]:
+    decrypted = decrypt_quic_initial(packet.payload)
+    if decrypted is None:
+        return None
+    dcid, payload = decrypted
+    key = (packet.src, packet.dst, packet.sport, packet.dport, dcid)
+    if not new and key not in pending:
+        return None
+    fragments, _ = pending.setdefault(key, [{}, number])
+    for offset, data in quic_crypto_frames(payload):
+        fragments[offset] = data
+    stream = _assemble_crypto_stream(fragments)
+    if len(stream) < 4 or len(stream) < 4 + int.from_bytes(stream[1:4], 'big'):
+        if len(stream) > MAX_CLIENT_HELLO_LENGTH:
+            del pending[key]
+        return None
+    del pending[key]
+    return parse_client_hello_server_name(stream)
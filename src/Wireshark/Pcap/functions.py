@@ -0,0 +1,299 @@
+import struct
+import hashlib
+import tempfile
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict
+from typing import Iterable, List, Optional, Union
+from ipaddress import ip_address
+
+from .Classes import (
+    Pcap_Reader, Pcap_Writer, Frame, Packet, decode_frame,
+    IPPROTO_TCP, IPPROTO_UDP, IPPROTO_SCTP, LINKTYPE_ETHERNET
+)
+from .Tls import QUIC_Provider, extract_server_names, quic_initial_keys
+from ..Tshark.Classes import Report_Processor, Endpoint_Report, Conversation_Report
+
+# Protocols of `-z endpoints,...` and `-z conv,...` supported in-process.
+PROTOS_SUPPORTED_BY_PCAP_READER = ('eth', 'ip', 'ipv6', 'tcp', 'udp', 'sctp')
+
+_REPORT_NAMES = {
+    'eth': 'Ethernet', 'ip': 'IPv4', 'ipv6': 'IPv6',
+    'tcp': 'TCP', 'udp': 'UDP', 'sctp': 'SCTP'
+}
+_TRANSPORT_PROTOCOLS = {'tcp': IPPROTO_TCP, 'udp': IPPROTO_UDP, 'sctp': IPPROTO_SCTP}
+
+
+def get_timestamp_of_first_frame(pcap_file_path) -> Optional[datetime]:
+    with Pcap_Reader(pcap_file_path) as reader:
+        for frame in reader.frames():
+            if frame.timestamp is not None:
+                return datetime.fromtimestamp(frame.timestamp)
+    return None
+
+
+def _endpoint_keys(frame: Frame, packet: Optional[Packet], proto: str):
+    '''Source and destination endpoint of the frame for the protocol, if any.
+    Ethernet endpoints are taken from every frame, like tshark does, the
+    others from its decoded `packet`.'''
+    if proto == 'eth':
+        if frame.linktype != LINKTYPE_ETHERNET or len(frame.data) < 14: return None
+        return frame.data[6:12].tobytes(), frame.data[0:6].tobytes()
+    if packet is None: return None
+    if proto == 'ip':
+        if packet.version != 4: return None
+        return packet.src, packet.dst
+    if proto == 'ipv6':
+        if packet.version != 6: return None
+        return packet.src, packet.dst
+    if packet.protocol != _TRANSPORT_PROTOCOLS[proto] or packet.sport is None:
+        return None
+    return (packet.src, packet.sport), (packet.dst, packet.dport)
+
+
+def _format_endpoint(proto: str, key) -> list:
+    if proto == 'eth':
+        return [key.hex(':')]
+    if proto in ('ip', 'ipv6'):
+        return [ip_address(key)]
+    return [ip_address(key[0]), key[1]]
+
+
+def collect_reports(
+        pcap_file_path,
+        proto: Union[str, Iterable[str]] = PROTOS_SUPPORTED_BY_PCAP_READER
+) -> List[Union[Conversation_Report, Endpoint_Report]]:
+    '''In-process equivalent of `tshark -q -z endpoints,... -z conv,...`
+    in a single pass over the capture. Byte counts are exact,
+    so the units of conversations are always `bytes`.'''
+    protos = [p.strip() for p in proto.split(',')] if isinstance(proto, str) else list(proto)
+    unsupported_protos = [p for p in protos if p not in PROTOS_SUPPORTED_BY_PCAP_READER]
+    if unsupported_protos:
+        raise ValueError(
+            "Unsupported protocols specified: "
+            f"{', '.join(unsupported_protos)}")
+
+    # endpoint -> [packets, bytes, tx_packets, tx_bytes, rx_packets, rx_bytes]
+    endpoints = {p: defaultdict(lambda: [0] * 6) for p in protos}
+    # (A, B) -> [frames_to_A, bytes_to_A, frames_to_B, bytes_to_B, start, end]
+    conversations = {p: {} for p in protos}
+    # Conversation starts are relative to the first frame, whatever it is.
+    first_timestamp = None
+    decode = any(p != 'eth' for p in protos)
+    with Pcap_Reader(pcap_file_path) as reader:
+        for frame in reader.frames():
+            timestamp = frame.timestamp or 0.0
+            if first_timestamp is None: first_timestamp = timestamp
+            length = frame.length
+            packet = decode_frame(frame) if decode else None
+            for p in protos:
+                keys = _endpoint_keys(frame, packet, p)
+                if keys is None: continue
+                src, dst = keys
+                for key, tx in ((src, True), (dst, False)):
+                    counters = endpoints[p][key]
+                    counters[0] += 1; counters[1] += length
+                    if tx: counters[2] += 1; counters[3] += length
+                    else:  counters[4] += 1; counters[5] += length
+                if (dst, src) in conversations[p]:
+                    counters = conversations[p][(dst, src)]
+                    counters[0] += 1; counters[1] += length
+                else:
+                    counters = conversations[p].setdefault(
+                        (src, dst), [0, 0, 0, 0, timestamp, timestamp])
+                    counters[2] += 1; counters[3] += length
+                counters[5] = timestamp
+
+    reports = []
+    for p in protos:
+        Report_class = Report_Processor.Classes_dict[f"{_REPORT_NAMES[p]} Endpoints"]
+        reports.append(Endpoint_Report(
+            header=f"{_REPORT_NAMES[p]} Endpoints",
+            endpoints=[Report_class(*_format_endpoint(p, key), *counters)
+                       for key, counters in endpoints[p].items()]))
+    for p in protos:
+        Report_class = Report_Processor.Classes_dict[f"{_REPORT_NAMES[p]} Conversations"]
+        entries = []
+        for (a, b), (to_a, bytes_a, to_b, bytes_b, start, end) in conversations[p].items():
+            entries.append(Report_class(
+                *_format_endpoint(p, a), *_format_endpoint(p, b),
+                to_a, bytes_a, 'bytes', to_b, bytes_b, 'bytes',
+                to_a + to_b, bytes_a + bytes_b, 'bytes',
+                round(start - first_timestamp, 6), round(end - start, 4)))
+        reports.append(Conversation_Report(
+            header=f"{_REPORT_NAMES[p]} Conversations", conversations=entries))
+    return reports
+
+
+def build_ethernet_frame(
+        src: str, dst: str, protocol: int = IPPROTO_TCP,
+        sport: int = 0, dport: int = 0, payload: bytes = b''
+) -> bytes:
+    '''Ethernet/IP/transport frame for generated test captures.'''
+    src, dst = ip_address(src), ip_address(dst)
+    if protocol == IPPROTO_TCP:
+        transport = struct.pack('!HHIIBBHHH', sport, dport, 0, 0, 5 << 4, 0x18, 65535, 0, 0)
+    elif protocol == IPPROTO_UDP:
+        transport = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0)
+    else:
+        transport = struct.pack('!HHII', sport, dport, 0, 0)
+    transport += payload
+    if src.version == 4:
+        ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(transport), 0, 0,
+                                64, protocol, 0, src.packed, dst.packed)
+        ethertype = 0x0800
+    else:
+        ip_header = struct.pack('!IHBB16s16s', 6 << 28, len(transport), protocol, 64,
+                                src.packed, dst.packed)
+        ethertype = 0x86dd
+    macs = bytes.fromhex('020000000002') + bytes.fromhex('020000000001')
+    return macs + struct.pack('!H', ethertype) + ip_header + transport
+
+
+def build_client_hello(server_name: str, padding: int = 0) -> bytes:
+    '''ClientHello handshake message with the server_name extension
+    between two others; `padding` bytes make it span several segments.'''
+    name = server_name.encode()
+    server_name_extension = struct.pack('!HHHBH', 0x0000, len(name) + 5,
+                                        len(name) + 3, 0, len(name)) + name
+    extensions = (struct.pack('!HH', 0x000a, 4) + b'\x00\x02\x00\x1d'
+                  + server_name_extension
+                  + struct.pack('!HH', 0x0015, padding) + bytes(padding))
+    body = (b'\x03\x03' + bytes(32) + b'\x20' + bytes(32)
+            + b'\x00\x02\x13\x01' + b'\x01\x00'
+            + struct.pack('!H', len(extensions)) + extensions)
+    return b'\x01' + len(body).to_bytes(3, 'big') + body
+
+
+def build_quic_initials(
+        client_hello: bytes, destination_connection_id: bytes, fragments: int = 1
+) -> list[bytes]:
+    '''Client Initial packets carrying the ClientHello in CRYPTO frames,
+    in reverse order of offsets within a packet (as browsers do).'''
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    key, iv, hp = quic_initial_keys(destination_connection_id)
+    size = -(-len(client_hello) // fragments)
+    datagrams = []
+    for packet_number in range(fragments):
+        start = packet_number * size
+        half = size // 2
+        frames = b''.join(
+            b'\x06' + (0x4000 | offset).to_bytes(2, 'big')
+            + (0x4000 | len(chunk)).to_bytes(2, 'big') + chunk
+            for offset, chunk in (
+                (start + half, client_hello[start + half:start + size]),
+                (start, client_hello[start:start + half])))
+        frames += bytes(1162 - len(frames))  # padding
+        header = (bytes([0xc0]) + b'\x00\x00\x00\x01'
+                  + bytes([len(destination_connection_id)]) + destination_connection_id
+                  + b'\x00' + b'\x00'  # no source connection id, no token
+                  + (0x4000 | (len(frames) + 16 + 1)).to_bytes(2, 'big'))
+        packet_number_byte = bytes([packet_number])
+        nonce = (int.from_bytes(iv, 'big') ^ packet_number).to_bytes(12, 'big')
+        protected = AESGCM(key).encrypt(nonce, frames, header + packet_number_byte)
+        encryptor = Cipher(algorithms.AES(hp), modes.ECB()).encryptor()
+        mask = encryptor.update(protected[3:19]) + encryptor.finalize()
+        datagrams.append(bytes([header[0] ^ (mask[0] & 0x0f)]) + header[1:]
+                         + bytes([packet_number ^ mask[1]]) + protected)
+    return datagrams
+
+
+def test_server_name_extraction() -> None:
+    def _record(message: bytes) -> bytes:
+        return b'\x16\x03\x01' + struct.pack('!H', len(message)) + message
+
+    records = _record(build_client_hello('example.com', padding=2000))
+    segments = [records[i:i + 1400] for i in range(0, len(records), 1400)]
+    frames = [
+        build_ethernet_frame('10.0.0.1', '93.184.216.34', IPPROTO_TCP, 50000, 443, segments[0]),
+        # cut in the middle of the TCP header (e.g. by the snaplen), skipped
+        build_ethernet_frame('10.0.0.1', '93.184.216.34', IPPROTO_TCP, 50000, 443,
+                             segments[1])[:14 + 20 + 8],
+        build_ethernet_frame('10.0.0.1', '93.184.216.34', IPPROTO_TCP, 50000, 443, segments[0]),
+        build_ethernet_frame('10.0.0.1', '192.168.1.1', IPPROTO_TCP, 50001, 443,
+                             _record(build_client_hello('router.local'))),
+    ]
+    expected = {('93.184.216.34', 'example.com')}
+    if QUIC_Provider is not None:
+        for datagram in build_quic_initials(
+                build_client_hello('quic.example.org', padding=1500),
+                bytes.fromhex('8394c8f03e515708'), fragments=2):
+            frames.append(build_ethernet_frame(
+                '2001:db8::1', '2001:db8::443', IPPROTO_UDP, 50002, 443, datagram))
+        expected.add(('2001:db8::443', 'quic.example.org'))
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / 'sni.pcap'
+        with Pcap_Writer(path) as writer:
+            for number, data in enumerate(frames):
+                if number == 2:
+                    # The second segment carries the rest of the ClientHello.
+                    data = data[:-len(segments[0])] + segments[1]
+                    data = data[:38] + (1400).to_bytes(4, 'big') + data[42:]
+                writer.write(data, 1700000000 + number)
+        extracted = set((str(a), n) for a, n in extract_server_names(path))
+    print(f"QUIC Initial keys match RFC 9001 test vectors:"
+          f" {quic_initial_keys(bytes.fromhex('8394c8f03e515708'))[0].hex() == '1f369613dd76d5467730efcbe3b1a22d'}")
+    print(f"Server names are extracted correctly"
+          f" ({'with' if QUIC_Provider else 'without'} QUIC):"
+          f" {extracted == expected | {('192.168.1.1', 'router.local')}}")
+
+
+def test_pcap_reader() -> None:
+    frames = [
+        (1699999999.5, bytes(12) + b'\x08\x06' + bytes(28)),  # ARP
+        # padded to the minimum Ethernet frame size
+        (1700000000.000001, build_ethernet_frame('10.0.0.1', '1.1.1.1', IPPROTO_TCP, 50000, 443) + bytes(6)),
+        (1700000000.5, build_ethernet_frame('1.1.1.1', '10.0.0.1', IPPROTO_TCP, 443, 50000, b'x' * 100)),
+        (1700000001.25, build_ethernet_frame('10.0.0.1', '8.8.8.8', IPPROTO_UDP, 53000, 53, b'q' * 30)),
+        (1700000002.0, build_ethernet_frame('2001:db8::1', '2001:db8::2', IPPROTO_UDP, 1234, 443)),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        for format in ('pcap', 'pcapng'):
+            path = Path(directory) / f"test.{format}"
+            with Pcap_Writer(path, format=format) as writer:
+                for timestamp, data in frames:
+                    writer.write(data, timestamp)
+            with Pcap_Reader(path) as reader:
+                read_frames = [(f.timestamp, bytes(f.data)) for f in reader.frames()]
+                packets = list(reader.packets())
+            frames_ok = len(read_frames) == len(frames) and all(
+                abs(t - rt) < 1e-6 and d == rd
+                for (t, d), (rt, rd) in zip(frames, read_frames))
+            headers_ok = [(ip_address(p.src), p.sport, p.dport) for p in packets] == [
+                (ip_address(s), sp, dp) for s, sp, dp in (
+                    ('10.0.0.1', 50000, 443), ('1.1.1.1', 443, 50000),
+                    ('10.0.0.1', 53000, 53), ('2001:db8::1', 1234, 443))] \
+                and [len(p.payload) for p in packets] == [0, 100, 30, 0]
+            reports = {r.header: r for r in collect_reports(path)}
+            tcp_conversation = reports['TCP Conversations'].conversations[0]
+            statistics_ok = (
+                len(reports['IPv4 Endpoints'].endpoints) == 3
+                and tcp_conversation.total_frames == 2
+                and tcp_conversation.frames_to_A == 1
+                # non-IP frames count, and conversations start relative to them
+                and sum(e.packets for e in reports['Ethernet Endpoints'].endpoints) == 2 * len(frames)
+                and tcp_conversation.relative_start == 0.500001
+                and reports['UDP Endpoints'].endpoints[-1].port == 443)
+            timestamp_ok = get_timestamp_of_first_frame(path) \
+                == datetime.fromtimestamp(frames[0][0])
+            with Pcap_Reader(path) as reader:
+                metadata = reader.metadata(('sha256',))
+            metadata_ok = (
+                metadata.packets == len(frames)
+                and metadata.data_size == sum(len(d) for _, d in frames)
+                and abs(metadata.start - frames[0][0]) < 1e-6
+                and abs(metadata.end - frames[-1][0]) < 1e-6
+                and metadata.ordered and metadata.truncated is None
+                and metadata.checksums['sha256'] == hashlib.sha256(path.read_bytes()).hexdigest())
+            print(f"{format}:"
+                  f"\n  frames are read back correctly: {frames_ok}"
+                  f"\n  headers are decoded correctly: {headers_ok}"
+                  f"\n  statistics are collected correctly: {statistics_ok}"
+                  f"\n  first frame timestamp is correct: {timestamp_ok}"
+                  f"\n  metadata is read correctly: {metadata_ok}")
+
+
+if __name__ == '__main__':
+    test_pcap_reader()
+    test_server_name_extraction()
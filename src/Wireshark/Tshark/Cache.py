@@ -0,0 +1,102 @@
+'''Cache of the statistics of packet captures.
+
+Every capture has one entry per key (e.g. the backend) under the cache
+directory: a line of json metadata, the path, size, modification time
+and sha256 of the capture, followed by the statistics verbatim, so a
+hit returns them without parsing. Entries are valid while the size and
+modification time of the capture are unchanged; otherwise (or always,
+with `verify`) the sha256 decides, so touched or copied-back captures
+are not dissected again. Entries are replaced atomically, parallel runs
+never see partial data and the last writer wins.
+'''
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+from ..Pcap.Index import file_checksum
+from ...tools import write_atomically, remove_files
+
+# Bump on any change of the cached data.
+CACHE_FORMAT_VERSION = 1
+
+
+class Statistics_Cache:
+    def __init__(self, cache_dir: Union[str, Path], verify: bool = False) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.verify = verify
+
+    def _path(self, pcap_file_path: Path, *key_parts: Any) -> Path:
+        key = hashlib.sha256(json.dumps(
+            [CACHE_FORMAT_VERSION, str(pcap_file_path), *key_parts]).encode('utf-8')).hexdigest()
+        return self.cache_dir / f"statistics.{key}.json"
+
+    def _store(self, path: Path, metadata: dict, statistics: str) -> None:
+        def write(file):
+            file.write(json.dumps(metadata) + '\n')
+            file.write(statistics)
+        try:
+            write_atomically(path, write)
+        except OSError:
+            # Deliberately ignored: the statistics are returned anyway,
+            # a capture whose entry could not be written is dissected again.
+            pass
+
+    def _lookup(
+            self, pcap_file_path: Path, key_parts: tuple
+    ) -> tuple[Optional[str], os.stat_result, Optional[str]]:
+        '''`(statistics or None, stat of the capture, its sha256 if it was
+        computed)`, so a miss never hashes the capture again.'''
+        stat = pcap_file_path.stat()
+        path = self._path(pcap_file_path, *key_parts)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                metadata = json.loads(file.readline())
+                statistics = file.read()
+        except (OSError, ValueError):
+            # Missing or broken entries are simply recomputed.
+            return None, stat, None
+        if metadata.get('size') != stat.st_size:
+            return None, stat, None
+        unchanged = metadata.get('mtime_ns') == stat.st_mtime_ns
+        if unchanged and not self.verify:
+            return statistics, stat, None
+        checksum = file_checksum(pcap_file_path)
+        if metadata.get('sha256') != checksum:
+            return None, stat, checksum
+        if not unchanged:
+            # Touched only: the next lookup needs no checksum.
+            self._store(path, {**metadata, 'mtime_ns': stat.st_mtime_ns}, statistics)
+        return statistics, stat, checksum
+
+    def get(self, pcap_file_path: Union[str, Path], *key_parts: Any) -> Optional[str]:
+        '''Cached statistics of the capture, `None` if there are none or
+        the capture changed.'''
+        statistics, _, _ = self._lookup(Path(pcap_file_path).resolve(), key_parts)
+        return statistics
+
+    def get_or_compute(
+            self, pcap_file_path: Union[str, Path],
+            compute: Callable[[], str], *key_parts: Any
+    ) -> str:
+        '''Cached statistics of the capture, computed by `compute` and
+        cached on a miss. The capture is hashed at most once.'''
+        pcap_file_path = Path(pcap_file_path).resolve()
+        # The stat is taken before computing, a capture written meanwhile
+        # is a miss next time.
+        statistics, stat, checksum = self._lookup(pcap_file_path, key_parts)
+        if statistics is not None:
+            return statistics
+        metadata = {'path': str(pcap_file_path), 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'sha256': checksum or file_checksum(pcap_file_path)}
+        statistics = compute()
+        self._store(self._path(pcap_file_path, *key_parts), metadata, statistics)
+        return statistics
+
+    def clear(self) -> int:
+        '''Remove all cache entries, return their number.'''
+        return remove_files(self.cache_dir, 'statistics.*.json')
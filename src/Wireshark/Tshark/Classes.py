@@ -1,19 +1,75 @@
 import io
 import json
 import csv
+import heapq
 
 from dataclasses import dataclass, asdict, field
-from typing import Any, Callable, Dict, Literal, Optional, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, Literal, Optional, Sequence, TextIO, Tuple, Union
+from operator import attrgetter
 from collections import defaultdict
 from ipaddress import IPv4Address, IPv6Address, ip_address
 from copy import copy
+from functools import partial
+
+from ...tools import cast_value, get_converter, obj_to_stringified_dict, parse_ip_address
+
+def _compile_row_parser(cls) -> Callable[[str], list]:
+    '''Generate the parser of a row of `cls`: every field is converted by
+    an expression specialized to its type, with no per-row lookups.'''
+    fields = list(cls.__annotations__.values())
+    namespace = {'parse_ip_address': parse_ip_address}
+    lines = ["def parse(obj_str):",
+             "    t = obj_str.split()",
+             "    if '<->' in t: t.remove('<->')"]
+    values = []
+    token = 0
+    if any(base.__name__ == 'Transport_Conversation' for base in cls.__bases__):
+        # `IPv*Address:port` entries
+        for side in range(2):
+            lines.append(f"    a{side}, p{side} = t[{side}].rsplit(':', 1)")
+            values += [f"parse_ip_address(a{side})", f"int(p{side})"]
+        fields, token = fields[4:], 2
+    for number, field_type in enumerate(fields, token):
+        if field_type is int:
+            values.append(f"int(t[{number}].replace(',', ''))")
+        elif field_type is float:
+            values.append(f"float(t[{number}])")
+        elif field_type is str:
+            values.append(f"t[{number}]")
+        elif field_type == Union[IPv4Address, IPv6Address]:
+            values.append(f"parse_ip_address(t[{number}])")
+        else:
+            namespace[f"C{number}"] = get_converter(field_type)
+            values.append(f"C{number}(t[{number}])")
+    lines.append(f"    return [{', '.join(values)}]")
+    exec('\n'.join(lines), namespace)
+    return namespace['parse']
 
-from ...tools import cast_value, obj_to_stringified_dict
 
 class Item_Processor:
 
     @classmethod
     def parse_str(cls, obj_str: str):
+        return cls(*cls.row_parser()(obj_str))
+
+    @classmethod
+    def parse_values(cls, obj_str: str) -> list:
+        '''Field values of a report row, in the order of the fields.'''
+        return cls.row_parser()(obj_str)
+
+    @classmethod
+    def row_parser(cls) -> Callable[[str], list]:
+        '''`parse_values` compiled for this class on first use.'''
+        parser = cls.__dict__.get('_row_parser')
+        if parser is None:
+            parser = _compile_row_parser(cls)
+            setattr(cls, '_row_parser', parser)
+        return parser
+
+    @classmethod
+    def parse_values_generic(cls, obj_str: str) -> list:
+        '''Reference implementation of `parse_values` (see
+        `functions.benchmark_row_parsers`).'''
         obj_list = obj_str.split()
         if '<->' in obj_list: obj_list.remove('<->')
         resulting_obj_list = []
@@ -33,8 +89,7 @@ class Item_Processor:
             fields = fields[4:]
         for field_type in fields:
             resulting_obj_list.append(cast_value(obj_list.pop(0), field_type))
-        resulting_obj = cls(*resulting_obj_list)
-        return resulting_obj
+        return resulting_obj_list
 
     @property
     def as_dict(self)-> dict[str, Union[int, float, str, IPv4Address, IPv6Address]]:
@@ -137,6 +192,65 @@ class Report_Processor:
         'ZigBee Conversations': ZigBee_Conversation
     }
 
+    # tshark opens and closes every statistics page with this line.
+    PAGE_SEPARATOR = '=' * 80
+
+    @staticmethod
+    def page_classes(header: str) -> Optional[Tuple[type, type]]:
+        '''Report and entry classes of a page by its header line.'''
+        for Report_class in (Endpoint_Report, Conversation_Report):
+            Item_class = Report_class.Classes_dict.get(header)
+            if Item_class is not None:
+                return Report_class, Item_class
+        for Report_class in (Endpoint_Report, Conversation_Report):
+            for protocol, Item_class in Report_class.Classes_dict.items():
+                if header.startswith(protocol):
+                    return Report_class, Item_class
+        return None
+
+    @classmethod
+    def iterate_pages(
+            cls, lines: Iterable[str]
+    ) -> Iterator[Tuple[type, type, str, str, Iterator[str]]]:
+        '''`(report class, entry class, header, filter, entry lines)` of the
+        pages of tshark's `-z endpoints,...` and `-z conv,...` output, read
+        line by line. The entry lines must be used before the next page.'''
+        lines = iter(lines)
+        for line in lines:
+            header = line.strip()
+            if not header or header == cls.PAGE_SEPARATOR:
+                continue
+            classes = cls.page_classes(header)
+            if classes is None:
+                for line in lines:
+                    if line.startswith(cls.PAGE_SEPARATOR): break
+                continue
+            Report_class, Item_class = classes
+            filter_line = next(lines, '').rstrip('\r\n')
+            report_filter = '' if '<No Filter>' in filter_line else filter_line.split(':', 1)[-1]
+            # skip column headers--conversation headers span two rows
+            for _ in range(1 if Report_class is Endpoint_Report else 2):
+                next(lines, None)
+            entry_lines = cls._page_entry_lines(lines)
+            yield Report_class, Item_class, header, report_filter, entry_lines
+            for _ in entry_lines: pass
+
+    @classmethod
+    def _page_entry_lines(cls, lines: Iterator[str]) -> Iterator[str]:
+        for line in lines:
+            if line.startswith(cls.PAGE_SEPARATOR): return
+            if line.strip(): yield line
+
+    @classmethod
+    def iterate_reports(
+            cls, lines: Iterable[str]
+    ) -> Iterator[Union[Conversation_Report, Endpoint_Report]]:
+        '''Parse tshark's statistics output line by line, yielding every
+        report as soon as its page ends. Only the entries of the current
+        page are kept in memory.'''
+        for Report_class, Item_class, header, report_filter, entry_lines in cls.iterate_pages(lines):
+            yield Report_class(header, report_filter, [Item_class.parse_str(line) for line in entry_lines])
+
     @classmethod
     def parse_report_page(cls, report_str: str):
         for protocol, Report_class in cls.Classes_dict.items():
@@ -158,30 +272,74 @@ class Report_Processor:
                 resulting_report = cls(*init_args)
                 return resulting_report
 
-    def sort_entries(self, key, reverse: bool = False) -> None:
-        if key in self.entries[0].as_dict.keys():
-            if   isinstance(self, Endpoint_Report):     list_item = 'endpoints'
-            elif isinstance(self, Conversation_Report): list_item = 'conversations'
-            #TODO: a little hacky. Find a conventional way.
-            eval(f"self.{list_item}.sort(key=lambda entry: entry.{key}, reverse={reverse})")
-        # else:
-        #     raise Exception(f"Sort key must be one of: {', '.join(self.entries[0].as_dict.keys())}")
+    def entry_key(self, key: Union[str, Sequence[str]]) -> Callable[[Any], Any]:
+        '''Sort key of the entries by one or more fields. Addresses are
+        ordered by version, then value, so IPv4 and IPv6 ones mix.'''
+        names = [key] if isinstance(key, str) else list(key)
+        fields = getattr(self.entry_class, '__annotations__', {})
+        unknown = [name for name in names if name not in fields]
+        if unknown or not names:
+            raise ValueError(f"Sort key must be one of: {', '.join(fields)}")
+        addresses = [number for number, name in enumerate(names)
+                     if fields[name] == Union[IPv4Address, IPv6Address]]
+        get_values = attrgetter(*names)
+        if not addresses:
+            return get_values
+        if len(names) == 1:
+            def address_key(entry) -> tuple:
+                value = get_values(entry)
+                return value.version, int(value)
+            return address_key
+        def key_function(entry) -> tuple:
+            values = list(get_values(entry))
+            for number in addresses:
+                values[number] = (values[number].version, int(values[number]))
+            return tuple(values)
+        return key_function
+
+    def sort_entries(self, key: Union[str, Sequence[str]], reverse: bool = False) -> None:
+        '''Stable in-place sort by one or more fields (see `entry_key`).'''
+        self.entries.sort(key=self.entry_key(key), reverse=reverse)
+
+    def sorted_entries(self, key: Union[str, Sequence[str]], reverse: bool = False) -> list:
+        return sorted(self.entries, key=self.entry_key(key), reverse=reverse)
+
+    def top_entries(self, n: int, key: Union[str, Sequence[str]], reverse: bool = True) -> list:
+        '''First `n` entries of `sorted_entries(key, reverse)` (largest by
+        default) from a heap, without sorting the whole report.'''
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        return select(n, self.entries, key=self.entry_key(key))
+
+    @property
+    def entry_class(self) -> Optional[type]:
+        '''Class of the entries, also known for empty reports.'''
+        if self.entries:
+            return type(self.entries[0])
+        classes = self.page_classes(self.header)
+        return classes[1] if classes else None
+
+    @property
+    def entry_fields(self) -> Tuple[str, ...]:
+        return tuple(getattr(self.entry_class, '__annotations__', ()))
+
+    def iterate_rows(self) -> Iterator[list]:
+        '''Field values of every entry, with addresses as strings.'''
+        get_values = attrgetter(*self.entry_fields)
+        for entry in self.entries:
+            yield [str(v) if isinstance(v, (IPv4Address, IPv6Address)) else v
+                   for v in get_values(entry)]
 
     #TODO 0: make these methods universal for every instance
-    def calculate_column_widths(self):
-        column_widths = defaultdict(list)
-        for k in self.entries[0].__annotations__.keys():
-            column_widths[k].append(len(str(k)))
-        for e in self.entries:
-            for k, v in e.as_dict.items():
-                column_widths[k].append(len(str(v)))
-        for k in column_widths.keys():
-            column_widths[k] = max(column_widths[k])
-        return column_widths
+    def calculate_column_widths(self) -> Dict[str, int]:
+        names = self.entry_fields
+        widths = [len(k) for k in names]
+        for row in self.iterate_rows():
+            widths = [max(width, len(str(v))) for width, v in zip(widths, row)]
+        return dict(zip(names, widths))
 
     #TODO 0: make these methods universal for every instance
-    def to_pretty_table(
-            self, separator: str = ' ',
+    def write_pretty_table(
+            self, file: TextIO, separator: str = ' ',
             print_report_header: bool = True,
             merge_unit_columns: bool = False, #TODO join columns
             align: Union[None,
@@ -189,7 +347,9 @@ class Report_Processor:
                 Literal['center'],
                 Literal['right']
                 ] = None,
-    ) -> str:
+    ) -> None:
+        '''Write the table line by line: the column widths are measured
+        in a first pass over the entries, the rows rendered in a second.'''
         #TODO: recreate `tshark's` statistics output
         # (like in `-q -z [endpoints|conv],{proto}`)
         column_widths = self.calculate_column_widths()
@@ -203,21 +363,31 @@ class Report_Processor:
                 elif align == 'center': return str.center
                 else: return str.ljust
 
-        header_row = separator.join(str.ljust(k, column_widths[k])
-                                    for k in self.entries[0].as_dict.keys())
+        if print_report_header:
+            file.write(f"{self.header}\n{self.filter}\n")
+        file.write(separator.join(str.ljust(k, w) for k, w in column_widths.items()) + '\n')
         # header_row = separator.join(
         #     _get_alignment_func(k)(k, column_widths[k])
-        #     for k in self.entries[0].as_dict.keys())
-        entry_rows = []
-        for entry in self.entries:
-            entry_rows.append(separator.join(
-                _get_alignment_func(k)(str(v), column_widths[k])
-                for k, v in entry.as_dict.items()))
-        if print_report_header:
-            table_list = [self.header, self.filter, header_row, *entry_rows]
-        else:
-            table_list = [header_row, *entry_rows]
-        return '\n'.join(table_list)
+        #     for k in column_widths.keys())
+        columns = [(_get_alignment_func(k), w) for k, w in column_widths.items()]
+        for row in self.iterate_rows():
+            file.write(separator.join(
+                justify(str(v), w) for (justify, w), v in zip(columns, row)) + '\n')
+
+    def to_pretty_table(
+            self, separator: str = ' ',
+            print_report_header: bool = True,
+            merge_unit_columns: bool = False, #TODO join columns
+            align: Union[None,
+                Literal['left'],
+                Literal['center'],
+                Literal['right']
+                ] = None,
+    ) -> str:
+        output = io.StringIO()
+        self.write_pretty_table(output, separator, print_report_header,
+                                merge_unit_columns, align)
+        return output.getvalue().removesuffix('\n')
 
     @classmethod
     def from_csv(cls, csv_str: str) -> Union[Conversation_Report, Endpoint_Report]:
@@ -232,42 +402,68 @@ class Report_Processor:
         filter_line = next(reader)[0]
         filter_value = '' if filter_line.startswith('Filter:<No Filter>') else filter_line.split(':', 1)[1]
         field_names = next(reader)
+        item_class = cls.Classes_dict[header]
+        converters = [get_converter(item_class.__annotations__[k]) for k in field_names]
         items = []
         for row in reader:
-            item_data = {field: row[i] for i, field in enumerate(field_names)}
-            item_class = cls.Classes_dict[header]
             item = item_class(**{
-                k: cast_value(v, item_class.__annotations__[k])
-                for k, v in item_data.items()
+                k: convert(v) for k, convert, v in zip(field_names, converters, row)
             })
             items.append(item)
         return resulting_class(header=header, filter=filter_value, **{list_key: items})
 
-    def to_csv(self, dialect='excel') -> str:
-        output = io.StringIO()
-        writer = csv.writer(output, dialect)
+    def write_csv(self, file: TextIO, dialect='excel') -> None:
+        writer = csv.writer(file, dialect)
         writer.writerow([self.header])
         writer.writerow([f"Filter:{self.filter if self.filter != '' else '<No Filter>'}"])
         if self.entries:
-            writer.writerow(self.entries[0].__annotations__.keys())
-        for entry in self.entries:
-            writer.writerow([
-                str(getattr(entry, k))
-                if isinstance(getattr(entry, k), (IPv4Address, IPv6Address))
-                else getattr(entry, k)
-                for k in entry.__annotations__.keys()
-            ])
+            writer.writerow(self.entry_fields)
+        writer.writerows(self.iterate_rows())
+
+    def to_csv(self, dialect='excel') -> str:
+        output = io.StringIO()
+        self.write_csv(output, dialect)
         return output.getvalue()
 
+    def write_ndjson(self, file: TextIO) -> None:
+        '''One json object per entry and line.'''
+        names = self.entry_fields
+        for row in self.iterate_rows():
+            file.write(json.dumps(dict(zip(names, row)), ensure_ascii=False) + '\n')
+
+    def to_columns(self):
+        '''The entries as a `Columns.Report_Columns`.'''
+        from .Columns import Report_Columns
+        return Report_Columns.from_report(self)
+
     @property
     def as_dict(self) -> Dict[str, Any]: return asdict(self)
     def to_stringified_dict(self): return obj_to_stringified_dict(self)
+    def write_json(self, file: TextIO, indent: Union[None, int, str] = None) -> None:
+        '''Same output as `to_json`, written entry by entry.'''
+        if   isinstance(self, Endpoint_Report):     list_key = 'endpoints'
+        elif isinstance(self, Conversation_Report): list_key = 'conversations'
+        else: raise ValueError("Unknown report type")
+        if indent is None:
+            start, line, item, end = '{', ' ', '', '}'
+        else:
+            step = ' ' * indent if isinstance(indent, int) else indent
+            line, item = '\n' + step, '\n' + step * 2
+            start, end = '{' + line, '\n}'
+        dumps = partial(json.dumps, ensure_ascii=False)
+        file.write(f'{start}"header": {dumps(self.header)},{line}'
+                   f'"filter": {dumps(self.filter)},{line}"{list_key}": [')
+        names, prefix = self.entry_fields, item
+        for row in self.iterate_rows():
+            file.write(prefix + dumps(dict(zip(names, row)), indent=indent).replace('\n', item))
+            prefix = ',' + (item or ' ')
+        if indent is not None and prefix != item: file.write(line)
+        file.write(']' + end)
+
     def to_json(self, indent: Optional[int] = None) -> str:
-        # if   isinstance(self, Endpoint_Report):     list_key = 'endpoints'
-        # elif isinstance(self, Conversation_Report): list_key = 'conversations'
-        # else: raise ValueError("Unknown report type")
-        obj = self.to_stringified_dict()
-        return json.dumps(obj, indent=indent, ensure_ascii=False)
+        output = io.StringIO()
+        self.write_json(output, indent)
+        return output.getvalue()
 
     @classmethod
     def from_json(cls, json_str: str) -> Union[Conversation_Report, Endpoint_Report]:
@@ -277,12 +473,12 @@ class Report_Processor:
         elif isinstance(data, dict) and 'conversations' in data:
             list_key = 'conversations'; init_class = Conversation_Report
         else: raise ValueError("Invalid JSON structure")
+        item_class = cls.Classes_dict[data['header']]
+        converters = {k: get_converter(T) for k, T in item_class.__annotations__.items()}
         items = []
         for item_data in data[list_key]:
-            item_class = cls.Classes_dict[data['header']]
             item = item_class(**{
-                k: cast_value(v, item_class.__annotations__[k])
-                for k, v in item_data.items()
+                k: converters[k](v) for k, v in item_data.items()
             })
             items.append(item)
         return init_class(header=data['header'], filter=data['filter'], **{list_key: items})
@@ -0,0 +1,325 @@
+'''Columnar storage of tshark statistics reports.
+
+Every field of the entries of a report is one column: integers and
+floats in NumPy arrays (or `array` arrays without NumPy), addresses as
+integers split into version, high and low 64 bits, other strings in
+lists. Sorting, filtering, top-N and aggregation work on the columns;
+row objects (`TCP_Conversation`, ...) are only built when asked for.
+'''
+
+import io
+import csv
+import heapq
+from array import array
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+from ipaddress import IPv4Address, IPv6Address
+
+from .Classes import Report_Processor, Endpoint_Report, Conversation_Report
+from ...net_tools import Prefix_Set
+
+try:
+    import numpy as np
+    Columns_Provider = 'numpy'
+except ImportError:
+    Columns_Provider = 'python'
+
+ADDRESS = Union[IPv4Address, IPv6Address]
+_MASK_64 = (1 << 64) - 1
+_TYPECODES = {int: 'q', float: 'd'}
+_DTYPES = {'q': 'int64', 'd': 'float64', 'B': 'uint8', 'Q': 'uint64'}
+
+
+def _new_column(field_type) -> Any:
+    if field_type == ADDRESS:
+        return array('B'), array('Q'), array('Q')
+    if field_type in _TYPECODES:
+        return array(_TYPECODES[field_type])
+    return []
+
+
+def _finish_column(column: Any) -> Any:
+    if Columns_Provider != 'numpy':
+        return column
+    if isinstance(column, tuple):
+        return tuple(_finish_column(part) for part in column)
+    if isinstance(column, array):
+        return np.frombuffer(column, dtype=_DTYPES[column.typecode]) if len(column) else \
+            np.empty(0, dtype=_DTYPES[column.typecode])
+    return np.array(column, dtype=object)
+
+
+def _address(version: int, high: int, low: int) -> ADDRESS:
+    return IPv4Address(low) if version == 4 else IPv6Address((high << 64) | low)
+
+
+class Report_Columns:
+    '''Entries of one report page as columns. Built by `from_report`, from
+    tshark's output by `iterate_report_columns`, or by a report's
+    `to_columns`. Operations returning reports of rows return new
+    `Report_Columns` sharing nothing with the original one.'''
+
+    __slots__ = ('Report_class', 'Item_class', 'header', 'filter', 'columns', 'length')
+
+    def __init__(self, Report_class: type, Item_class: type, header: str, filter: str,
+                 columns: Dict[str, Any], length: int) -> None:
+        self.Report_class, self.Item_class = Report_class, Item_class
+        self.header, self.filter = header, filter
+        self.columns, self.length = columns, length
+
+    @property
+    def fields(self) -> Dict[str, Any]:
+        return self.Item_class.__annotations__
+
+    @classmethod
+    def from_rows(cls, Report_class: type, Item_class: type, header: str, filter: str,
+                  rows: Iterable[Sequence[Any]]) -> 'Report_Columns':
+        fields = Item_class.__annotations__
+        columns = [_new_column(field_type) for field_type in fields.values()]
+        length = 0
+        for values in rows:
+            for column, value in zip(columns, values):
+                if isinstance(column, tuple):
+                    integer = int(value)
+                    column[0].append(value.version)
+                    column[1].append(integer >> 64)
+                    column[2].append(integer & _MASK_64)
+                else:
+                    column.append(value)
+            length += 1
+        return cls(Report_class, Item_class, header, filter,
+                   {name: _finish_column(column) for name, column in zip(fields, columns)},
+                   length)
+
+    @classmethod
+    def from_report(cls, report: Union[Endpoint_Report, Conversation_Report]) -> 'Report_Columns':
+        Item_class = report.Classes_dict[report.header]
+        fields = list(Item_class.__annotations__)
+        return cls.from_rows(
+            type(report), Item_class, report.header, report.filter,
+            ([getattr(entry, name) for name in fields] for entry in report.entries))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def column(self, name: str) -> Any:
+        '''The column of a field; `(versions, high bits, low bits)` for addresses.'''
+        return self.columns[name]
+
+    # Row materialization
+
+    def _values(self, index: int) -> List[Any]:
+        values = []
+        for column in self.columns.values():
+            if isinstance(column, tuple):
+                values.append(_address(*(int(part[index]) for part in column)))
+            else:
+                value = column[index]
+                values.append(value.item() if hasattr(value, 'item') else value)
+        return values
+
+    def row(self, index: int) -> Any:
+        if not -self.length <= index < self.length:
+            raise IndexError("Row index out of range.")
+        return self.Item_class(*self._values(index % self.length))
+
+    def rows(self) -> Iterator[Any]:
+        return (self.Item_class(*self._values(index)) for index in range(self.length))
+
+    __iter__ = rows
+
+    def to_report(self) -> Union[Endpoint_Report, Conversation_Report]:
+        return self.Report_class(self.header, self.filter, list(self.rows()))
+
+    # Selection
+
+    def take(self, indices: Iterable[int]) -> 'Report_Columns':
+        '''New columns of the rows at `indices`, in that order.'''
+        if Columns_Provider == 'numpy':
+            indices = np.asarray(indices, dtype=np.intp)
+            def _take(column):
+                if isinstance(column, tuple):
+                    return tuple(part[indices] for part in column)
+                return column[indices]
+            length = len(indices)
+        else:
+            indices = list(indices)
+            def _take(column):
+                if isinstance(column, tuple):
+                    return tuple(_take(part) for part in column)
+                if isinstance(column, array):
+                    return array(column.typecode, (column[i] for i in indices))
+                return [column[i] for i in indices]
+            length = len(indices)
+        return Report_Columns(self.Report_class, self.Item_class, self.header, self.filter,
+                              {name: _take(column) for name, column in self.columns.items()},
+                              length)
+
+    def select(self, mask: Sequence[bool]) -> 'Report_Columns':
+        '''Rows where `mask` (e.g. `columns.column('bytes') > 10**6`) is true.'''
+        if Columns_Provider == 'numpy':
+            return self.take(np.flatnonzero(np.asarray(mask, dtype=bool)))
+        return self.take(index for index, keep in enumerate(mask) if keep)
+
+    def where(self, name: str, predicate: Callable[[Any], bool]) -> 'Report_Columns':
+        '''Rows whose value of a non-address field satisfies `predicate`.'''
+        return self.select([bool(predicate(value)) for value in self.columns[name]])
+
+    def in_networks(self, name: str, networks: Union[Prefix_Set, Iterable[Any]]) -> Sequence[bool]:
+        '''Mask of the rows whose address field is in any of `networks`.'''
+        if not isinstance(networks, Prefix_Set):
+            networks = Prefix_Set(networks)
+        versions, highs, lows = self.columns[name]
+        if Columns_Provider == 'numpy':
+            mask = np.zeros(self.length, dtype=bool)
+            v4 = versions == 4
+            firsts, lasts = (np.array(bounds, dtype=np.uint64) for bounds in
+                             zip(*networks.ranges(4))) if 4 in networks.versions else ((), ())
+            if len(firsts):
+                # IPv4 ranges fit into the low bits: one binary search per row.
+                i = np.searchsorted(firsts, lows, side='right') - 1
+                mask |= v4 & (i >= 0) & (lows <= lasts[np.maximum(i, 0)])
+            for first, last in networks.ranges(6):
+                first_high, first_low = np.uint64(first >> 64), np.uint64(first & _MASK_64)
+                last_high, last_low = np.uint64(last >> 64), np.uint64(last & _MASK_64)
+                mask |= ~v4 \
+                    & ((highs > first_high) | ((highs == first_high) & (lows >= first_low))) \
+                    & ((highs < last_high) | ((highs == last_high) & (lows <= last_low)))
+            return mask
+        return [_address(version, high, low) in networks
+                for version, high, low in zip(versions, highs, lows)]
+
+    # Ordering
+
+    def _sort_columns(self, names: Sequence[str]) -> List[Any]:
+        '''Numeric columns ordering rows like their fields, most significant first.'''
+        columns = []
+        for name in names:
+            column = self.columns[name]
+            if isinstance(column, tuple):
+                columns.extend(column)
+            elif column.dtype == object:
+                columns.append(np.unique(column.astype(str), return_inverse=True)[1])
+            else:
+                columns.append(column)
+        return columns
+
+    def _python_key(self, names: Sequence[str]) -> Callable[[int], tuple]:
+        columns = [self.columns[name] for name in names]
+        def key(index: int) -> tuple:
+            return tuple(part for column in columns
+                         for part in ((column[0][index], column[1][index], column[2][index])
+                                      if isinstance(column, tuple) else (column[index],)))
+        return key
+
+    def order(self, key: Union[str, Sequence[str]], reverse: bool = False) -> Sequence[int]:
+        '''Stable order of row indices by one or more fields (addresses by
+        version, then value). With `reverse` equal rows keep their order.'''
+        names = [key] if isinstance(key, str) else list(key)
+        if Columns_Provider == 'numpy':
+            columns = self._sort_columns(names)
+            if not reverse:
+                return np.lexsort(columns[::-1])
+            order = np.lexsort([column[::-1] for column in columns[::-1]])
+            return (self.length - 1 - order)[::-1]
+        return sorted(range(self.length), key=self._python_key(names), reverse=reverse)
+
+    def sort(self, key: Union[str, Sequence[str]], reverse: bool = False) -> 'Report_Columns':
+        return self.take(self.order(key, reverse))
+
+    def top(self, n: int, key: Union[str, Sequence[str]], reverse: bool = True) -> 'Report_Columns':
+        '''First `n` rows of `sort(key, reverse)` (largest by default)
+        without sorting all of them.'''
+        n = max(0, min(n, self.length))
+        names = [key] if isinstance(key, str) else list(key)
+        if Columns_Provider == 'numpy':
+            column = self.columns[names[0]]
+            if len(names) > 1 or isinstance(column, tuple) or column.dtype == object or n == 0:
+                return self.take(self.order(names, reverse)[:n])
+            # Every row tied with the n-th one is a candidate, so the
+            # result is the same as with the full sort.
+            kth = self.length - n if reverse else n - 1
+            threshold = np.partition(column, kth)[kth]
+            candidates = np.flatnonzero(column >= threshold if reverse else column <= threshold)
+            values = column[candidates]
+            return self.take(candidates[np.argsort(-values if reverse else values, kind='stable')][:n])
+        key_function = self._python_key(names)
+        # Ties go by index, like in the stable sort.
+        if reverse:
+            indices = heapq.nlargest(n, range(self.length), key=lambda i: (key_function(i), -i))
+        else:
+            indices = heapq.nsmallest(n, range(self.length), key=lambda i: (key_function(i), i))
+        return self.take(indices)
+
+    # Aggregation
+
+    def aggregate(
+            self, by: Union[str, Sequence[str]], fields: Optional[Sequence[str]] = None
+    ) -> Dict[tuple, Dict[str, Union[int, float]]]:
+        '''Sums of numeric `fields` (all by default) and the number of rows
+        for every distinct value of the `by` fields, in their order.'''
+        names = [by] if isinstance(by, str) else list(by)
+        if fields is None:
+            fields = [name for name, field_type in self.fields.items()
+                      if field_type in _TYPECODES and name not in names]
+        result = {}
+        if self.length == 0:
+            return result
+        order = self.order(names)
+        if Columns_Provider == 'numpy':
+            keys = [column[order] for column in self._sort_columns(names)]
+            starts = np.flatnonzero(np.concatenate(
+                ([True], np.any([k[1:] != k[:-1] for k in keys], axis=0))))
+            counts = np.diff(np.append(starts, self.length))
+            sums = {name: np.add.reduceat(self.columns[name][order], starts).tolist() for name in fields}
+            for group, (start, count) in enumerate(zip(starts.tolist(), counts.tolist())):
+                values = self._values(int(order[start]))
+                group_key = tuple(values[list(self.fields).index(name)] for name in names)
+                result[group_key] = {'count': count, **{name: sums[name][group] for name in fields}}
+            return result
+        positions = [list(self.fields).index(name) for name in names]
+        key_function = self._python_key(names)
+        previous = None
+        for index in order:
+            sort_key = key_function(index)
+            if sort_key != previous:
+                values = self._values(index)
+                sums = result[tuple(values[p] for p in positions)] = \
+                    {'count': 0, **{name: 0 for name in fields}}
+                previous = sort_key
+            sums['count'] += 1
+            for name in fields:
+                sums[name] += self.columns[name][index]
+        return result
+
+    # Export
+
+    def write_csv(self, file: TextIO, dialect='excel') -> None:
+        '''Same output as the `write_csv` of the report.'''
+        writer = csv.writer(file, dialect)
+        writer.writerow([self.header])
+        writer.writerow([f"Filter:{self.filter if self.filter != '' else '<No Filter>'}"])
+        if self.length:
+            writer.writerow(self.fields.keys())
+        columns = []
+        for column in self.columns.values():
+            if isinstance(column, tuple):
+                columns.append([str(_address(*parts)) for parts in zip(
+                    *(part.tolist() if hasattr(part, 'tolist') else part for part in column))])
+            else:
+                columns.append(column.tolist() if hasattr(column, 'tolist') else column)
+        writer.writerows(zip(*columns))
+
+    def to_csv(self, dialect='excel') -> str:
+        output = io.StringIO()
+        self.write_csv(output, dialect)
+        return output.getvalue()
+
+
+def iterate_report_columns(lines: Iterable[str]) -> Iterator[Report_Columns]:
+    '''`Report_Processor.iterate_reports` building columns instead of row
+    objects.'''
+    for Report_class, Item_class, header, report_filter, entry_lines in \
+            Report_Processor.iterate_pages(lines):
+        yield Report_Columns.from_rows(
+            Report_class, Item_class, header, report_filter,
+            (Item_class.parse_values(line) for line in entry_lines))
@@ -0,0 +1,446 @@
+'''Persistent SQLite store of the endpoint and conversation statistics of
+packet captures.
+
+Captures are recognized by path, size and modification time first, and
+by the sha256 of their content (the `SHA256` capinfos reports) if those
+changed, so every capture is dissected once per set of protocols and
+display filter. The parsed reports are kept per capture: they are
+returned as they were collected, or merged across captures and rolled up
+per endpoint, per conversation and per time bucket in SQL.
+
+Conversation byte counts of tshark are rounded to the unit it prints
+(`bytes`, `kB`, ...); roll-ups convert them to bytes, so they are exact
+only for counts reported in bytes.
+'''
+
+import time
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .Classes import Report_Processor, Endpoint_Report, Conversation_Report
+from .functions import collect_reports
+from ..common import PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS
+from ..Pcap.Index import file_checksum
+from ..Pcap.functions import get_timestamp_of_first_frame
+from ...tools import row_converter
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    checksum TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    -- timestamp of the first frame, the origin of `relative_start`
+    start_time REAL,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS captures_by_path ON captures (path, size, mtime);
+CREATE TABLE IF NOT EXISTS collections (
+    id INTEGER PRIMARY KEY,
+    capture_id INTEGER NOT NULL REFERENCES captures (id) ON DELETE CASCADE,
+    protos TEXT NOT NULL,
+    display_filter TEXT NOT NULL,
+    collected_at REAL NOT NULL,
+    UNIQUE (capture_id, protos, display_filter)
+);
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    collection_id INTEGER NOT NULL REFERENCES collections (id) ON DELETE CASCADE,
+    header TEXT NOT NULL,
+    filter TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reports_by_collection ON reports (collection_id);
+CREATE TABLE IF NOT EXISTS endpoints (
+    report_id INTEGER NOT NULL REFERENCES reports (id) ON DELETE CASCADE,
+    address TEXT NOT NULL, port INTEGER,
+    packets INTEGER, bytes INTEGER,
+    tx_packets INTEGER, tx_bytes INTEGER,
+    rx_packets INTEGER, rx_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS endpoints_by_report ON endpoints (report_id);
+CREATE TABLE IF NOT EXISTS conversations (
+    report_id INTEGER NOT NULL REFERENCES reports (id) ON DELETE CASCADE,
+    address_A TEXT NOT NULL, port_A INTEGER,
+    address_B TEXT NOT NULL, port_B INTEGER,
+    frames_to_A INTEGER, bytes_to_A INTEGER, units_to_A TEXT,
+    frames_to_B INTEGER, bytes_to_B INTEGER, units_to_B TEXT,
+    total_frames INTEGER, total_bytes INTEGER, total_units TEXT,
+    relative_start REAL, duration REAL
+);
+CREATE INDEX IF NOT EXISTS conversations_by_report ON conversations (report_id);
+'''
+
+ENDPOINT_COLUMNS = (
+    'address', 'port', 'packets', 'bytes',
+    'tx_packets', 'tx_bytes', 'rx_packets', 'rx_bytes')
+CONVERSATION_COLUMNS = (
+    'address_A', 'port_A', 'address_B', 'port_B',
+    'frames_to_A', 'bytes_to_A', 'units_to_A',
+    'frames_to_B', 'bytes_to_B', 'units_to_B',
+    'total_frames', 'total_bytes', 'total_units',
+    'relative_start', 'duration')
+
+# Size units of tshark's conversation tables (SI prefixes).
+UNITS = {'bytes': 1, 'kB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12, 'PB': 10**15}
+
+
+def _in_bytes(value: str, units: str) -> str:
+    '''SQL expression of a byte count reported in `units`.'''
+    cases = ' '.join(f"WHEN '{unit}' THEN {factor}" for unit, factor in UNITS.items() if factor != 1)
+    return f"{value} * (CASE {units} {cases} ELSE 1 END)"
+
+
+def _protos_key(proto: Union[str, Iterable[str]]) -> str:
+    protos = proto.split(',') if isinstance(proto, str) else proto
+    return ','.join(sorted({p.strip() for p in protos if p.strip()}))
+
+
+# Conversations are oriented so that address A sorts before address B,
+# the same conversation may be seen from both sides in different captures.
+_ORIENTED_CONVERSATIONS = f'''
+SELECT header, start_time,
+    CASE WHEN swap THEN address_B ELSE address_A END AS a,
+    CASE WHEN swap THEN port_B ELSE port_A END AS port_a,
+    CASE WHEN swap THEN address_A ELSE address_B END AS b,
+    CASE WHEN swap THEN port_A ELSE port_B END AS port_b,
+    CASE WHEN swap THEN frames_to_B ELSE frames_to_A END AS frames_to_a,
+    CASE WHEN swap THEN bytes_b ELSE bytes_a END AS bytes_to_a,
+    CASE WHEN swap THEN frames_to_A ELSE frames_to_B END AS frames_to_b,
+    CASE WHEN swap THEN bytes_a ELSE bytes_b END AS bytes_to_b,
+    COALESCE(start_time, 0) + relative_start AS first_seen,
+    COALESCE(start_time, 0) + relative_start + duration AS last_seen
+FROM (
+    SELECT r.header, k.start_time, x.*,
+        {_in_bytes('x.bytes_to_A', 'x.units_to_A')} AS bytes_a,
+        {_in_bytes('x.bytes_to_B', 'x.units_to_B')} AS bytes_b,
+        (x.address_A > x.address_B OR (x.address_A = x.address_B
+         AND IFNULL(x.port_A, 0) > IFNULL(x.port_B, 0))) AS swap
+    FROM conversations x
+    JOIN reports r ON x.report_id = r.id
+    JOIN collections c ON r.collection_id = c.id
+    JOIN captures k ON c.capture_id = k.id
+    {{where}}
+)'''
+
+
+class Stats_Store:
+
+    def __init__(self, database_path: Union[str, Path]) -> None:
+        self.database_path = Path(database_path)
+        self.database_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.database_path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> 'Stats_Store':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _capture_id(self, path: Path) -> int:
+        '''Id of the capture, added to the store if it is not known yet.'''
+        stat = path.stat()
+        known = self.connection.execute(
+            'SELECT id FROM captures WHERE path = ? AND size = ? AND mtime = ?',
+            (str(path), stat.st_size, stat.st_mtime)).fetchone()
+        if known:
+            return known[0]
+        checksum = file_checksum(path)
+        known = self.connection.execute(
+            'SELECT id, path FROM captures WHERE checksum = ?', (checksum,)).fetchone()
+        with self.connection:
+            # The path was rewritten with other content, forget the old one.
+            self.connection.execute(
+                'DELETE FROM captures WHERE path = ? AND checksum != ?', (str(path), checksum))
+            if known:
+                # The same capture moved or touched, not just copied.
+                if known[1] == str(path) or not Path(known[1]).exists():
+                    self.connection.execute(
+                        'UPDATE captures SET path = ?, size = ?, mtime = ? WHERE id = ?',
+                        (str(path), stat.st_size, stat.st_mtime, known[0]))
+                return known[0]
+            try:
+                start_time = get_timestamp_of_first_frame(path)
+            except Exception:
+                # A format only tshark reads
+                start_time = None
+            return self.connection.execute(
+                'INSERT INTO captures (checksum, path, size, mtime, start_time, added_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (checksum, str(path), stat.st_size, stat.st_mtime,
+                 start_time and start_time.timestamp(), time.time())).lastrowid
+
+    def _collection_id(
+            self, capture_id: int, protos: str, display_filter: str
+    ) -> Optional[int]:
+        known = self.connection.execute(
+            'SELECT id FROM collections WHERE capture_id = ? AND protos = ? AND display_filter = ?',
+            (capture_id, protos, display_filter)).fetchone()
+        return known and known[0]
+
+    def collect_reports(
+            self, pcap_file_path: Union[str, Path],
+            proto=PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
+            display_filter: Optional[str] = None,
+            backend: str = 'auto'
+    ) -> List[Union[Conversation_Report, Endpoint_Report]]:
+        '''`functions.collect_reports` collecting every capture once.'''
+        reports, _ = self._collect(Path(pcap_file_path).resolve(), proto, display_filter, backend)
+        return reports
+
+    def _collect(
+            self, path: Path, proto, display_filter: Optional[str], backend: str
+    ) -> Tuple[List[Union[Conversation_Report, Endpoint_Report]], bool]:
+        capture_id = self._capture_id(path)
+        protos, display_filter = _protos_key(proto), display_filter or ''
+        collection_id = self._collection_id(capture_id, protos, display_filter)
+        if collection_id is not None:
+            return self._load_reports(collection_id), False
+        reports = collect_reports(str(path), proto, display_filter or None, backend)
+        with self.connection:
+            collection_id = self.connection.execute(
+                'INSERT INTO collections (capture_id, protos, display_filter, collected_at)'
+                ' VALUES (?, ?, ?, ?)',
+                (capture_id, protos, display_filter, time.time())).lastrowid
+            for report in reports:
+                self._store_report(collection_id, report)
+        return reports, True
+
+    def add_captures(
+            self, pcap_file_paths: Iterable[Union[str, Path]],
+            proto=PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
+            display_filter: Optional[str] = None,
+            backend: str = 'auto'
+    ) -> Tuple[List[Path], List[Path]]:
+        '''Collect the statistics of captures which are not collected yet,
+        return the lists of collected and skipped ones.'''
+        collected, skipped = [], []
+        for path in (Path(p).resolve() for p in pcap_file_paths):
+            _, is_new = self._collect(path, proto, display_filter, backend)
+            (collected if is_new else skipped).append(path)
+        return collected, skipped
+
+    def _store_report(
+            self, collection_id: int, report: Union[Conversation_Report, Endpoint_Report]
+    ) -> None:
+        report_id = self.connection.execute(
+            'INSERT INTO reports (collection_id, header, filter) VALUES (?, ?, ?)',
+            (collection_id, report.header, report.filter)).lastrowid
+        table, columns = ('endpoints', ENDPOINT_COLUMNS) \
+            if isinstance(report, Endpoint_Report) else ('conversations', CONVERSATION_COLUMNS)
+        fields = report.entry_fields
+        positions = [fields.index(c) if c in fields else None for c in columns]
+        self.connection.executemany(
+            f"INSERT INTO {table} VALUES (?, {', '.join('?' * len(columns))})",
+            ((report_id, *(None if p is None else row[p] for p in positions))
+             for row in report.iterate_rows()))
+
+    def _load_reports(
+            self, collection_id: int
+    ) -> List[Union[Conversation_Report, Endpoint_Report]]:
+        reports = []
+        for report_id, header, report_filter in self.connection.execute(
+                'SELECT id, header, filter FROM reports WHERE collection_id = ? ORDER BY id',
+                (collection_id,)).fetchall():
+            Report_class, Item_class = Report_Processor.page_classes(header)
+            table = 'endpoints' if Report_class is Endpoint_Report else 'conversations'
+            convert = row_converter(Item_class.__annotations__.values())
+            rows = self.connection.execute(
+                f"SELECT {', '.join(Item_class.__annotations__)} FROM {table}"
+                ' WHERE report_id = ? ORDER BY rowid', (report_id,))
+            reports.append(Report_class(
+                header, report_filter, [Item_class(*convert(row)) for row in rows]))
+        return reports
+
+    def _selection(
+            self, proto, display_filter: Optional[str],
+            checksums: Optional[Iterable[str]], since: Optional[float], until: Optional[float]
+    ) -> Tuple[str, list]:
+        '''Captures collected with `proto` and `display_filter`, of the
+        `checksums` and with their first frame in `[since, until)`.'''
+        conditions = ['c.protos = ?', 'c.display_filter = ?']
+        parameters: List[Any] = [_protos_key(proto), display_filter or '']
+        if checksums is not None:
+            checksums = list(checksums)
+            conditions.append(f"k.checksum IN ({', '.join('?' * len(checksums))})")
+            parameters.extend(checksums)
+        if since is not None:
+            conditions.append('k.start_time >= ?'); parameters.append(since)
+        if until is not None:
+            conditions.append('k.start_time < ?'); parameters.append(until)
+        return ' WHERE ' + ' AND '.join(conditions), parameters
+
+    def merged_reports(
+            self,
+            proto=PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
+            display_filter: Optional[str] = None,
+            checksums: Optional[Iterable[str]] = None,
+            since: Optional[float] = None,
+            until: Optional[float] = None
+    ) -> List[Union[Conversation_Report, Endpoint_Report]]:
+        '''Reports of the selected captures (see `_selection`) merged into
+        one per header: packets, frames and bytes are summed per endpoint
+        and per conversation, conversations span from their first to their
+        last frame in any capture. Byte counts are in `bytes`, starts
+        relative to the first frame of the earliest capture.'''
+        where, parameters = self._selection(proto, display_filter, checksums, since, until)
+        origin = self.connection.execute(
+            'SELECT MIN(k.start_time) FROM captures k JOIN collections c'
+            f' ON c.capture_id = k.id{where}', parameters).fetchone()[0] or 0
+        reports, appenders = {}, {}
+        for header, report_filter in self.connection.execute(
+                'SELECT DISTINCT r.header, r.filter FROM reports r'
+                ' JOIN collections c ON r.collection_id = c.id'
+                f' JOIN captures k ON c.capture_id = k.id{where} ORDER BY r.id', parameters):
+            if header not in reports:
+                Report_class, _ = Report_Processor.page_classes(header)
+                reports[header] = Report_class(header, report_filter, [])
+                appenders[header] = self._entry_appender(reports[header])
+
+        endpoints = self.connection.execute(
+            'SELECT r.header, e.address, e.port, SUM(e.packets), SUM(e.bytes),'
+            ' SUM(e.tx_packets), SUM(e.tx_bytes), SUM(e.rx_packets), SUM(e.rx_bytes)'
+            ' FROM endpoints e JOIN reports r ON e.report_id = r.id'
+            ' JOIN collections c ON r.collection_id = c.id'
+            f' JOIN captures k ON c.capture_id = k.id{where}'
+            ' GROUP BY r.header, e.address, e.port ORDER BY MIN(e.rowid)', parameters)
+        for header, address, port, *counters in endpoints:
+            appenders[header]([address, port, *counters])
+
+        conversations = self.connection.execute(
+            'SELECT header, a, port_a, b, port_b, SUM(frames_to_a), SUM(bytes_to_a),'
+            ' SUM(frames_to_b), SUM(bytes_to_b), MIN(first_seen), MAX(last_seen)'
+            f' FROM ({_ORIENTED_CONVERSATIONS.format(where=where)})'
+            ' GROUP BY header, a, port_a, b, port_b ORDER BY MIN(first_seen)', parameters)
+        for header, a, port_a, b, port_b, to_a, bytes_a, to_b, bytes_b, first, last in conversations:
+            appenders[header]([
+                a, port_a, b, port_b,
+                to_a, bytes_a, 'bytes', to_b, bytes_b, 'bytes',
+                to_a + to_b, bytes_a + bytes_b, 'bytes',
+                round(first - origin, 6), round(last - first, 4)])
+        return list(reports.values())
+
+    @staticmethod
+    def _entry_appender(
+            report: Union[Conversation_Report, Endpoint_Report]
+    ) -> Callable[[list], None]:
+        '''Append an entry of values in the order of the store's columns
+        (`None` ports of entries without them are dropped).'''
+        Item_class = report.entry_class
+        columns = ENDPOINT_COLUMNS if isinstance(report, Endpoint_Report) else CONVERSATION_COLUMNS
+        positions = [n for n, c in enumerate(columns) if c in Item_class.__annotations__]
+        convert = row_converter(Item_class.__annotations__.values())
+        def append(values: list) -> None:
+            report.entries.append(Item_class(*convert([values[p] for p in positions])))
+        return append
+
+    def conversation_buckets(
+            self, bucket: float,
+            proto=PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
+            display_filter: Optional[str] = None,
+            checksums: Optional[Iterable[str]] = None,
+            since: Optional[float] = None,
+            until: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        '''Number of conversations, their frames and bytes per header and
+        time bucket of `bucket` seconds. A conversation counts in the bucket
+        it starts in; captures with no known start time are left out.'''
+        if bucket <= 0:
+            raise ValueError("The bucket size must be positive.")
+        where, parameters = self._selection(proto, display_filter, checksums, since, until)
+        rows = self.connection.execute(
+            'SELECT header, CAST(first_seen / ? AS INTEGER) * ? AS time_bucket, COUNT(*),'
+            ' SUM(frames_to_a + frames_to_b), SUM(bytes_to_a + bytes_to_b)'
+            f' FROM ({_ORIENTED_CONVERSATIONS.format(where=where)})'
+            ' WHERE start_time IS NOT NULL'
+            ' GROUP BY header, time_bucket ORDER BY header, time_bucket',
+            [bucket, bucket, *parameters])
+        return [{'header': header, 'bucket': time_bucket, 'conversations': count,
+                 'frames': frames, 'bytes': total_bytes}
+                for header, time_bucket, count, frames, total_bytes in rows]
+
+    def remove_missing_captures(self) -> int:
+        '''Forget captures whose files do not exist anymore.'''
+        missing = [(capture_id,) for capture_id, path in
+                   self.connection.execute('SELECT id, path FROM captures')
+                   if not Path(path).exists()]
+        with self.connection:
+            self.connection.executemany('DELETE FROM captures WHERE id = ?', missing)
+        return len(missing)
+
+    def captures(self) -> List[Dict[str, Any]]:
+        rows = self.connection.execute(
+            'SELECT path, checksum, size, start_time, added_at,'
+            ' (SELECT COUNT(*) FROM collections WHERE capture_id = captures.id)'
+            ' FROM captures ORDER BY start_time, path')
+        return [{'path': path, 'checksum': checksum, 'size': size,
+                 'start_time': start_time, 'added_at': added_at, 'collections': count}
+                for path, checksum, size, start_time, added_at, count in rows]
+
+
+def test_stats_store() -> None:
+    import tempfile
+    from ..Pcap.Classes import Pcap_Writer, IPPROTO_TCP, IPPROTO_UDP
+    from ..Pcap.functions import build_ethernet_frame
+
+    hour = 1700000000.0
+    captures = {
+        'a.pcap': [
+            (hour + 1, build_ethernet_frame('10.0.0.1', '1.1.1.1', IPPROTO_TCP, 50000, 443)),
+            (hour + 2, build_ethernet_frame('1.1.1.1', '10.0.0.1', IPPROTO_TCP, 443, 50000, b'x' * 100)),
+            (hour + 3, build_ethernet_frame('10.0.0.1', '8.8.8.8', IPPROTO_UDP, 53000, 53, b'q' * 30))],
+        # the same conversation, first seen from the other side
+        'b.pcap': [
+            (hour + 3601, build_ethernet_frame('1.1.1.1', '10.0.0.1', IPPROTO_TCP, 443, 50000, b'y' * 10)),
+            (hour + 3605, build_ethernet_frame('10.0.0.1', '1.1.1.1', IPPROTO_TCP, 50000, 443))]}
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        for name, frames in captures.items():
+            with Pcap_Writer(directory / name) as writer:
+                for timestamp, data in frames:
+                    writer.write(data, timestamp)
+        with Stats_Store(directory / 'stats.sqlite3') as store:
+            collected, _ = store.add_captures(sorted(directory.glob('*.pcap')), backend='python')
+            cached_ok = store.collect_reports(directory / 'a.pcap', backend='python') \
+                == collect_reports(str(directory / 'a.pcap'), backend='python')
+            (directory / 'a.pcap').rename(directory / 'c.pcap')
+            _, skipped = store.add_captures([directory / 'c.pcap'], backend='python')
+            moved_ok = len(collected) == 2 and len(skipped) == 1 \
+                and {c['path'] for c in store.captures()} == {
+                    str((directory / n).resolve()) for n in ('b.pcap', 'c.pcap')}
+
+            merged = {r.header: r for r in store.merged_reports()}
+            tcp, = merged['TCP Conversations'].conversations
+            merged_ok = (
+                (str(tcp.address_A), tcp.port_A, tcp.frames_to_A, tcp.frames_to_B)
+                == ('1.1.1.1', 443, 2, 2)
+                and tcp.total_bytes == sum(
+                    len(d) for _, d in captures['a.pcap'][:2] + captures['b.pcap'])
+                and tcp.relative_start == 0.0 and tcp.duration == 3604.0
+                and sum(e.packets for e in merged['IPv4 Endpoints'].endpoints) == 10)
+            buckets = [(b['bucket'], b['conversations'], b['frames'])
+                       for b in store.conversation_buckets(3600) if b['header'] == 'TCP Conversations']
+            buckets_ok = buckets == [(1699999200, 1, 2), (1700002800, 1, 2)]
+
+            # b.pcap rewritten with one more frame replaces the old one.
+            with Pcap_Writer(directory / 'b.pcap') as writer:
+                for timestamp, data in captures['b.pcap'] + captures['b.pcap'][-1:]:
+                    writer.write(data, timestamp + 1)
+            store.add_captures([directory / 'b.pcap'], backend='python')
+            tcp, = {r.header: r for r in store.merged_reports()}['TCP Conversations'].conversations
+            rewritten_ok = len(store.captures()) == 2 and tcp.total_frames == 5
+    print(f"reports are cached correctly: {cached_ok}"
+          f"\nmoved captures are recognized: {moved_ok}"
+          f"\nreports are merged correctly: {merged_ok}"
+          f"\nconversations are bucketed correctly: {buckets_ok}"
+          f"\nrewritten captures replace their old content: {rewritten_ok}")
+
+
+if __name__ == '__main__':
+    test_stats_store()
@@ -1,11 +1,14 @@
+import sys
 import subprocess
 from typing import Any, Dict, List, Optional, Union
 from pathlib import Path
 
 # from src.Wireshark.common import PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS
-from ..common import PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS
+from ..common import PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS, resolve_backend
 from ..Main import Tshark
-from .Classes import Report_Processor, Endpoint_Report, Conversation_Report
+from ..Pcap import functions as pcap_functions
+from .Cache import Statistics_Cache
+from .Classes import Report_Processor, Endpoint_Report, Conversation_Report, TCP_Conversation
 
 FILE_BINARY = '/usr/bin/file'
 
@@ -13,48 +16,77 @@ FILE_BINARY = '/usr/bin/file'
 def collect_reports(
         pcap_file_path,
         proto=PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS,
-        display_filter=None
+        display_filter=None,
+        backend: str = 'auto'
 ) -> List[Union[Conversation_Report, Endpoint_Report]]:
 
-    reports = Tshark.parse_conversations_reports(
-        Tshark.get_endpoints_statistics_strings(
-            pcap_file_path,
-            proto,
-            display_filter
-        ))
+    if resolve_backend(backend) == 'python':
+        if display_filter is not None:
+            raise ValueError("Display filters are supported only by the tshark backend.")
+        if proto == PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS:
+            proto = pcap_functions.PROTOS_SUPPORTED_BY_PCAP_READER
+        return pcap_functions.collect_reports(pcap_file_path, proto)
+
+    reports = list(Tshark.iterate_statistics_reports(
+        pcap_file_path,
+        proto,
+        display_filter
+    ))
 
     return reports
 
 
+PCAP_FILE_SUFFIXES = ('.pcap', '.pcapng', '.cap')
+
+
 def get_sni_dict(
         pcap_file_path_str: Union[str, Path],
         filter: Optional[str] = None,
         get_server_name_to_addresses: bool = False,
         get_address_to_server_names:  bool = False,
+        backend: str = 'auto',
+        workers: Optional[int] = None
 ) -> Dict[str, Union[Dict[str, List[str]], Any]]:
+    '''`pcap_file_path_str` may be a directory of captures
+    (e.g. ring buffer files), see `Tshark.get_ipaddr_tls_server_name_pairs`
+    for `workers`.'''
 
     pcap_file_path_obj = Path(pcap_file_path_str)
 
     if not Path.exists(pcap_file_path_obj):
         print(f"File {pcap_file_path_str} does not exist.")
         return
-    try:
-        pcap_file_type = subprocess.run(
-            [FILE_BINARY, pcap_file_path_str], text=True, capture_output=True,
-            check=True
-        ).stdout.strip()
-    except Exception as e:
-        raise e
-
-    if not 'pcap capture file' in pcap_file_type and \
-       not 'pcapng capture file' in pcap_file_type:
-        raise Exception(f"File {pcap_file_path_str} is not packet capture file.")
+    if pcap_file_path_obj.is_dir():
+        pcap_file_paths = sorted(
+            str(p) for p in pcap_file_path_obj.iterdir()
+            if p.is_file() and p.suffix.lower() in PCAP_FILE_SUFFIXES)
+        if not pcap_file_paths:
+            raise Exception(f"Directory {pcap_file_path_str} has no packet capture files.")
+    else:
+        pcap_file_paths = [str(pcap_file_path_str)]
+    backend = resolve_backend(backend)
+    # The in-process reader checks the file format itself.
+    if backend == 'tshark':
+        for pcap_file_path in pcap_file_paths:
+            try:
+                pcap_file_type = subprocess.run(
+                    [FILE_BINARY, pcap_file_path], text=True, capture_output=True,
+                    check=True
+                ).stdout.strip()
+            except Exception as e:
+                raise e
+
+            if not 'pcap capture file' in pcap_file_type and \
+               not 'pcapng capture file' in pcap_file_type:
+                raise Exception(f"File {pcap_file_path} is not packet capture file.")
 
     data = Tshark.get_ipaddr_tls_server_name_pairs(
-        pcap_file_path_str,
+        pcap_file_paths if len(pcap_file_paths) > 1 else pcap_file_paths[0],
         filter=filter,
         get_address_to_server_names=get_address_to_server_names,
-        get_server_name_to_addresses=get_server_name_to_addresses
+        get_server_name_to_addresses=get_server_name_to_addresses,
+        backend=backend,
+        workers=workers
     )
 
     return data
@@ -68,19 +100,22 @@ def print_reports_as_table(
     reports.sort(key=lambda r: len(r.entries))
 
     for report in reports:
-        print(report.to_pretty_table(print_report_header=print_report_header))
+        report.write_pretty_table(sys.stdout, print_report_header=print_report_header)
 
 
-def gather_all_pcap_data_as_json(pcap_file_path) -> str:
+def gather_all_pcap_data_as_json(
+        pcap_file_path, backend: str = 'auto',
+        cache: Optional[Statistics_Cache] = None
+) -> str:
+    '''With a `cache` the capture is dissected only if it changed since
+    its statistics were cached.'''
     #TODO 0: Append data gathering with `capinfos`
-    #TODO 1: Check if `pcap file` exists.
-    #TODO 1: If we're saving statistics data to a file,
-    #TODO 1:   then check if `data file` exists.
-    #TODO 1:     Check if `data file` is valid statistic file.
-    #TODO 1:     Get checksum from `pcap file`
-    #TODO 1:     and compare it with the checksum from `data file`.
-    #TODO 1: If checksums differ, then to a new `data file` adding timestamp-suffix before extension.
-    reports = collect_reports(pcap_file_path)
+    if cache is not None:
+        return cache.get_or_compute(
+            pcap_file_path,
+            lambda: gather_all_pcap_data_as_json(pcap_file_path, backend),
+            resolve_backend(backend))
+    reports = collect_reports(pcap_file_path, backend=backend)
     #TODO -1: It's a mess. Refactor the following into `Statistics_Processor` class:
     conversation_reports_json = '"Conversation reports": ['+', '.join(report.to_json() for report in reports if 'conversation' in report.header.lower())+']'
     endpoint_reports_json     = '"Endpoint reports": ['+', '.join(report.to_json() for report in reports if 'endpoint' in report.header.lower())+']'
@@ -92,7 +127,7 @@ def gather_all_pcap_data_as_json(pcap_file_path) -> str:
 def gather_all_pcap_data_and_print_as_table(pcap_file_path):
     reports = collect_reports(pcap_file_path)
     for report in reports:
-        print(report.to_pretty_table())
+        report.write_pretty_table(sys.stdout)
 
 
 def test_reports_export_import(pcap_file_path) -> None:
@@ -108,9 +143,47 @@ def test_reports_export_import(pcap_file_path) -> None:
         )
 
 
+def benchmark_row_parsers(rows: int = 1_000_000) -> None:
+    '''Compare the compiled row parser of `TCP_Conversation` with the
+    generic one (`parse_values_generic`) on a synthetic report page.'''
+    import random
+    from time import perf_counter
+
+    random.seed(0)
+    lines = [
+        f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:{random.randrange(1024, 65536)}"
+        f"  <-> {'2001:db8::' + format(i & 0xffff, 'x') if i % 4 == 0 else '192.0.2.' + str(i % 250)}:443"
+        f"  {random.randrange(100)} {random.randrange(10**6):,} bytes"
+        f"  {random.randrange(100)} {random.randrange(10**4)} kB"
+        f"  {random.randrange(200)} {random.randrange(10**6):,} bytes"
+        f"  {random.random() * 1000:.9f}  {random.random() * 60:.4f}"
+        for i in range(rows)]
+    if any(TCP_Conversation.parse_values_generic(line) != TCP_Conversation.parse_values(line)
+           for line in lines[:1000]):
+        raise AssertionError("The compiled parser differs from the generic one.")
+
+    page = ['TCP Conversations', 'Filter:<No Filter>', '', '', *lines]
+    timings = {}
+    for name, function in (
+            ('generic', lambda: [TCP_Conversation.parse_values_generic(line) for line in lines]),
+            ('compiled', lambda: [TCP_Conversation.parse_values(line) for line in lines]),
+            ('compiled to report', lambda: next(Report_Processor.iterate_reports(page)))):
+        started = perf_counter(); function()
+        timings[name] = perf_counter() - started
+    baseline = timings['generic']
+    for name, elapsed in timings.items():
+        print(f"{name:>20}: {elapsed:8.3f}s {rows / elapsed:12,.0f} rows/s"
+              f" x{baseline / elapsed:.2f}")
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('pcap', type=str, help='Path to pcap or pcapng file to be processed.')
+    parser.add_argument('pcap', type=str, nargs='?', help='Path to pcap or pcapng file to be processed.')
+    parser.add_argument('-n', '--benchmark', type=int, nargs='?', const=1_000_000, metavar='ROWS',
+                        help='Benchmark the row parsers on a synthetic report of ROWS rows.')
     args = parser.parse_args()
-    test_reports_export_import(args.pcap)
+    if args.benchmark:
+        benchmark_row_parsers(args.benchmark)
+    if args.pcap:
+        test_reports_export_import(args.pcap)
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 #TODO: for this (and other constants for paths to binary executables)
 # implement an algorithm to find a realpath to binary to make this project portable
 
@@ -9,3 +11,15 @@ PROTOS_SUPPORTED_BY_ENDPOINTS_AND_CONVERSATIONS = (
     "ipx", "jxta", "ltp", "mptcp", "ncp", "opensafety", "rsvp", "sctp",
     "sll", "tcp", "tr", "udp", "usb", "wlan", "wpan", "zbee_nwk"
 )
+
+# `tshark` runs the binary above, `python` reads captures in-process
+# (see `Pcap`), `auto` picks `tshark` if it is installed.
+BACKENDS = ('auto', 'tshark', 'python')
+
+
+def resolve_backend(backend: str = 'auto') -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend must be one of: {', '.join(BACKENDS)}")
+    if backend == 'auto':
+        return 'tshark' if Path(TSHARK_BINARY).exists() else 'python'
+    return backend
@@ -0,0 +1,539 @@
+'''Compile capture filters into classic BPF to see what they cost.
+
+The local libpcap (via `ctypes`) is used when it is available, otherwise
+a pure-Python compiler handles the subset of the filter syntax produced
+by `net_tools.construct_filters`: `[ip|ip6|tcp|udp|sctp] [src|dst]
+host|net|port|portrange`, bare protocols, `and`/`or`/`not` and
+parentheses. The latter generates straightforward unoptimized code,
+comparable to `tcpdump -O -d`.
+'''
+
+import ctypes
+import ctypes.util
+import struct
+from dataclasses import dataclass, field
+from typing import Literal, Optional, Union
+from ipaddress import IPv4Address, IPv6Address, ip_address
+
+from .net_tools import parse_ip_string
+
+BACKEND = Literal['auto', 'libpcap', 'python']
+
+DLT_EN10MB = 1
+SNAPLEN = 262144
+PCAP_NETMASK_UNKNOWN = 0xffffffff
+
+# Classic BPF opcodes (see `net/bpf.h`).
+BPF_LD, BPF_LDX, BPF_ST, BPF_STX = 0x00, 0x01, 0x02, 0x03
+BPF_ALU, BPF_JMP, BPF_RET, BPF_MISC = 0x04, 0x05, 0x06, 0x07
+BPF_W, BPF_H, BPF_B = 0x00, 0x08, 0x10
+BPF_IMM, BPF_ABS, BPF_IND, BPF_MEM, BPF_LEN, BPF_MSH = 0x00, 0x20, 0x40, 0x60, 0x80, 0xa0
+BPF_JA, BPF_JEQ, BPF_JGT, BPF_JGE, BPF_JSET = 0x00, 0x10, 0x20, 0x30, 0x40
+BPF_K, BPF_X, BPF_A = 0x00, 0x08, 0x10
+
+ETHERTYPE_IP, ETHERTYPE_IPV6 = 0x0800, 0x86dd
+IP_PROTOS = {'tcp': 6, 'udp': 17, 'sctp': 132}
+
+Instruction = tuple[int, int, int, int]  # code, jt, jf, k
+# jt and jf are 8-bit offsets.
+BPF_MAX_JUMP = 255
+
+
+@dataclass
+class Bpf_Program:
+    expression: str
+    instructions: list[Instruction] = field(default_factory=list)
+    backend: str = 'python'
+    optimized: bool = False
+
+    @property
+    def instruction_count(self) -> int:
+        return len(self.instructions)
+
+    @property
+    def worst_case_path(self) -> int:
+        '''Longest number of instructions executed for any packet.
+        Classic BPF only jumps forward, so one backward pass is enough.'''
+        lengths = [0] * (len(self.instructions) + 1)
+        for pc in range(len(self.instructions) - 1, -1, -1):
+            code, jt, jf, k = self.instructions[pc]
+            if code & 0x07 == BPF_RET:
+                lengths[pc] = 1
+            elif code & 0x07 == BPF_JMP:
+                if code & 0xf0 == BPF_JA: successors = (pc + 1 + k,)
+                else:                     successors = (pc + 1 + jt, pc + 1 + jf)
+                lengths[pc] = 1 + max(lengths[s] for s in successors)
+            else:
+                lengths[pc] = 1 + lengths[pc + 1]
+        return lengths[0] if self.instructions else 0
+
+    def as_dict(self) -> dict[str, Union[int, str, bool]]:
+        return {
+            'characters': len(self.expression),
+            'instructions': self.instruction_count,
+            'worst_case_path': self.worst_case_path,
+            'backend': self.backend,
+            'optimized': self.optimized,
+        }
+
+    def dump(self) -> str:
+        '''Instructions in the `tcpdump -dd` format.'''
+        return '\n'.join(f"{{ 0x{code:x}, {jt}, {jf}, 0x{k:08x} }},"
+                         for code, jt, jf, k in self.instructions)
+
+    def run(self, packet: bytes) -> int:
+        '''Interpret the program, return the accepted length (0 to drop).'''
+        a = x = 0
+        memory = [0] * 16
+        pc = 0
+
+        def _load(offset: int, size: int) -> Optional[int]:
+            if offset < 0 or offset + size > len(packet): return None
+            return int.from_bytes(packet[offset:offset + size], 'big')
+
+        while pc < len(self.instructions):
+            code, jt, jf, k = self.instructions[pc]
+            cls = code & 0x07
+            if cls in (BPF_LD, BPF_LDX):
+                mode, size = code & 0xe0, {BPF_W: 4, BPF_H: 2, BPF_B: 1}[code & 0x18]
+                if   mode == BPF_IMM: value = k
+                elif mode == BPF_LEN: value = len(packet)
+                elif mode == BPF_MEM: value = memory[k]
+                elif mode == BPF_ABS: value = _load(k, size)
+                elif mode == BPF_IND: value = _load(x + k, size)
+                elif mode == BPF_MSH:
+                    value = _load(k, 1)
+                    if value is not None: value = (value & 0x0f) * 4
+                if value is None: return 0
+                if cls == BPF_LD: a = value
+                else:             x = value
+            elif cls == BPF_ST:  memory[k] = a
+            elif cls == BPF_STX: memory[k] = x
+            elif cls == BPF_ALU:
+                operand = x if code & BPF_X else k
+                operation = code & 0xf0
+                if operation in (0x30, 0x90) and operand == 0: return 0
+                a = {
+                    0x00: lambda: a + operand, 0x10: lambda: a - operand,
+                    0x20: lambda: a * operand, 0x30: lambda: a // operand,
+                    0x40: lambda: a | operand, 0x50: lambda: a & operand,
+                    0x60: lambda: a << operand, 0x70: lambda: a >> operand,
+                    0x80: lambda: -a, 0x90: lambda: a % operand,
+                    0xa0: lambda: a ^ operand,
+                }[operation]() & 0xffffffff
+            elif cls == BPF_JMP:
+                operation = code & 0xf0
+                if operation == BPF_JA:
+                    pc += 1 + k; continue
+                operand = x if code & BPF_X else k
+                taken = {
+                    BPF_JEQ: a == operand, BPF_JGT: a > operand,
+                    BPF_JGE: a >= operand, BPF_JSET: bool(a & operand),
+                }[operation]
+                pc += 1 + (jt if taken else jf); continue
+            elif cls == BPF_RET:
+                return a if code & 0x18 == BPF_A else k
+            elif cls == BPF_MISC:
+                if code & 0xf8 == 0x00: x = a  # tax
+                else:                   a = x  # txa
+            pc += 1
+        return 0
+
+
+# libpcap binding
+
+class _Bpf_Insn(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_ushort), ('jt', ctypes.c_ubyte),
+                ('jf', ctypes.c_ubyte), ('k', ctypes.c_uint32)]
+
+
+class _Bpf_Program(ctypes.Structure):
+    _fields_ = [('bf_len', ctypes.c_uint),
+                ('bf_insns', ctypes.POINTER(_Bpf_Insn))]
+
+
+_libpcap = None
+
+
+def _load_libpcap() -> Optional[ctypes.CDLL]:
+    global _libpcap
+    if _libpcap is None:
+        path = ctypes.util.find_library('pcap')
+        try:
+            library = ctypes.CDLL(path) if path else False
+        except OSError:
+            library = False
+        if library:
+            library.pcap_open_dead.restype = ctypes.c_void_p
+            library.pcap_open_dead.argtypes = [ctypes.c_int, ctypes.c_int]
+            library.pcap_compile.restype = ctypes.c_int
+            library.pcap_compile.argtypes = [
+                ctypes.c_void_p, ctypes.POINTER(_Bpf_Program),
+                ctypes.c_char_p, ctypes.c_int, ctypes.c_uint32]
+            library.pcap_geterr.restype = ctypes.c_char_p
+            library.pcap_geterr.argtypes = [ctypes.c_void_p]
+            library.pcap_freecode.argtypes = [ctypes.POINTER(_Bpf_Program)]
+            library.pcap_close.argtypes = [ctypes.c_void_p]
+        _libpcap = library
+    return _libpcap or None
+
+
+def is_libpcap_available() -> bool:
+    return _load_libpcap() is not None
+
+
+def compile_with_libpcap(
+        expression: str, optimize: bool = True,
+        linktype: int = DLT_EN10MB, snaplen: int = SNAPLEN
+) -> Bpf_Program:
+    library = _load_libpcap()
+    if library is None:
+        raise RuntimeError("libpcap is not available")
+    pcap = library.pcap_open_dead(linktype, snaplen)
+    program = _Bpf_Program()
+    try:
+        if library.pcap_compile(pcap, ctypes.byref(program), expression.encode(),
+                                int(optimize), PCAP_NETMASK_UNKNOWN) != 0:
+            raise ValueError(library.pcap_geterr(pcap).decode())
+        instructions = [
+            (i.code, i.jt, i.jf, i.k)
+            for i in program.bf_insns[:program.bf_len]]
+        library.pcap_freecode(ctypes.byref(program))
+    finally:
+        library.pcap_close(pcap)
+    return Bpf_Program(expression, instructions, 'libpcap', optimize)
+
+
+# Pure-Python compiler
+
+# A test loads a value into A and compares it; `negate` turns the jump
+# around (e.g. "fragment offset bits must not be set").
+Test = tuple[tuple[Instruction, ...], int, int, bool]
+
+
+def _ld(offset: int, size: int = BPF_W, mode: int = BPF_ABS) -> Instruction:
+    return (BPF_LD | size | mode, 0, 0, offset)
+
+
+def _test(loads, jump: int, k: int, negate: bool = False) -> Test:
+    return tuple(loads), BPF_JMP | jump | BPF_K, k & 0xffffffff, negate
+
+
+def _ethertype(ethertype: int) -> Test:
+    return _test([_ld(12, BPF_H)], BPF_JEQ, ethertype)
+
+
+def _address_tests(
+        address: Union[IPv4Address, IPv6Address], prefixlen: int, direction: str
+) -> list[Test]:
+    if address.version == 4:
+        tests = [_ethertype(ETHERTYPE_IP)]
+        offset, words = (26 if direction == 'src' else 30), 1
+    else:
+        tests = [_ethertype(ETHERTYPE_IPV6)]
+        offset, words = (22 if direction == 'src' else 38), 4
+    value = int(address)
+    for word in range(words):
+        bits = min(max(prefixlen - word * 32, 0), 32)
+        if bits == 0: break
+        k = (value >> (32 * (words - 1 - word))) & 0xffffffff
+        loads = [_ld(offset + word * 4)]
+        if bits < 32:
+            mask = (0xffffffff << (32 - bits)) & 0xffffffff
+            loads.append((BPF_ALU | 0x50 | BPF_K, 0, 0, mask))
+        tests.append(_test(loads, BPF_JEQ, k))
+    return tests
+
+
+def _port_tests(
+        protocol: str, version: int, direction: str, first: int, last: int
+) -> list[Test]:
+    if version == 4:
+        tests = [_ethertype(ETHERTYPE_IP),
+                 _test([_ld(23, BPF_B)], BPF_JEQ, IP_PROTOS[protocol]),
+                 _test([_ld(20, BPF_H)], BPF_JSET, 0x1fff, negate=True)]
+        loads = [(BPF_LDX | BPF_B | BPF_MSH, 0, 0, 14),
+                 _ld(14 if direction == 'src' else 16, BPF_H, BPF_IND)]
+    else:
+        tests = [_ethertype(ETHERTYPE_IPV6),
+                 _test([_ld(20, BPF_B)], BPF_JEQ, IP_PROTOS[protocol])]
+        loads = [_ld(54 if direction == 'src' else 56, BPF_H)]
+    if first == last:
+        tests.append(_test(loads, BPF_JEQ, first))
+    else:
+        tests.append(_test(loads, BPF_JGE, first))
+        tests.append(_test(loads, BPF_JGT, last, negate=True))
+    return tests
+
+
+def _primitive(
+        protocol: Optional[str], direction: Optional[str],
+        kind: Optional[str], value: Optional[str]
+) -> list[list[Test]]:
+    '''Expand a primitive into a disjunction of conjunctions of tests.'''
+    directions = (direction,) if direction else ('src', 'dst')
+    if kind is None:
+        if protocol == 'ip':  return [[_ethertype(ETHERTYPE_IP)]]
+        if protocol == 'ip6': return [[_ethertype(ETHERTYPE_IPV6)]]
+        return [[_ethertype(ETHERTYPE_IP),
+                 _test([_ld(23, BPF_B)], BPF_JEQ, IP_PROTOS[protocol])],
+                [_ethertype(ETHERTYPE_IPV6),
+                 _test([_ld(20, BPF_B)], BPF_JEQ, IP_PROTOS[protocol])]]
+    if kind in ('host', 'net'):
+        parsed_kind, parsed = parse_ip_string(value)
+        if parsed_kind == 'invalid':
+            raise ValueError(f"{value} is not a valid {kind}")
+        if parsed_kind == 'address':
+            address, prefixlen = parsed, parsed.max_prefixlen
+        else:
+            address, prefixlen = parsed.network_address, parsed.prefixlen
+        if (protocol == 'ip' and address.version != 4) or \
+           (protocol == 'ip6' and address.version != 6) or \
+           protocol in IP_PROTOS:
+            raise ValueError(f"Unsupported qualifiers for {kind} {value}")
+        return [_address_tests(address, prefixlen, d) for d in directions]
+    # port and portrange
+    first, _, last = value.partition('-') if kind == 'portrange' else (value, '', value)
+    if not first.isdigit() or not last.isdigit():
+        raise ValueError(f"Unsupported {kind} {value}")
+    protocols = (protocol,) if protocol in IP_PROTOS else tuple(IP_PROTOS)
+    versions = {'ip': (4,), 'ip6': (6,)}.get(protocol, (4, 6))
+    return [_port_tests(p, v, d, int(first), int(last))
+            for v in versions for p in protocols for d in directions]
+
+
+_PROTOCOL_WORDS = {'ip', 'ip6', *IP_PROTOS}
+_DIRECTION_WORDS = {'src', 'dst'}
+_KIND_WORDS = {'host', 'net', 'port', 'portrange'}
+_OPERATORS = {'and': 'and', '&&': 'and', 'or': 'or', '||': 'or',
+              'not': 'not', '!': 'not'}
+
+
+def _tokenize(expression: str) -> list[str]:
+    for char in '()!':
+        expression = expression.replace(char, f" {char} ")
+    return expression.replace('& &', '&&').split()
+
+
+class _Parser:
+    '''`and` and `or` have equal precedence and associate to the left,
+    `not` binds tighter, as in libpcap.'''
+
+    def __init__(self, expression: str) -> None:
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def _peek(self) -> Optional[str]:
+        if self.position < len(self.tokens): return self.tokens[self.position]
+        return None
+
+    def _next(self) -> str:
+        token = self._peek()
+        if token is None: raise ValueError("Unexpected end of filter expression")
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self._expression()
+        if self._peek() is not None:
+            raise ValueError(f"Unexpected token {self._peek()!r}")
+        return node
+
+    def _expression(self):
+        node = self._unary()
+        while _OPERATORS.get(self._peek()) in ('and', 'or'):
+            operator = _OPERATORS[self._next()]
+            node = (operator, node, self._unary())
+        return node
+
+    def _unary(self):
+        token = self._peek()
+        if _OPERATORS.get(token) == 'not':
+            self._next(); return ('not', self._unary())
+        if token == '(':
+            self._next(); node = self._expression()
+            if self._next() != ')': raise ValueError("Missing ')'")
+            return node
+        return self._primitive()
+
+    def _primitive(self):
+        protocol = direction = kind = value = None
+        while self._peek() in _PROTOCOL_WORDS | _DIRECTION_WORDS | _KIND_WORDS:
+            token = self._next()
+            if token in _PROTOCOL_WORDS:    protocol = token
+            elif token in _DIRECTION_WORDS: direction = token
+            else:
+                kind = token; value = self._next(); break
+        if kind is None and protocol is None:
+            token = self._next()
+            if parse_ip_string(token)[0] == 'invalid':
+                raise ValueError(f"Unsupported filter primitive {token!r}")
+            kind, value = 'host', token
+        if kind is None and direction is not None:
+            raise ValueError(f"Missing host, net or port after {direction!r}")
+        return ('primitive', _primitive(protocol, direction, kind, value))
+
+
+def compile_with_python(expression: str, max_jump: int = BPF_MAX_JUMP) -> Bpf_Program:
+    '''Conditional jumps further than `max_jump` go through `ja`
+    instructions, see `_assemble`.'''
+    tree = _Parser(expression).parse()
+    code: list = []  # instructions with label references, and label markers
+    labels_count = 0
+
+    def _label() -> int:
+        nonlocal labels_count
+        labels_count += 1
+        return labels_count
+
+    def _emit_jump(jump: int, k: int, jt, jf) -> None:
+        # `None` means "fall through to the next instruction".
+        code.append(('jump', jump, k, jt, jf))
+
+    def _generate(node, on_true: int, on_false: int) -> None:
+        if node[0] == 'not':
+            _generate(node[1], on_false, on_true)
+        elif node[0] in ('and', 'or'):
+            middle = _label()
+            if node[0] == 'and': _generate(node[1], middle, on_false)
+            else:                _generate(node[1], on_true, middle)
+            code.append(('label', middle))
+            _generate(node[2], on_true, on_false)
+        else:
+            conjunctions = node[1]
+            for i, tests in enumerate(conjunctions):
+                next_conjunction = _label() if i < len(conjunctions) - 1 else on_false
+                for j, (loads, jump, k, negate) in enumerate(tests):
+                    code.extend(('insn', load) for load in loads)
+                    success = on_true if j == len(tests) - 1 else None
+                    if negate: _emit_jump(jump, k, next_conjunction, success)
+                    else:      _emit_jump(jump, k, success, next_conjunction)
+                if next_conjunction != on_false:
+                    code.append(('label', next_conjunction))
+
+    accept, reject = _label(), _label()
+    _generate(tree, accept, reject)
+    code.append(('label', accept)); code.append(('insn', (BPF_RET | BPF_K, 0, 0, SNAPLEN)))
+    code.append(('label', reject)); code.append(('insn', (BPF_RET | BPF_K, 0, 0, 0)))
+
+    return Bpf_Program(expression, _assemble(code, max_jump), 'python', False)
+
+
+def _assemble(code: list, max_jump: int = BPF_MAX_JUMP) -> list[Instruction]:
+    '''Resolve the labels of `compile_with_python` code. jt and jf are 8-bit,
+    so a conditional jump further than `max_jump` goes to a `ja` right
+    after it, as libpcap does; inserting those moves other targets away,
+    so this repeats until every offset fits.'''
+    labels_count = max((entry[1] for entry in code if entry[0] == 'label'), default=0)
+    resolved = []
+    for entry in code:
+        if entry[0] == 'jump' and None in entry[3:]:
+            # Explicit targets, trampolines may be put after the jump.
+            labels_count += 1
+            _, jump, k, jt, jf = entry
+            entry = ('jump', jump, k,
+                     labels_count if jt is None else jt, labels_count if jf is None else jf)
+            resolved += [entry, ('label', labels_count)]
+        else:
+            resolved.append(entry)
+    code = resolved
+
+    while True:
+        positions, pc = {}, 0
+        for entry in code:
+            if entry[0] == 'label': positions[entry[1]] = pc
+            else: pc += 1
+        resolved, pc, relaxed = [], 0, False
+        for entry in code:
+            resolved.append(entry)
+            if entry[0] == 'label': continue
+            if entry[0] == 'jump':
+                _, jump, k, jt, jf = entry
+                redirected, trampolines = {}, []
+                for target in (jt, jf):
+                    if positions[target] - pc - 1 > max_jump and target not in redirected:
+                        labels_count += 1
+                        redirected[target] = labels_count
+                        trampolines += [('label', labels_count), ('ja', target)]
+                if trampolines:
+                    relaxed = True
+                    resolved[-1] = ('jump', jump, k,
+                                    redirected.get(jt, jt), redirected.get(jf, jf))
+                    resolved += trampolines
+            pc += 1
+        code = resolved
+        if not relaxed: break
+
+    instructions, pc = [], 0
+    for entry in code:
+        if entry[0] == 'label': continue
+        if entry[0] == 'insn':
+            instructions.append(entry[1])
+        elif entry[0] == 'ja':
+            instructions.append((BPF_JMP | BPF_JA, 0, 0, positions[entry[1]] - pc - 1))
+        else:
+            _, jump, k, jt, jf = entry
+            instructions.append((jump, positions[jt] - pc - 1, positions[jf] - pc - 1, k))
+        pc += 1
+    return instructions
+
+
+def compile_filter(
+        expression: str, optimize: bool = True, backend: BACKEND = 'auto'
+) -> Bpf_Program:
+    '''Compile a capture filter with libpcap or, if it is unavailable
+    (or `backend='python'`), with the built-in unoptimizing compiler.'''
+    if backend == 'libpcap' or (backend == 'auto' and is_libpcap_available()):
+        return compile_with_libpcap(expression, optimize=optimize)
+    return compile_with_python(expression)
+
+
+def build_test_packet(
+        src: str, dst: str, protocol: str = 'tcp',
+        sport: int = 0, dport: int = 0
+) -> bytes:
+    '''Minimal Ethernet/IP/transport frame to feed `Bpf_Program.run`.'''
+    src, dst = ip_address(src), ip_address(dst)
+    transport = struct.pack('!HH', sport, dport) + bytes(16)
+    if src.version == 4:
+        ip_header = struct.pack(
+            '!BBHHHBBH4s4s', 0x45, 0, 20 + len(transport), 0, 0, 64,
+            IP_PROTOS[protocol], 0, src.packed, dst.packed)
+        ethertype = ETHERTYPE_IP
+    else:
+        ip_header = struct.pack(
+            '!IHBB16s16s', 6 << 28, len(transport), IP_PROTOS[protocol], 64,
+            src.packed, dst.packed)
+        ethertype = ETHERTYPE_IPV6
+    return bytes(12) + struct.pack('!H', ethertype) + ip_header + transport
+
+
+def test_long_jumps() -> bool:
+    '''A filter of 100 endpoints has jumps far beyond 8 bits: they must go
+    through `ja` without changing which packets are accepted.'''
+    import random
+    from .net_tools import construct_filters
+
+    random.seed(8)
+    endpoints = [(f"10.{i // 250}.{i % 250}.1", random.choice(('tcp', 'udp')),
+                  random.randrange(1, 65536)) for i in range(100)]
+    capture_filter = construct_filters(
+        ''.join(f"{a},{p},{port}\n" for a, p, port in endpoints), display=False)
+    program = compile_with_python(capture_filter)
+    unbounded = compile_with_python(capture_filter, max_jump=2**32)
+    ok = all(jt <= BPF_MAX_JUMP and jf <= BPF_MAX_JUMP
+             for code, jt, jf, _ in program.instructions)
+    ok &= max(max(jt, jf) for _, jt, jf, _ in unbounded.instructions) > BPF_MAX_JUMP
+    packets = [build_test_packet(a, '192.0.2.1', p, port, 443) for a, p, port in endpoints]
+    packets += [build_test_packet('192.0.2.1', a, p, 443, port) for a, p, port in endpoints]
+    packets += [build_test_packet(a, '192.0.2.1', 'sctp' if p == 'tcp' else 'tcp', port, 443)
+                for a, p, port in endpoints[:20]]
+    packets += [build_test_packet('10.9.9.9', '192.0.2.1', 'tcp', 1, 2),
+                build_test_packet('2001:db8::1', '2001:db8::2', 'udp', 53, 53)]
+    ok &= [program.run(p) for p in packets] == [unbounded.run(p) for p in packets]
+    ok &= any(program.run(p) for p in packets) and not all(program.run(p) for p in packets)
+    return ok
+
+
+if __name__ == '__main__':
+    print(f"long jumps are compiled correctly: {test_long_jumps()}")
@@ -0,0 +1,122 @@
+'''Content-hashed cache of parsed endpoint tables and generated filters.
+
+Entries live as json files under the cache directory and are keyed by
+the sha256 of the csv content, so edited files are recomputed no matter
+their path or modification time. When several csv files are combined,
+only the ones that changed are parsed (and, for plain filters, have
+their clauses rebuilt) again.
+'''
+
+import json
+import hashlib
+from pathlib import Path
+from collections import defaultdict
+from typing import Any, Optional, Union
+from ipaddress import ip_network
+
+from .tools import write_atomically, remove_files
+from .net_tools import (
+    GOAL, ENDPOINTS,
+    parse_endpoints, construct_filters, construct_optimized_filters
+)
+
+# Bump on any change of the cached data or of the filter generators.
+CACHE_FORMAT_VERSION = 2
+
+FILTERS = Union[str, tuple[str, str]]
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class Filter_Cache:
+    def __init__(self, cache_dir: Union[str, Path]) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, kind: str, *key_parts: Any) -> Path:
+        key = content_hash(json.dumps([CACHE_FORMAT_VERSION, *key_parts]))
+        return self.cache_dir / f"{kind}.{key}.json"
+
+    def _load(self, path: Path) -> Optional[Any]:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            # Missing or broken entries are simply recomputed.
+            return None
+
+    def _store(self, path: Path, data: Any) -> None:
+        try:
+            write_atomically(path, lambda file: json.dump(data, file))
+        except OSError:
+            # Deliberately ignored: an entry which could not be written
+            # (full disk, removed cache directory) is just recomputed.
+            pass
+
+    def endpoints(self, csv_content: str) -> ENDPOINTS:
+        '''`parse_endpoints` of the csv, parsed only once per content.'''
+        path = self._path('endpoints', content_hash(csv_content))
+        cached = self._load(path)
+        if cached is not None:
+            return {(protocol, ip_network(network)): set(ports)
+                    for protocol, network, ports in cached}
+        endpoints = parse_endpoints(csv_content)
+        self._store(path, [[protocol, str(network), sorted(ports)]
+                           for (protocol, network), ports in endpoints.items()])
+        return endpoints
+
+    def _plain_filters(
+            self, csv_content: str, goal: GOAL
+    ) -> tuple[str, str]:
+        path = self._path('filters', content_hash(csv_content), goal, False)
+        cached = self._load(path)
+        if cached is not None:
+            return tuple(cached)
+        filters = construct_filters(csv_content, goal=goal)
+        self._store(path, list(filters))
+        return filters
+
+    def filters(
+            self,
+            csv_contents: list[str],
+            capture: bool = True,
+            display: bool = True,
+            goal: GOAL = 'include',
+            optimize: bool = False
+    ) -> FILTERS:
+        '''Cached equivalent of `construct_filters` for the concatenation
+        of `csv_contents`.
+
+        Plain filters are built per csv and joined, so only changed files
+        get their clauses rebuilt. Optimized filters group endpoints
+        across all files, so they are rebuilt from the cached endpoint
+        tables whenever any of the files changes.'''
+        hashes = [content_hash(c) for c in csv_contents]
+        path = self._path('combined', hashes, goal, optimize)
+        cached = self._load(path)
+        if cached is None:
+            if optimize:
+                endpoints = defaultdict(set)
+                for csv_content in csv_contents:
+                    for key, ports in self.endpoints(csv_content).items():
+                        endpoints[key] |= ports
+                cached = list(construct_optimized_filters(endpoints, goal=goal))
+            else:
+                joiner = ' or ' if goal == 'include' else ' and '
+                parts = [self._plain_filters(c, goal) for c in csv_contents]
+                cached = [joiner.join(p[i] for p in parts if p[i])
+                          for i in range(2)]
+            self._store(path, cached)
+        capture_filter, display_filter = cached
+        if capture and display:
+            return capture_filter, display_filter
+        elif capture:
+            return capture_filter
+        elif display:
+            return display_filter
+
+    def clear(self) -> int:
+        '''Remove all cache entries, return their number.'''
+        return remove_files(self.cache_dir, '*.json')
@@ -1,32 +1,83 @@
-from typing import Iterator, Literal, Union
+import heapq
+from array import array
+from typing import Iterable, Iterator, Literal, Optional, Union
 from collections import defaultdict
+from dataclasses import dataclass, field
 from ipaddress import (
+    IPv4Address, IPv6Address,
     IPv4Network, IPv6Network,
-    ip_address, ip_network, collapse_addresses
+    ip_address, ip_network
 )
 
+from .tools import parse_ip_address
+
 IPv4_Internet = IPv4Network('0.0.0.0/0')
 IPv6_Internet = IPv6Network('::/0')
 
 
+PARSED_KIND = Literal['address', 'network', 'invalid']
+Parsed_IP = tuple[PARSED_KIND, Union[IPv4Address, IPv6Address,
+                                     IPv4Network, IPv6Network, None]]
+
+_DIGITS = frozenset('0123456789')
+
+
+def _parse_ipv4_int(item: str) -> Optional[int]:
+    '''Fast path for plain dotted quads; `None` means "ask ipaddress".'''
+    octets = item.split('.')
+    if len(octets) != 4: return None
+    value = 0
+    for octet in octets:
+        if not octet or len(octet) > 3 or not _DIGITS.issuperset(octet) \
+                or (octet[0] == '0' and len(octet) > 1):
+            return None
+        octet = int(octet)
+        if octet > 255: return None
+        value = (value << 8) | octet
+    return value
+
+
+def parse_ip_string(item: str) -> Parsed_IP:
+    '''Classify and parse a string in one step.
+
+    Returns `('address', ip_address)` for host addresses,
+    `('network', ip_network)` for `address/prefix` networks
+    (strict, host bits must be unset) and `('invalid', None)` otherwise.
+    '''
+    address, slash, prefix = item.partition('/')
+    value = _parse_ipv4_int(address)
+    if value is not None:
+        if not slash:
+            return 'address', IPv4Address(value)
+        if prefix and len(prefix) <= 2 and _DIGITS.issuperset(prefix) \
+                and (prefix[0] != '0' or len(prefix) == 1):
+            prefixlen = int(prefix)
+            if prefixlen <= 32:
+                if value & ((1 << (32 - prefixlen)) - 1):
+                    return 'invalid', None
+                return 'network', IPv4Network((value, prefixlen))
+    try:
+        if slash: return 'network', ip_network(item)
+        else:     return 'address', ip_address(item)
+    except ValueError:
+        return 'invalid', None
+
+
+def parse_ip_strings(items: Iterable[str]) -> Iterator[Parsed_IP]:
+    '''Bulk variant of `parse_ip_string`: lazily yields a result per item.'''
+    return map(parse_ip_string, items)
+
+
 def is_string_a_valid_ip_address(item: str) -> bool:
-    try: ip_address(item); return True
-    except: return False
+    return parse_ip_string(item)[0] == 'address'
 
 
 def is_string_a_valid_ip_network(item: str, strict: bool = False) -> bool:
+    kind = parse_ip_string(item)[0]
     if not strict:
-        try:
-            ip_network(item)
-            return True
-        except Exception:
-            return False
+        return kind != 'invalid'
     else:
-        if is_string_a_valid_ip_network(item) and \
-                not is_string_a_valid_ip_address(item):
-            return True
-        else:
-            return False
+        return kind == 'network'
 
 
 def exclude_addresses(
@@ -52,24 +103,532 @@ def exclude_addresses(
 
     and see how long it takes. (:
     ... (the author does not bear any responsibility for the OOM killer of your operating system)
+
+    The exclusion itself is done on integer ranges (see `Prefix_Set`):
+    the excluded networks are turned into sorted, merged `(first, last)`
+    pairs, the gaps between them are found in a single sweep and
+    converted back into minimal CIDR blocks. If none of the addresses
+    overlaps the target network, nothing is returned (as before).
+    '''
+    target = Prefix_Set((target_network,))
+    excluded = Prefix_Set(addresses_to_exclude)
+    if excluded.versions - {target_network.version}:
+        raise TypeError(
+            f"Addresses to exclude are not all IPv{target_network.version}")
+    if target.isdisjoint(excluded):
+        return iter(())
+    return (target - excluded).networks()
+
+
+def exclude_addresses_stream(
+        target_network:       Union[IPv4Network, IPv6Network],
+        addresses_to_exclude: Iterable[Union[IPv4Network, IPv6Network]],
+        presorted:            bool = False
+)    -> Union[Iterator[IPv4Network], Iterator[IPv6Network]]:
+    '''Lazily yield `target_network` minus `addresses_to_exclude`.
+
+    Unlike `exclude_addresses` every excluded network is reduced to a pair
+    of integers as soon as it is read. With `presorted` the input must be
+    sorted by network address; it is then merged on the fly, so memory
+    stays flat regardless of the input length. Excluded networks outside
+    of the target network are ignored.
+    '''
+    target_first, target_last = _network_to_range(target_network)
+    ranges = (
+        _network_to_range(address, target_network.version)
+        for address in addresses_to_exclude)
+    if presorted: ranges = _merge_sorted_ranges(ranges)
+    else:         ranges = _merge_ranges(ranges)
+    return _ranges_to_networks(
+        _subtract_ranges((target_first, target_last), ranges),
+        target_network.version)
+
+
+def _network_to_range(
+        network: Union[IPv4Network, IPv6Network],
+        version: Optional[Literal[4, 6]] = None
+) -> tuple[int, int]:
+    if version is not None and network.version != version:
+        raise TypeError(f"{network} is not an IPv{version} network")
+    first = int(network.network_address)
+    return first, first | ((1 << (network.max_prefixlen - network.prefixlen)) - 1)
+
+
+def _merge_ranges(ranges: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    '''Sort `(first, last)` pairs and merge overlapping and adjacent ones.'''
+    return list(_merge_sorted_ranges(sorted(ranges)))
+
+
+def _merge_sorted_ranges(
+        ranges: Iterable[tuple[int, int]]
+) -> Iterator[tuple[int, int]]:
+    '''Lazily merge `(first, last)` pairs already sorted by `first`.'''
+    current = None
+    for first, last in ranges:
+        if current is None:
+            current = [first, last]
+        elif first < current[0]:
+            raise ValueError("Address ranges are not sorted")
+        elif first <= current[1] + 1:
+            if last > current[1]:
+                current[1] = last
+        else:
+            yield current[0], current[1]
+            current = [first, last]
+    if current is not None:
+        yield current[0], current[1]
+
+
+def _subtract_ranges(
+        target_range: tuple[int, int],
+        ranges: Iterable[tuple[int, int]]
+) -> Iterator[tuple[int, int]]:
+    '''Yield the gaps of `target_range` not covered by sorted, merged `ranges`.'''
+    cursor, target_last = target_range
+    for first, last in ranges:
+        if last < cursor:
+            continue
+        if first > target_last:
+            break
+        if first > cursor:
+            yield cursor, first - 1
+        cursor = last + 1
+        if cursor > target_last:
+            return
+    if cursor <= target_last:
+        yield cursor, target_last
+
+
+def _range_to_networks(
+        first: int, last: int, version: Literal[4, 6]
+) -> Iterator[Union[IPv4Network, IPv6Network]]:
+    '''Yield the minimal list of CIDR blocks covering `first`..`last`.'''
+    if version == 4: network_class, max_prefixlen = IPv4Network, 32
+    else:            network_class, max_prefixlen = IPv6Network, 128
+    while first <= last:
+        # The largest block is bounded both by the alignment of `first`
+        # and by the number of addresses left in the range.
+        if first:
+            block_bits = (first & -first).bit_length() - 1
+        else:
+            block_bits = max_prefixlen
+        block_bits = min(block_bits, (last - first + 1).bit_length() - 1)
+        yield network_class((first, max_prefixlen - block_bits))
+        first += 1 << block_bits
+
+
+def _ranges_to_networks(
+        ranges: Iterable[tuple[int, int]], version: Literal[4, 6]
+) -> Iterator[Union[IPv4Network, IPv6Network]]:
+    for first, last in ranges:
+        yield from _range_to_networks(first, last, version)
+
+
+_V4_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+_V6_WORD_MASK = (1 << 64) - 1
+
+
+def _pack_ranges(
+        ranges: Iterable[tuple[int, int]], version: Literal[4, 6]
+) -> array:
+    '''Store `(first, last)` pairs flat: one word per bound for IPv4,
+    two 64-bit words (high, low) per bound for IPv6.'''
+    if version == 4:
+        packed = array(_V4_TYPECODE)
+        for first, last in ranges:
+            packed.append(first); packed.append(last)
+    else:
+        packed = array('Q')
+        for first, last in ranges:
+            packed.extend((first >> 64, first & _V6_WORD_MASK,
+                           last >> 64, last & _V6_WORD_MASK))
+    return packed
+
+
+def _unpack_ranges(
+        packed: array, version: Literal[4, 6]
+) -> Iterator[tuple[int, int]]:
+    if version == 4:
+        for i in range(0, len(packed), 2):
+            yield packed[i], packed[i + 1]
+    else:
+        for i in range(0, len(packed), 4):
+            yield ((packed[i] << 64) | packed[i + 1],
+                   (packed[i + 2] << 64) | packed[i + 3])
+
+
+def _intersect_sorted_ranges(
+        ranges_a: Iterable[tuple[int, int]],
+        ranges_b: Iterable[tuple[int, int]]
+) -> Iterator[tuple[int, int]]:
+    ranges_b = iter(ranges_b)
+    b = next(ranges_b, None)
+    for first, last in ranges_a:
+        while b is not None and b[1] < first:
+            b = next(ranges_b, None)
+        while b is not None and b[0] <= last:
+            yield max(first, b[0]), min(last, b[1])
+            if b[1] > last: break
+            b = next(ranges_b, None)
+
+
+def _subtract_sorted_ranges(
+        ranges_a: Iterable[tuple[int, int]],
+        ranges_b: Iterable[tuple[int, int]]
+) -> Iterator[tuple[int, int]]:
+    ranges_b = iter(ranges_b)
+    b = next(ranges_b, None)
+    for first, last in ranges_a:
+        while b is not None and b[1] < first:
+            b = next(ranges_b, None)
+        while b is not None and b[0] <= last:
+            if b[0] > first:
+                yield first, b[0] - 1
+            first = b[1] + 1
+            if b[1] > last: break
+            b = next(ranges_b, None)
+        if first <= last:
+            yield first, last
+
+
+class Prefix_Set:
+    '''A set of IPv4 and IPv6 addresses kept as sorted, merged integer
+    ranges in packed arrays (separate storage for each version).
+
+    A range costs 8 bytes for IPv4 and 32 bytes for IPv6 instead of
+    a few hundred bytes per `IPv4Network`/`IPv6Network` object.
+    Networks are only materialised on iteration, always collapsed.
+    Accepts networks, addresses and their string representations::
+
+        >>> s = Prefix_Set(['10.0.0.0/24', '10.0.1.0/24', '::1'])
+        >>> list(s - Prefix_Set(['10.0.0.128/25']))
+        [IPv4Network('10.0.0.0/25'), IPv4Network('10.0.1.0/24'), IPv6Network('::1/128')]
+    '''
+    __slots__ = ('_v4', '_v6')
+
+    def __init__(
+            self,
+            items: Iterable[Union[str, IPv4Address, IPv6Address,
+                                  IPv4Network, IPv6Network]] = ()
+    ) -> None:
+        ranges = {4: [], 6: []}
+        for item in items:
+            if isinstance(item, str):
+                item = ip_network(item)
+            elif isinstance(item, (IPv4Address, IPv6Address)):
+                item = ip_network(item)
+            ranges[item.version].append(_network_to_range(item))
+        self._v4 = _pack_ranges(_merge_ranges(ranges[4]), 4)
+        self._v6 = _pack_ranges(_merge_ranges(ranges[6]), 6)
+
+    @classmethod
+    def from_ranges(
+            cls,
+            v4_ranges: Iterable[tuple[int, int]] = (),
+            v6_ranges: Iterable[tuple[int, int]] = (),
+            presorted: bool = False
+    ) -> 'Prefix_Set':
+        '''Build a set from integer `(first, last)` pairs.
+        With `presorted` they must be sorted and are merged lazily.'''
+        merge = _merge_sorted_ranges if presorted else _merge_ranges
+        prefix_set = cls.__new__(cls)
+        prefix_set._v4 = _pack_ranges(merge(v4_ranges), 4)
+        prefix_set._v6 = _pack_ranges(merge(v6_ranges), 6)
+        return prefix_set
+
+    def ranges(self, version: Literal[4, 6]) -> Iterator[tuple[int, int]]:
+        if version == 4: return _unpack_ranges(self._v4, 4)
+        else:            return _unpack_ranges(self._v6, 6)
+
+    @property
+    def versions(self) -> set[int]:
+        return {v for v, packed in ((4, self._v4), (6, self._v6)) if packed}
+
+    @property
+    def num_addresses(self) -> int:
+        return sum(last - first + 1
+                   for version in (4, 6)
+                   for first, last in self.ranges(version))
+
+    def networks(
+            self, version: Optional[Literal[4, 6]] = None
+    ) -> Iterator[Union[IPv4Network, IPv6Network]]:
+        '''Yield the collapsed networks, IPv4 first.'''
+        for v in ((4, 6) if version is None else (version,)):
+            yield from _ranges_to_networks(self.ranges(v), v)
+
+    def collapse(self) -> list[Union[IPv4Network, IPv6Network]]:
+        return list(self.networks())
+
+    def __iter__(self) -> Iterator[Union[IPv4Network, IPv6Network]]:
+        return self.networks()
+
+    def __bool__(self) -> bool:
+        return bool(self._v4) or bool(self._v6)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Prefix_Set): return NotImplemented
+        return self._v4 == other._v4 and self._v6 == other._v6
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({[str(n) for n in self]})"
+
+    def _combine(self, other: 'Prefix_Set', operation) -> 'Prefix_Set':
+        if not isinstance(other, Prefix_Set): other = Prefix_Set(other)
+        return Prefix_Set.from_ranges(
+            *(operation(self.ranges(v), other.ranges(v)) for v in (4, 6)),
+            presorted=True)
+
+    def union(self, other) -> 'Prefix_Set':
+        return self._combine(other, heapq.merge)
+
+    def intersection(self, other) -> 'Prefix_Set':
+        return self._combine(other, _intersect_sorted_ranges)
+
+    def difference(self, other) -> 'Prefix_Set':
+        return self._combine(other, _subtract_sorted_ranges)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def isdisjoint(self, other) -> bool:
+        return not self.intersection(other)
+
+    def issubset(self, other) -> bool:
+        return not self.difference(other)
+
+    def __contains__(
+            self,
+            item: Union[str, IPv4Address, IPv6Address, IPv4Network, IPv6Network]
+    ) -> bool:
+        '''Binary search for an address or a whole network.'''
+        if isinstance(item, str): item = ip_network(item)
+        if isinstance(item, (IPv4Address, IPv6Address)): item = ip_network(item)
+        first, last = _network_to_range(item)
+        packed, words = (self._v4, 2) if item.version == 4 else (self._v6, 4)
+        low, high = 0, len(packed) // words
+        # Find the last range starting at or before `first`.
+        while low < high:
+            middle = (low + high) // 2
+            if item.version == 4: start = packed[middle * 2]
+            else: start = (packed[middle * 4] << 64) | packed[middle * 4 + 1]
+            if start <= first: low = middle + 1
+            else:              high = middle
+        if low == 0: return False
+        i = (low - 1) * words
+        if item.version == 4: end = packed[i + 1]
+        else: end = (packed[i + 2] << 64) | packed[i + 3]
+        return last <= end
+
+
+def exclude_addresses_batch(
+        target_networks:      Iterable[Union[IPv4Network, IPv6Network]],
+        addresses_to_exclude: Union[Prefix_Set, Iterable[Union[IPv4Network, IPv6Network]]]
+)    -> dict[Union[IPv4Network, IPv6Network], list[Union[IPv4Network, IPv6Network]]]:
+    '''`exclude_addresses` for many target networks at once.
+
+    The excluded networks are merged into sorted ranges only once
+    (a ready `Prefix_Set` can be passed to reuse it between calls),
+    then all targets, sorted, are answered in a single sweep over them.
+    Each target is only affected by excluded networks of its version;
+    a target no excluded network overlaps gets an empty list (as with
+    `exclude_addresses`).
     '''
-    addresses_to_exclude = sorted(collapse_addresses(addresses_to_exclude))
-    # Process addresses.
-    networks = []
-    for address in addresses_to_exclude:
-        if address.subnet_of(target_network):
-            networks.extend(target_network.address_exclude(address))
-    networks = sorted(set(networks))
-    # Post-process resulting network list.
-    networks_to_remove = []
+    if not isinstance(addresses_to_exclude, Prefix_Set):
+        addresses_to_exclude = Prefix_Set(addresses_to_exclude)
+    targets = sorted(set(target_networks),
+                     key=lambda n: (n.version, _network_to_range(n)))
+    results = {}
+    for version in (4, 6):
+        ranges = list(addresses_to_exclude.ranges(version))
+        position = 0
+        for target in targets:
+            if target.version != version: continue
+            target_first, target_last = _network_to_range(target)
+            # Targets are sorted by their first address, so the first
+            # range that may overlap them only moves forward.
+            while position < len(ranges) and ranges[position][1] < target_first:
+                position += 1
+            overlapping = []
+            i = position
+            while i < len(ranges) and ranges[i][0] <= target_last:
+                overlapping.append(ranges[i]); i += 1
+            if not overlapping:
+                results[target] = []
+            else:
+                results[target] = list(_ranges_to_networks(
+                    _subtract_ranges((target_first, target_last), overlapping),
+                    version))
+    return results
+
+
+@dataclass
+class Approximated_Networks:
+    networks: list[Union[IPv4Network, IPv6Network]] = field(default_factory=list)
+    over_included: int = 0
+    under_included: int = 0
+
+
+def approximate_networks(
+        networks: Iterable[Union[IPv4Network, IPv6Network]],
+        max_prefixes: int,
+        allow_drop: bool = False
+) -> Approximated_Networks:
+    '''Reduce collapsed, sorted `networks` to at most `max_prefixes` entries.
+
+    The networks are the leaves of a compressed binary trie whose inner
+    nodes are the smallest common supernets of neighbouring networks.
+    Filling an inner node replaces every network under it with the node
+    itself (the gaps become over-included); with `allow_drop` a network
+    may also be left out entirely (under-included). A priority queue
+    keyed on the number of wrongly (in|ex)cluded addresses per removed
+    prefix picks the cheapest step each time, smallest gaps first.
+
+    Networks of different versions are never merged, so with both of
+    them present and without `allow_drop` the result may still hold
+    more than `max_prefixes` entries.
+    '''
+    if max_prefixes < 1:
+        raise ValueError("max_prefixes must be a positive number")
+
+    # Trie nodes as parallel lists. `covered` and `leaves` are the
+    # currently included addresses and prefixes under a node, `exact`
+    # is the number of addresses included by the original networks.
+    firsts, prefixlens, bits = [], [], []
+    left, right, parent = [], [], []
+    covered, leaves, exact, state = [], [], [], []
+    NORMAL, FILLED, DROPPED = 0, 1, 2
+
+    def _add_node(first, prefixlen, max_prefixlen) -> int:
+        firsts.append(first); prefixlens.append(prefixlen); bits.append(max_prefixlen)
+        left.append(None); right.append(None); parent.append(None)
+        covered.append(0); leaves.append(0); exact.append(0); state.append(NORMAL)
+        return len(firsts) - 1
+
+    def _size(i) -> int:
+        return 1 << (bits[i] - prefixlens[i])
+
+    # Build the trie as a Cartesian tree (minimal prefix length on top)
+    # over the sequence `leaf, supernet, leaf, supernet, ..., leaf`.
+    roots, stack, previous = [], [], None
     for network in networks:
-        for address in addresses_to_exclude:
-            if address.subnet_of(network) or address.supernet_of(network):
-                networks_to_remove.append(network)
-    for network in networks_to_remove:
-        if network in networks:
-            networks.remove(network)
-    return collapse_addresses(networks)
+        leaf = _add_node(int(network.network_address), network.prefixlen,
+                         network.max_prefixlen)
+        covered[leaf] = exact[leaf] = _size(leaf); leaves[leaf] = 1
+        if previous is not None and bits[previous] != bits[leaf]:
+            roots.append(stack[0]); stack = []; previous = None
+        sequence = [leaf]
+        if previous is not None:
+            host_bits = (firsts[previous] ^ firsts[leaf]).bit_length()
+            supernet = _add_node(firsts[leaf] >> host_bits << host_bits,
+                                 bits[leaf] - host_bits, bits[leaf])
+            sequence.insert(0, supernet)
+        for node in sequence:
+            last = None
+            while stack and prefixlens[stack[-1]] > prefixlens[node]:
+                last = stack.pop()
+            if last is not None:
+                left[node] = last; parent[last] = node
+            if stack:
+                right[stack[-1]] = node; parent[node] = stack[-1]
+            stack.append(node)
+        previous = leaf
+    if stack: roots.append(stack[0])
+
+    # Sum up the leaves bottom-up: reversed pre-order visits children
+    # before their parents.
+    order = []
+    for root in roots:
+        stack = [root]
+        while stack:
+            node = stack.pop(); order.append(node)
+            if left[node] is not None: stack.extend((left[node], right[node]))
+    for node in reversed(order):
+        if left[node] is not None:
+            covered[node] = covered[left[node]] + covered[right[node]]
+            leaves[node] = leaves[left[node]] + leaves[right[node]]
+        exact[node] = covered[node]
+
+    queue, sequence_number = [], 0
+
+    def _push(node, action) -> None:
+        nonlocal sequence_number
+        if action == 'fill':
+            if leaves[node] < 2: return
+            cost, gain = _size(node) - covered[node], leaves[node] - 1
+        else:
+            cost, gain = covered[node], 1
+        heapq.heappush(queue, (cost / gain, sequence_number, action,
+                               node, covered[node], leaves[node]))
+        sequence_number += 1
+
+    def _is_reachable(node) -> bool:
+        node = parent[node]
+        while node is not None:
+            if state[node] != NORMAL: return False
+            node = parent[node]
+        return True
+
+    def _update_ancestors(node, delta_covered, delta_leaves) -> None:
+        node = parent[node]
+        while node is not None:
+            covered[node] += delta_covered; leaves[node] += delta_leaves
+            _push(node, 'fill')
+            node = parent[node]
+
+    for node in range(len(firsts)):
+        if left[node] is not None: _push(node, 'fill')
+        elif allow_drop:           _push(node, 'drop')
+
+    count = sum(leaves[root] for root in roots)
+    while count > max_prefixes and queue:
+        _, _, action, node, queued_covered, queued_leaves = heapq.heappop(queue)
+        if not _is_reachable(node): continue
+        if action == 'fill':
+            if state[node] != NORMAL: continue
+            if (covered[node], leaves[node]) != (queued_covered, queued_leaves):
+                continue  # a fresher entry has been queued
+            delta_covered = _size(node) - covered[node]
+            delta_leaves = 1 - leaves[node]
+            state[node] = FILLED
+            covered[node] += delta_covered; leaves[node] = 1
+            if allow_drop: _push(node, 'drop')
+        else:
+            if state[node] == DROPPED or leaves[node] != 1: continue
+            delta_covered, delta_leaves = -covered[node], -1
+            state[node] = DROPPED
+            covered[node] = 0; leaves[node] = 0
+        count += delta_leaves
+        _update_ancestors(node, delta_covered, delta_leaves)
+
+    result = Approximated_Networks()
+    for root in roots:
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if state[node] == DROPPED:
+                result.under_included += exact[node]
+            elif state[node] == FILLED or left[node] is None:
+                network_class = IPv4Network if bits[node] == 32 else IPv6Network
+                result.networks.append(network_class((firsts[node], prefixlens[node])))
+                result.over_included += _size(node) - exact[node]
+            else:
+                stack.extend((right[node], left[node]))
+    return result
+
+
+def exclude_addresses_approximate(
+        target_network:       Union[IPv4Network, IPv6Network],
+        addresses_to_exclude: Union[list[IPv4Network], list[IPv6Network]],
+        max_prefixes:         int,
+        allow_drop:           bool = False
+) -> Approximated_Networks:
+    '''`exclude_addresses` limited to `max_prefixes` resulting networks,
+    see `approximate_networks`.'''
+    return approximate_networks(
+        exclude_addresses(target_network, addresses_to_exclude),
+        max_prefixes, allow_drop)
 
 
 def construct_capture_filter_for_endpoint(
@@ -99,10 +658,15 @@ def construct_filters(
         csv_content: str,
         capture: bool = True,
         display: bool = True,
-        goal: GOAL = 'include'
+        goal: GOAL = 'include',
+        optimize: bool = False
 ):
     '''New version to construct capture and display filters
-    for multiple endpoints from csv data'''
+    for multiple endpoints from csv data.
+    With `optimize` see `construct_optimized_filters`.'''
+    if optimize:
+        return construct_optimized_filters(
+            csv_content, capture=capture, display=display, goal=goal)
     if capture:
         filters_capture = defaultdict(lambda: {'src': [], 'dst': []})
     if display:
@@ -136,9 +700,10 @@ def construct_filters(
 
     for ip in filters_list:
         if capture:
-            if is_string_a_valid_ip_network(ip, strict=True):
+            kind = parse_ip_string(ip)[0]
+            if kind == 'network':
                 ip_type = 'net'
-            elif is_string_a_valid_ip_address(ip):
+            elif kind == 'address':
                 ip_type = 'host'
             else:
                 raise ValueError(
@@ -184,23 +749,250 @@ def construct_filters(
 
 def construct_capture_filter(
         csv_content: str,
-        goal: GOAL = 'include'
+        goal: GOAL = 'include',
+        optimize: bool = False
 ) -> str:
     return construct_filters(
         csv_content=csv_content,
         capture=True,
         display=False,
-        goal=goal
+        goal=goal,
+        optimize=optimize
     )
 
 
 def construct_display_filter(
         csv_content: str,
-        goal: GOAL = 'include'
+        goal: GOAL = 'include',
+        optimize: bool = False
 ) -> str:
     return construct_filters(
         csv_content=csv_content,
         capture=False,
         display=True,
-        goal=goal
+        goal=goal,
+        optimize=optimize
     )
+
+
+ENDPOINTS = dict[tuple[str, Union[IPv4Network, IPv6Network]], set[str]]
+
+
+def parse_endpoints(csv_content: str) -> ENDPOINTS:
+    '''Map `(protocol, network)` of `address,protocol,port` rows
+    to the set of their ports.'''
+    ports_of_endpoints = defaultdict(set)
+    for row in [line for line in csv_content.splitlines()
+                if not line.startswith('#') and not line == ""]:
+        try:
+            ip, protocol, port = (column.strip() for column in row.split(','))
+        except ValueError:
+            continue
+        kind, parsed = parse_ip_string(ip)
+        if kind == 'invalid':
+            raise ValueError(
+                f"{ip} is not valid ip address of host or network")
+        ports_of_endpoints[(protocol, ip_network(parsed))].add(port)
+    return ports_of_endpoints
+
+
+def group_endpoints(
+        csv_content: Union[str, ENDPOINTS]
+) -> dict[tuple[str, frozenset], list[Union[IPv4Network, IPv6Network]]]:
+    '''Group `address,protocol,port` rows by protocol and the set of ports.
+
+    Every address gets all of its ports for a protocol merged first,
+    then addresses sharing exactly the same protocol and ports are
+    collapsed into as few networks as possible.
+    Accepts csv data or endpoints already parsed by `parse_endpoints`.'''
+    if isinstance(csv_content, str):
+        ports_of_endpoints = parse_endpoints(csv_content)
+    else:
+        ports_of_endpoints = csv_content
+    groups = defaultdict(list)
+    for (protocol, network), ports in ports_of_endpoints.items():
+        groups[(protocol, frozenset(ports))].append(network)
+    return {key: Prefix_Set(networks).collapse()
+            for key, networks in groups.items()}
+
+
+def _port_ranges(ports: Iterable[str]) -> list[Union[str, tuple[int, int]]]:
+    '''Merge consecutive numeric ports into `(first, last)` ranges;
+    named ports are kept as they are.'''
+    numbers = sorted(int(p) for p in ports if p.isdigit())
+    named = sorted(p for p in ports if not p.isdigit())
+    ranges = [(first, last) for first, last in
+              _merge_sorted_ranges((n, n) for n in numbers)]
+    return ranges + named
+
+
+def _join(parts: list[str], operator: str) -> str:
+    if len(parts) == 1: return parts[0]
+    return '(' + f" {operator} ".join(parts) + ')'
+
+
+def _capture_clause(
+        protocol: str, ports: frozenset,
+        networks: list[Union[IPv4Network, IPv6Network]]
+) -> str:
+    clauses = []
+    for direction in ('src', 'dst'):
+        addresses = _join([
+            f"{direction} host {n.network_address}"
+            if n.prefixlen == n.max_prefixlen else f"{direction} net {n}"
+            for n in networks], 'or')
+        port_parts = []
+        for port in _port_ranges(ports):
+            if isinstance(port, str):
+                port_parts.append(f"{protocol} {direction} port {port}")
+            elif port[0] == port[1]:
+                port_parts.append(f"{protocol} {direction} port {port[0]}")
+            else:
+                port_parts.append(
+                    f"{protocol} {direction} portrange {port[0]}-{port[1]}")
+        clauses.append(f"({addresses} and {_join(port_parts, 'or')})")
+    return _join(clauses, 'or')
+
+
+def _display_clause(
+        protocol: str, ports: frozenset,
+        networks: list[Union[IPv4Network, IPv6Network]]
+) -> str:
+    def _field_test(field: str, values: list[str]) -> str:
+        if len(values) == 1 and '..' not in values[0]:
+            return f"{field} == {values[0]}"
+        return f"{field} in {{{', '.join(values)}}}"
+
+    port_values = [
+        port if isinstance(port, str)
+        else str(port[0]) if port[0] == port[1]
+        else f"{port[0]}..{port[1]}"
+        for port in _port_ranges(ports)]
+    clauses = []
+    for direction in ('src', 'dst'):
+        address_tests = []
+        for field, version in (('ip', 4), ('ipv6', 6)):
+            values = [str(n.network_address) if n.prefixlen == n.max_prefixlen
+                      else str(n) for n in networks if n.version == version]
+            if values:
+                address_tests.append(_field_test(f"{field}.{direction}", values))
+        ports_test = _field_test(f"{protocol}.{direction}port", port_values)
+        clauses.append(f"({_join(address_tests, 'or')} and {ports_test})")
+    return _join(clauses, 'or')
+
+
+def construct_optimized_filters(
+        csv_content: Union[str, ENDPOINTS],
+        capture: bool = True,
+        display: bool = True,
+        goal: GOAL = 'include'
+):
+    '''Construct minimal equivalent capture and display filters
+    for multiple endpoints from csv data.
+
+    Endpoints are grouped by protocol and port set (`group_endpoints`),
+    hosts of a group are collapsed into networks, consecutive ports
+    become `portrange`s (`a..b` in display filters) and the exclusion
+    is expressed as a single `not (...)` instead of one per endpoint.
+    Endpoints already parsed by `parse_endpoints` are accepted as well.'''
+    groups = sorted(
+        group_endpoints(csv_content).items(),
+        key=lambda item: (item[0][0], sorted(item[0][1]), str(item[1])))
+
+    def _combine(clauses: list[str]) -> str:
+        if not clauses: return ''
+        expression = ' or '.join(clauses)
+        if goal == 'exclude':
+            return f"not ({expression})"
+        return expression
+
+    if capture:
+        capture_filter = _combine([
+            _capture_clause(protocol, ports, networks)
+            for (protocol, ports), networks in groups])
+    if display:
+        display_filter = _combine([
+            _display_clause(protocol, ports, networks)
+            for (protocol, ports), networks in groups])
+
+    if capture and display:
+        return capture_filter, display_filter
+    elif capture:
+        return capture_filter
+    elif display:
+        return display_filter
+
+
+def test_construct_optimized_filters() -> bool:
+    capture_filter, display_filter = construct_optimized_filters(
+        '10.0.0.1,tcp,443\n10.0.0.2,tcp,443\n10.0.0.1,tcp,444\n10.0.0.2,tcp,444\n'
+        '2001:db8::1,udp,53\n192.0.2.7,udp,53\n')
+    ok = capture_filter == (
+        '(((src host 10.0.0.1 or src host 10.0.0.2) and tcp src portrange 443-444)'
+        ' or ((dst host 10.0.0.1 or dst host 10.0.0.2) and tcp dst portrange 443-444))'
+        ' or (((src host 192.0.2.7 or src host 2001:db8::1) and udp src port 53)'
+        ' or ((dst host 192.0.2.7 or dst host 2001:db8::1) and udp dst port 53))')
+    # Sets are comma separated, Wireshark 4 rejects space separated ones.
+    ok &= display_filter == (
+        '((ip.src in {10.0.0.1, 10.0.0.2} and tcp.srcport in {443..444})'
+        ' or (ip.dst in {10.0.0.1, 10.0.0.2} and tcp.dstport in {443..444}))'
+        ' or (((ip.src == 192.0.2.7 or ipv6.src == 2001:db8::1) and udp.srcport == 53)'
+        ' or ((ip.dst == 192.0.2.7 or ipv6.dst == 2001:db8::1) and udp.dstport == 53))')
+    _, display_filter = construct_optimized_filters(
+        '10.0.0.1,tcp,80\n10.0.0.9,tcp,80\n10.0.0.1,tcp,8080\n10.0.0.9,tcp,8080\n', goal='exclude')
+    ok &= display_filter == (
+        'not (((ip.src in {10.0.0.1, 10.0.0.9} and tcp.srcport in {80, 8080})'
+        ' or (ip.dst in {10.0.0.1, 10.0.0.9} and tcp.dstport in {80, 8080})))')
+    return ok
+
+
+def benchmark_ip_parsing(count: int = 1_000_000) -> None:
+    '''Compare `parse_ip_string(s)` with the former validate-then-parse
+    path (`is_string_a_valid_ip_network` followed by `ip_network`, as in
+    `exclude-addresses`) for a mix of addresses, networks and garbage.'''
+    import random
+    from time import perf_counter
+
+    def _validate_then_parse(item: str):
+        try: ip_network(item); valid = True
+        except Exception: valid = False
+        return ip_network(item) if valid else None
+
+    random.seed(0)
+    items = []
+    for _ in range(count):
+        choice = random.random()
+        if choice < 0.6:
+            items.append(str(IPv4Address(random.getrandbits(32))))
+        elif choice < 0.85:
+            items.append(str(IPv4Network((random.getrandbits(24) << 8, 24))))
+        elif choice < 0.95:
+            items.append(str(IPv6Address(random.getrandbits(128))))
+        else:
+            items.append(f"{random.getrandbits(32)}.garbage")
+
+    timings = {}
+    for name, function in (
+            ('validate then parse', lambda: [_validate_then_parse(i) for i in items]),
+            ('parse_ip_string', lambda: [parse_ip_string(i) for i in items]),
+            ('parse_ip_strings', lambda: list(parse_ip_strings(items)))):
+        started = perf_counter(); function()
+        timings[name] = perf_counter() - started
+    baseline = timings['validate then parse']
+    for name, elapsed in timings.items():
+        print(f"{name:>20}: {elapsed:8.3f}s {count / elapsed:12,.0f} items/s"
+              f" x{baseline / elapsed:.2f}")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=1_000_000,
+                        help='Number of strings to parse in the benchmark.')
+    parser.add_argument('-t', '--test', action='store_true',
+                        help='Test the construction of filters instead of benchmarking.')
+    args = parser.parse_args()
+    if args.test:
+        print(f"filters are constructed correctly: {test_construct_optimized_filters()}")
+    else:
+        benchmark_ip_parsing(args.count)
@@ -0,0 +1,514 @@
+'''Streaming reading and merging of the server name JSON files
+written by `extract-sni-from-pcap.py`.
+
+Those files are objects of sections (`address_to_server_names` and/or
+`server_name_to_addresses`) whose keys are sorted, addresses by value
+and server names by their reversed labels. Merging them is a k-way
+merge over those keys, keeping one entry per file in memory. Filtering
+streams the entries through a `Prefix_Set` of networks and a trie of
+domain name patterns.
+'''
+
+import os
+import re
+import json
+import heapq
+import socket
+import tempfile
+from bisect import bisect_right
+from pathlib import Path
+from itertools import groupby
+from functools import lru_cache
+from ipaddress import ip_address
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .net_tools import Prefix_Set
+
+ADDRESS_TO_SERVER_NAMES = 'address_to_server_names'
+SERVER_NAME_TO_ADDRESSES = 'server_name_to_addresses'
+SECTIONS = (ADDRESS_TO_SERVER_NAMES, SERVER_NAME_TO_ADDRESSES)
+
+READ_BLOCK_SIZE = 1024 * 1024
+# Above this many inputs files are merged in batches through temporary files.
+MAX_OPEN_FILES = 256
+
+ENTRY = Tuple[str, List[str]]
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def address_key(address: str) -> Tuple[int, int]:
+    '''`(version, integer)` of an address string, by `inet_pton` which
+    is much cheaper than building an address object.'''
+    try:
+        if ':' in address:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+    except OSError:
+        # e.g. scoped IPv6 addresses
+        address = ip_address(address)
+        return address.version, int(address)
+
+
+def server_name_key(server_name: str) -> List[str]:
+    return server_name.split('.')[::-1]
+
+
+# Section: (key of its keys, key of its values)
+SECTION_KEYS = {
+    ADDRESS_TO_SERVER_NAMES: (address_key, server_name_key),
+    SERVER_NAME_TO_ADDRESSES: (server_name_key, address_key)
+}
+
+
+class Json_Stream:
+    '''Incremental reader of nested JSON objects. `keys` yields the keys
+    of the object at the current position, the caller reads (`value`)
+    or skips (`skip`) the value of each key before taking the next one.
+    `entries` yields the pairs of an object of lists.'''
+
+    def __init__(self, file: IO[str]) -> None:
+        self.file = file
+        self.name = getattr(file, 'name', '<stream>')
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        block = self.file.read(max(READ_BLOCK_SIZE, len(self.buffer) - self.position))
+        if not block:
+            return False
+        self.buffer = self.buffer[self.position:] + block
+        self.position = 0
+        return True
+
+    def _next_char(self) -> str:
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise ValueError(f"Unexpected end of {self.name}.")
+
+    def _expect(self, chars: str) -> str:
+        char = self._next_char()
+        if char not in chars:
+            raise ValueError(
+                f"Expected {' or '.join(map(repr, chars))} instead of {char!r} in {self.name}.")
+        self.position += 1
+        return char
+
+    def value(self) -> Any:
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError as e:
+                if self._fill():
+                    continue
+                raise ValueError(f"Invalid JSON in {self.name}: {e}") from None
+            # A number may be cut by the end of the buffer.
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def skip(self) -> None:
+        if self._next_char() == '{':
+            for _ in self.keys():
+                self.skip()
+        else:
+            self.value()
+
+    def keys(self) -> Iterator[str]:
+        self._expect('{')
+        if self._next_char() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"Invalid object key {key!r} in {self.name}.")
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def entries(self) -> Iterator[Tuple[str, Any]]:
+        '''Pairs of the object of lists at the current position. The
+        complete entries in the buffer are decoded at once, one by one
+        only where a `],` inside a string breaks that.'''
+        self._expect('{')
+        if self._next_char() == '}':
+            self.position += 1
+            return
+        failed_buffer = None
+        while True:
+            end = self.buffer.rfind('],', self.position)
+            if end > self.position and self.buffer is not failed_buffer:
+                try:
+                    block = json.loads('{' + self.buffer[self.position:end + 1] + '}')
+                except json.JSONDecodeError:
+                    failed_buffer = self.buffer
+                else:
+                    self.position = end + 1
+                    yield from block.items()
+                    self._expect(',')
+                    continue
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"Invalid object key {key!r} in {self.name}.")
+            self._expect(':')
+            yield key, self.value()
+            if self._expect(',}') == '}':
+                return
+
+
+def read_section(
+        path: Union[str, Path], section: str
+) -> Iterator[Tuple[Any, str, List[str]]]:
+    '''`(sort key, key, values)` of one section of a server name JSON file,
+    other sections are skipped without being built.'''
+    key_function = SECTION_KEYS[section][0]
+    with open(path, encoding='utf-8') as file:
+        stream = Json_Stream(file)
+        for name in stream.keys():
+            if name != section:
+                stream.skip()
+                continue
+            previous = None
+            for key, values in stream.entries():
+                sort_key = key_function(key)
+                if previous is not None and sort_key <= previous:
+                    raise ValueError(f"Keys of {section} in {path} are not sorted at {key!r}.")
+                previous = sort_key
+                yield sort_key, key, values
+            return
+
+
+def read_sections(
+        path: Union[str, Path], sections: Iterable[str] = SECTIONS
+) -> Iterator[Tuple[str, Iterator[ENTRY]]]:
+    '''`(section, entries)` of a server name JSON file in file order,
+    the entries of a section must be used before taking the next one.'''
+    with open(path, encoding='utf-8') as file:
+        stream = Json_Stream(file)
+        for section in stream.keys():
+            if section not in sections:
+                stream.skip()
+                continue
+            entries = stream.entries()
+            yield section, entries
+            for _ in entries:
+                pass
+
+
+def merge_section(paths: Iterable[Union[str, Path]], section: str) -> Iterator[ENTRY]:
+    value_key = SECTION_KEYS[section][1]
+    merged = heapq.merge(*(read_section(path, section) for path in paths),
+                         key=lambda entry: entry[0])
+    for _, entries in groupby(merged, key=lambda entry: entry[0]):
+        entries = list(entries)
+        values = set().union(*(values for _, _, values in entries))
+        yield entries[0][1], sorted(values, key=value_key)
+
+
+def write_sections(
+        file: IO[str],
+        sections: Iterable[Tuple[str, Iterable[ENTRY]]],
+        indent: Optional[int] = None
+) -> None:
+    '''Same output as `json.dump(..., ensure_ascii=False, indent=indent)`
+    of the `(section, entries)` pairs without building them.'''
+    def newline(level: int) -> str:
+        return '' if indent is None else '\n' + ' ' * (indent * level)
+
+    def dumps(value: Any, level: int) -> str:
+        text = json.dumps(value, ensure_ascii=False, indent=indent)
+        return text if indent is None else text.replace('\n', newline(level))
+
+    item_separator = ', ' if indent is None else ','
+    file.write('{')
+    number = -1
+    for number, (section, entries) in enumerate(sections):
+        file.write(f"{item_separator if number else ''}{newline(1)}{dumps(section, 1)}: {{")
+        empty = True
+        for key, values in entries:
+            file.write(f"{'' if empty else item_separator}{newline(2)}"
+                       f"{dumps(key, 2)}: {dumps(values, 2)}")
+            empty = False
+        file.write('}' if empty else f"{newline(1)}}}")
+    file.write(f"{newline(0)}}}" if number >= 0 else '}')
+
+
+def merge_files(
+        paths: Iterable[Union[str, Path]],
+        output: IO[str],
+        sections: Iterable[str] = SECTIONS,
+        indent: Optional[int] = None,
+        max_open_files: int = MAX_OPEN_FILES
+) -> None:
+    '''Merge server name JSON files into `output`. Addresses and server
+    names of the same key in several files are united.'''
+    paths, sections = list(paths), tuple(sections)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        level = 0
+        while len(paths) > max_open_files:
+            merged_paths = []
+            for start in range(0, len(paths), max_open_files):
+                batch = paths[start:start + max_open_files]
+                merged_path = Path(temporary_directory) / f"{level}.{start}.json"
+                with open(merged_path, 'w', encoding='utf-8') as file:
+                    write_sections(file, [(section, merge_section(batch, section))
+                                          for section in sections])
+                if level:
+                    for path in batch:
+                        os.remove(path)
+                merged_paths.append(merged_path)
+            paths, level = merged_paths, level + 1
+        write_sections(output, [(section, merge_section(paths, section))
+                                for section in sections], indent)
+
+
+class _Domain_Node:
+    __slots__ = ('children', 'match')
+
+    def __init__(self) -> None:
+        self.children: Dict[str, '_Domain_Node'] = {}
+        # 0: no pattern ends here, 1: subdomains only, 2: domain and subdomains
+        self.match = 0
+
+
+class Domain_Trie:
+    '''Domain name patterns in a trie of reversed labels, so a name is
+    checked against all of them in one walk over its labels.
+
+    `example.com` matches the domain and its subdomains, `*.example.com`
+    only its subdomains and a `*` label elsewhere any one label::
+
+        >>> t = Domain_Trie(['example.com', '*.cdn.example.org', 'api.*.net'])
+        >>> [n in t for n in ('www.example.com', 'cdn.example.org', 'a.cdn.example.org', 'api.x.net')]
+        [True, False, True, True]
+    '''
+    __slots__ = ('_root', '_wildcards')
+
+    def __init__(self, patterns: Iterable[str] = ()) -> None:
+        self._root = _Domain_Node()
+        # Without `*` labels past the leading one a name has one path.
+        self._wildcards = False
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str) -> None:
+        labels = pattern.strip().lower().rstrip('.').split('.')
+        match = 2
+        if labels[0] == '*':
+            labels, match = labels[1:], 1
+        if '' in labels:
+            raise ValueError(f"Invalid domain name pattern: {pattern!r}.")
+        self._wildcards |= '*' in labels
+        node = self._root
+        for label in reversed(labels):
+            node = node.children.setdefault(label, _Domain_Node())
+        node.match = max(node.match, match)
+
+    def __contains__(self, server_name: str) -> bool:
+        labels = server_name.lower().rstrip('.').split('.')
+        if not self._wildcards:
+            node = self._root
+            for label in reversed(labels):
+                if node.match:
+                    return True
+                node = node.children.get(label)
+                if node is None:
+                    return False
+            return node.match == 2
+        nodes = [self._root]
+        for label in reversed(labels):
+            advanced = []
+            for node in nodes:
+                # At least this label is left, so both kinds of patterns match.
+                if node.match:
+                    return True
+                for child in (node.children.get(label), node.children.get('*')):
+                    if child is not None:
+                        advanced.append(child)
+            if not advanced:
+                return False
+            nodes = advanced
+        return any(node.match == 2 for node in nodes)
+
+
+def _address_matcher(addresses: Prefix_Set) -> Callable[[str], bool]:
+    '''Membership test of address strings by bisecting the ranges of
+    the set, without building an address object per lookup.'''
+    bounds = {}
+    for version in (4, 6):
+        ranges = list(addresses.ranges(version))
+        bounds[version] = [first for first, _ in ranges], [last for _, last in ranges]
+
+    def contains(address: str) -> bool:
+        version, value = address_key(address)
+        firsts, lasts = bounds[version]
+        i = bisect_right(firsts, value) - 1
+        return i >= 0 and value <= lasts[i]
+    return contains
+
+
+class Substring_Automaton:
+    '''Aho-Corasick automaton of case-insensitive substrings, checking
+    a text against all of them in one pass over its characters::
+
+        >>> a = Substring_Automaton(['google', 'gstatic', 'tube'])
+        >>> [t in a for t in ('www.youtube.com', 'fonts.GSTATIC.com', 'example.com')]
+        [True, True, False]
+    '''
+    __slots__ = ('_goto', '_fail', '_match')
+
+    def __init__(self, substrings: Iterable[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._match: List[bool] = [False]
+        for substring in substrings:
+            state = 0
+            for char in substring.lower():
+                if char not in self._goto[state]:
+                    self._goto[state][char] = len(self._goto)
+                    self._goto.append({})
+                    self._match.append(False)
+                state = self._goto[state][char]
+            self._match[state] = True
+        # Failure links in breadth-first order, so the links of shorter
+        # prefixes are ready when longer ones need them.
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0) if state else 0
+                self._match[child] |= self._match[self._fail[child]]
+                queue.append(child)
+        if self._match[0]:
+            raise ValueError("Empty substrings match everything.")
+
+    def __contains__(self, text: str) -> bool:
+        goto, fail, match = self._goto, self._fail, self._match
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if match[state]:
+                return True
+        return False
+
+
+def filter_sections(
+        sections: Iterable[Tuple[str, Iterable[ENTRY]]],
+        addresses: Optional[Prefix_Set] = None,
+        server_names: Optional[Domain_Trie] = None
+) -> Iterator[Tuple[str, Iterator[ENTRY]]]:
+    '''Keep the entries whose key and at least one of whose values pass
+    the filters, with only those values. A missing filter passes all.'''
+    if addresses is None:
+        address_passes = lambda address: True
+    else:
+        # The same addresses repeat as values of many server names.
+        address_passes = lru_cache(maxsize=65536)(_address_matcher(addresses))
+    if server_names is None:
+        server_name_passes = lambda server_name: True
+    else:
+        server_name_passes = lru_cache(maxsize=65536)(server_names.__contains__)
+
+    def filtered(entries: Iterable[ENTRY], key_passes, value_passes) -> Iterator[ENTRY]:
+        for key, values in entries:
+            if key_passes(key):
+                values = [value for value in values if value_passes(value)]
+                if values:
+                    yield key, values
+
+    for section, entries in sections:
+        if section == ADDRESS_TO_SERVER_NAMES:
+            yield section, filtered(entries, address_passes, server_name_passes)
+        else:
+            yield section, filtered(entries, server_name_passes, address_passes)
+
+
+def filter_file(
+        path: Union[str, Path],
+        output: IO[str],
+        addresses: Optional[Prefix_Set] = None,
+        server_names: Optional[Domain_Trie] = None,
+        indent: Optional[int] = None
+) -> None:
+    write_sections(output, filter_sections(read_sections(path), addresses, server_names), indent)
+
+
+def test_merge_files() -> bool:
+    import io
+    import random
+    from .Wireshark.Main import Tshark
+
+    def sni_dict(pairs):
+        result = {}
+        for section, (key_function, value_key) in SECTION_KEYS.items():
+            entries = {}
+            for address, server_name in pairs:
+                key, value = ((address, server_name) if section == ADDRESS_TO_SERVER_NAMES
+                              else (server_name, address))
+                entries.setdefault(key, set()).add(value)
+            result[section] = {key: sorted(entries[key], key=value_key)
+                               for key in sorted(entries, key=key_function)}
+        return result
+
+    random.seed(14)
+    addresses = [f"10.{i}.{j}.1" for i in range(4) for j in range(4)] + ['2001:db8::1', '::1']
+    server_names = [f"{h}.{d}" for h in ('a', 'b', 'www') for d in ('example.com', 'example.org', 'b.io')]
+    files = [random.sample([(a, s) for a in addresses for s in server_names], 20) for _ in range(9)]
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for number, pairs in enumerate(files):
+            paths.append(Path(directory) / f"{number}.json")
+            with open(paths[-1], 'w', encoding='utf-8') as file:
+                json.dump(Tshark.server_name_dicts(pairs), file, indent=number % 3 or None)
+        expected = sni_dict([pair for pairs in files for pair in pairs])
+        for indent in (None, 0, 2):
+            for max_open_files in (2, 3, MAX_OPEN_FILES):
+                output = io.StringIO()
+                merge_files(paths, output, indent=indent, max_open_files=max_open_files)
+                ok &= output.getvalue() == json.dumps(expected, ensure_ascii=False, indent=indent)
+        output = io.StringIO()
+        merge_files(paths, output, sections=(SERVER_NAME_TO_ADDRESSES,))
+        ok &= json.loads(output.getvalue()) == {
+            SERVER_NAME_TO_ADDRESSES: expected[SERVER_NAME_TO_ADDRESSES]}
+    return ok
+
+
+def test_filter_sections() -> bool:
+    trie = Domain_Trie(['example.com', '*.example.org', 'a.*.b.io', '*'])
+    ok = all(name in trie for name in ('x.y', 'example.com', 'w.example.org', 'a.x.b.io'))
+    trie = Domain_Trie(['example.com', '*.example.org', 'a.*.b.io'])
+    ok &= all(name in trie for name in ('Example.COM.', 'w.x.example.com', 'w.example.org', 'z.a.x.b.io'))
+    ok &= not any(name in trie for name in ('example.org', 'xexample.com', 'a.b.io', 'com', 'b.x.b.io'))
+
+    sections = [
+        (ADDRESS_TO_SERVER_NAMES, {'10.0.0.1': ['a.example.com', 'b.example.net'],
+                                   '10.1.0.1': ['a.example.com'],
+                                   '2001:db8::1': ['b.example.net']}),
+        (SERVER_NAME_TO_ADDRESSES, {'a.example.com': ['10.0.0.1', '10.1.0.1'],
+                                    'b.example.net': ['10.0.0.1', '2001:db8::1']})
+    ]
+    result = {section: dict(entries) for section, entries in filter_sections(
+        ((section, entries.items()) for section, entries in sections),
+        Prefix_Set(['10.0.0.0/16', '2001:db8::/32']), Domain_Trie(['example.com']))}
+    ok &= result == {
+        ADDRESS_TO_SERVER_NAMES: {'10.0.0.1': ['a.example.com']},
+        SERVER_NAME_TO_ADDRESSES: {'a.example.com': ['10.0.0.1']}}
+    return ok
+
+
+if __name__ == '__main__':
+    print(test_merge_files())
+    print(test_filter_sections())
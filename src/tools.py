@@ -1,13 +1,16 @@
 import os
 import sys
-from typing import Any, NoReturn, Optional, Union
+import tempfile
+from pathlib import Path
+from typing import IO, Any, Callable, Iterable, NoReturn, Optional, Union
+from functools import lru_cache
 from datetime import datetime
 from ipaddress import (
     IPv4Address, IPv6Address,
     IPv4Network, IPv6Network,
     ip_address, ip_network
 )
-from socket import AddressFamily, SocketKind
+from socket import AddressFamily, SocketKind, inet_pton, AF_INET, AF_INET6
 
 
 def die(code: int, message: Optional[str] = None) -> NoReturn:
@@ -18,38 +21,93 @@ def die(code: int, message: Optional[str] = None) -> NoReturn:
     sys.exit(code)
 
 
+Converter = Callable[[Any], Any]
+
+CONVERTERS: dict[Any, Converter] = {}
+
+
+def register_converter(*target_types: Any) -> Callable[[Converter], Converter]:
+    '''Register the decorated function as the converter to `target_types`.'''
+    def register(converter: Converter) -> Converter:
+        for target_type in target_types:
+            CONVERTERS[target_type] = converter
+        get_converter.cache_clear()
+        return converter
+    return register
+
+
+@lru_cache(maxsize=None)
+def get_converter(target_type: Any) -> Converter:
+    '''The converter to `target_type`, resolved once per type.
+
+    Classes without a converter of their own use the one of their closest
+    registered base class; anything else is converted with `str`.
+    '''
+    if target_type in CONVERTERS:
+        return CONVERTERS[target_type]
+    if isinstance(target_type, type):
+        for base in target_type.__mro__[1:-1]:
+            if base in CONVERTERS:
+                return CONVERTERS[base]
+    return str
+
+
 def cast_value(value: Any, target_type:
      Union[int, float, str, datetime, AddressFamily, SocketKind, IPv4Address, IPv6Address, IPv4Network, IPv6Network]
 ) -> Union[int, float, str, datetime, AddressFamily, SocketKind, IPv4Address, IPv6Address, IPv4Network, IPv6Network]:
-    if target_type == int or target_type in (AddressFamily, SocketKind):
-        if isinstance(value, int):
-            return value
-        else:
-            if ',' in value:
-                return int(value.replace(',', ''))
-            else:
-                return int(value)
-    elif target_type == float:
-        return float(value)
-    elif target_type == str:
-        return str(value)
-    elif target_type == datetime:
-        if isinstance(value, datetime):
-            return value
-        elif isinstance(value, float):
-            try:
-                return datetime.fromtimestamp(value)
-            except Exception as e:
-                raise e
-        # elif isinstance(value, str):
-        #     try: return datetime.fromtimestamp(float(value))
-        #     except: pass
-    elif target_type == Union[IPv4Address, IPv6Address]:
-        return ip_address(value)
-    elif target_type == Union[IPv4Network, IPv6Network]:
-        return ip_network(value)
-    else:
-        return str(value)
+    return get_converter(target_type)(value)
+
+
+def cast_values(values: Iterable[Any], target_type: Any) -> list:
+    '''Convert a whole column of values to `target_type`.'''
+    return list(map(get_converter(target_type), values))
+
+
+def row_converter(target_types: Iterable[Any]) -> Callable[[Iterable[Any]], list]:
+    '''Converter of rows whose values are of `target_types`, in order.'''
+    converters = tuple(map(get_converter, target_types))
+    def convert(values: Iterable[Any]) -> list:
+        return [convert(value) for convert, value in zip(converters, values)]
+    return convert
+
+
+@register_converter(int, AddressFamily, SocketKind)
+def to_int(value: Union[int, str]) -> int:
+    if isinstance(value, int):
+        return value
+    return int(value.replace(',', ''))
+
+
+register_converter(float)(float)
+register_converter(str)(str)
+
+
+@register_converter(datetime)
+def to_datetime(value: Union[datetime, float]) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    elif isinstance(value, float):
+        return datetime.fromtimestamp(value)
+    # elif isinstance(value, str):
+    #     try: return datetime.fromtimestamp(float(value))
+    #     except: pass
+
+
+@register_converter(Union[IPv4Address, IPv6Address])
+def parse_ip_address(item: str) -> Union[IPv4Address, IPv6Address]:
+    '''`ip_address` of a string, several times faster: `inet_pton` parses
+    the text and the address is built from the integer.'''
+    try:
+        if ':' in item:
+            return IPv6Address(int.from_bytes(inet_pton(AF_INET6, item), 'big'))
+        return IPv4Address(int.from_bytes(inet_pton(AF_INET, item), 'big'))
+    except (OSError, TypeError):
+        # Scoped IPv6 addresses, address objects or invalid values
+        # for `ip_address` to deal with.
+        return ip_address(item)
+
+
+register_converter(Union[IPv4Network, IPv6Network])(ip_network)
 
 
 def obj_to_stringified_dict(obj) -> dict[str, Union[int, str]]:
@@ -79,3 +137,29 @@ def get_file_size(file_path):
     except OSError as e:
         print(f"Error getting file size: {e}")
         return 0
+
+
+def write_atomically(path: Union[str, Path], write: Callable[[IO[str]], None]) -> None:
+    '''Write a text file by `write` to a temporary file next to it which
+    then replaces it, so readers never see partial data. On any error the
+    temporary file is removed, the previous file is left in place and the
+    error is raised.'''
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def remove_files(directory: Union[str, Path], pattern: str) -> int:
+    '''Remove the files of `directory` matching the glob `pattern`,
+    return their number.'''
+    removed = 0
+    for path in Path(directory).glob(pattern):
+        path.unlink(missing_ok=True)
+        removed += 1
+    return removed